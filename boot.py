@@ -0,0 +1,11 @@
+# autocopy
+
+"""
+Runs once at power-up, before USB starts. Changes here only take effect after
+a hard reset (the reset button, or unplugging the Macropad).
+"""
+
+import usb_cdc
+
+# Keep the REPL console, and add the data port telemetry.py talks on
+usb_cdc.enable(console=True, data=True)
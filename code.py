@@ -1,195 +1,75 @@
 # autocopy
+from micropython import const
 
 # Run synchronous or asynchronous
 USE_ASYNC = True
 # Disable all HID outputs
 REPL_MODE = True
+# Measure heap allocations in the event and frame loops at boot
+AUDIT_ALLOCATIONS = False
+# Time every task and report loop health on the console and a debug page.
+# This is a const: with 0, the compiler leaves the profiling code out entirely.
+PROFILE = const(1)
+# Record key and encoder input in RAM. Hold any key and click the encoder to
+# dump it to the console, then replay it with host/replay.py. Also a const.
+TRACE_INPUT = const(0)
+# Send telemetry and take commands on the usb_cdc data port, for
+# host/monitor.py. boot.py enables the port. Also a const.
+TELEMETRY = const(1)
 
-if USE_ASYNC:
-    import asyncio
-
-import board
-from digitalio import DigitalInOut, Pull
-from displayio import Group
-from adafruit_display_text import label
-import adafruit_ds3231
-from adafruit_fancyled.adafruit_fancyled import expand_gradient, CRGB, denormalize
-
-# from adafruit_hid.keyboard import Keyboard
-from adafruit_hid.consumer_control import ConsumerControl
-from adafruit_hid.keycode import Keycode as K
-import keypad
-from math import copysign
-import microcontroller
-import neopixel
-from adafruit_simple_text_display import SimpleTextDisplay as SimTex
-import rotaryio
-from terminalio import FONT
-from time import monotonic
-import usb_hid
+from time import monotonic, sleep
 
 
 """
-NVM MANAGEMENT
+BOOT TIMELINE
 """
+# Until the first mute report goes out, the mic might be live. So boot runs in
+# order of urgency: HID and the mute first, then the keys and LEDs, then the
+# clock. Heavy imports wait for the section that needs them, and the menu only
+# loads its library when it's first opened.
+#
+# time.monotonic() counts from power-on, so these are absolute. (s)
+#
+# The boot report ends with the heap: if the largest free block after boot
+# drops under HEAP_BUDGET, something grew. (B)
+HEAP_BUDGET = const(32 * 1024)
+boot_times = [("code.py started", monotonic())]
 
 
-def fetch_nvm_sel_hour():
-    # NVM byte 0
-    mem_sel_hour = microcontroller.nvm[0]
-    # decode selected
-    mem_selected = mem_sel_hour & 0b000_000_11
-    # decode hour
-    mem_hour = (mem_sel_hour & 0b000_111_00) >> 2
-    mem_hour -= 4
-
-    return mem_selected, mem_hour
-
-
-def fetch_nvm_brightness():
-    # NVM byte 1
-    mem_bright = microcontroller.nvm[1]
-    brightness = mem_bright / 255
-    return brightness
-
-
-def set_nvm_selected(value):
-    mem_sel_hour = microcontroller.nvm[0]
-    mem_sel_hour &= 0b111_111_00
-    mem_sel_hour |= value << 0
-    microcontroller.nvm[0] = mem_sel_hour
+def mark_boot(event):
+    boot_times.append((event, monotonic()))
 
 
-def set_nvm_hour(value):
-    value += 4
-    value = max(0, min(value, 7))
-    mem_sel_hour = microcontroller.nvm[0]
-    mem_sel_hour &= 0b111_000_11
-    mem_sel_hour |= value << 2
-    microcontroller.nvm[0] = mem_sel_hour
+def report_boot():
+    for event, at in boot_times:
+        print(f"boot: {event} at {at * 1000:.0f} ms")
+    # what's left once everything is loaded and the first frames are out
+    free = gc.mem_free()
+    largest = largest_free_block()
+    print(f"boot: heap {free} B free, largest block {largest} B")
+    if largest < HEAP_BUDGET:
+        print(f"boot: largest free block is under the {HEAP_BUDGET} B budget!")
 
 
-def set_nvm_brightness(value):
-    mem_bright = int(value * 255)
-    microcontroller.nvm[1] = mem_bright
+# Only what the mute needs
+import board
+import microcontroller
+import usb_hid
+from adafruit_hid.consumer_control import ConsumerControl
+from adafruit_hid.keycode import Keycode as K
+from hid_queue import HIDQueue
+from settings import Settings
+from ticks import ticks_add, ticks_diff, ticks_ms
 
 
 """
-CLOCK
+SETTINGS
 """
-rtc = adafruit_ds3231.DS3231(board.I2C())
-print(rtc.datetime)
-
-
-class GraphicalUserInterface:
-    INTERVAL = 30
-    WHITE = (255, 255, 255)
-    BLACK = (0, 0, 0)
-
-    def __init__(self):
-        # fetch values from NVM
-        mem_selected, mem_hour = fetch_nvm_sel_hour()
-        self._selected = mem_selected % 3
-        self._hour_offset = mem_hour
-
-        # display init
-        self.d = board.DISPLAY
-        self.d.rotation = 90
-
-        # sync mode setup
-        self.last_update = monotonic() - self.INTERVAL
-
-        # create clock label
-        self.l = label.Label(FONT, text="20\n15", scale=4)
-        self.l.x = 10
-        self.l.y = 25
-        # update and show
-        self.tick_sync()
-        self.show_clock()
-
-        # menu
-        self.m = None
-
-    # NVM-stored properties
-    @property
-    def selected(self):
-        return self._selected
-
-    @selected.setter
-    def selected(self, value):
-        value %= 3
-        self._selected = value
-        self._update_selection()
-        set_nvm_selected(value)
-
-    @property
-    def hour_offset(self):
-        return self._hour_offset
-
-    @hour_offset.setter
-    def hour_offset(self, value):
-        value = min(4, max(value, -4))
-        self._hour_offset = value
-        self._update_clock_label()
-        set_nvm_hour(value)
-
-    # SCHEDULED TASKS
-    def tick_sync(self):
-        if self.last_update + self.INTERVAL < monotonic():
-            self._update_clock_label()
-            self.last_update = monotonic()
-
-    async def tick(self):
-        while True:
-            # Do first update right away
-            self._update_clock_label()
-
-            # Do subsequent updates at the top of the minute
-            next_minute_seconds = 60 - rtc.datetime.tm_sec
-            await asyncio.sleep(next_minute_seconds)
-
-    # CLOCK
-    def show_clock(self):
-        self.d.show(self.l)
-
-    def _update_clock_label(self):
-        t = rtc.datetime
-        hour = (t.tm_hour + self.hour_offset) % 24
-        self.l.text = f"{hour:0>2}\n{t.tm_min:0>2}"
-
-    # MENU
-    def show_menu(self):
-        self._update_selection()
-        self.m.show()
-
-    def showing_menu(self):
-        return bool(self.m and self.d.root_group[0] == self.m[0])
-
-    def _build_menu(self):
-        self.m = SimTex(colors=[self.WHITE])
-        self.m[0].text = "  ENCODER  "
-        self.m[1].text = "  FUNCTION "
-        self.m[2].text = "~~~~~~~~~~~"
-        self.m[3].text = "Brightness "
-        self.m[4].text = "Volume     "
-        self.m[5].text = "Hour offset"
-
-    def _update_selection(self):
-        if not self.m:
-            self._build_menu()
-
-        # Clear selection
-        for label in self.m._lines:
-            label.color = self.WHITE
-            label.background_color = self.BLACK
-
-        # Set new selection
-        idx = self.selected + 3
-        self.m[idx].color = self.BLACK
-        self.m[idx].background_color = self.WHITE
-
-
-gui = GraphicalUserInterface()
+# settings.json overrides the defaults below (see settings.py). Boot uses the
+# copy cached in NVM, so the mute doesn't wait for the file: it's checked once
+# the clock is up.
+settings = Settings.cached(microcontroller.nvm)
+mark_boot(f"settings loaded from {settings.source}")
 
 
 """
@@ -219,17 +99,65 @@ else:
 #
 class Voicemeeter:
     """
-    A small class to handle mute and unmute states.
+    A small class to handle mute and unmute states. Reports go out through an
+    HIDQueue: mute and unmute immediately, volume steps at a steady rate.
+
+    The state we want (muted, what the LEDs show) and the state we last
+    reported to the host are kept apart, so:
+
+    -- setting the state we already reported sends nothing.
+    -- a change within MUTE_WINDOW of the previous report waits for the window
+    to close, and then only the net change goes out. Mashing keys sends the
+    first transition right away and at most one more after it, instead of a
+    burst for the host to race through.
+    -- if nothing was reported for REASSERT_PERIOD, the state is sent again, in
+    case the host missed a report. MUTE and UNMUTE set the state rather than
+    flip it, so sending one twice is harmless.
     """
 
-    MUTE = 200  # (K.ALT, K.KEYPAD_ZERO)
-    UNMUTE = 201  # (K.ALT, K.KEYPAD_ONE)
-    VOLUME_UP = 202  # (K.ALT, K.KEYPAD_TWO)
-    VOLUME_DOWN = 203  # (K.ALT, K.KEYPAD_THREE)
+    # CircuitPython ignores __slots__: instances there get a small dict either
+    # way. CPython enforces it, so in the emulator an attribute that isn't
+    # listed (a typo, usually) fails loudly instead of quietly becoming a new
+    # one. The other classes below list theirs too.
+    __slots__ = (
+        "hid_queue",
+        "_muted",
+        "_reported",
+        "_reported_at",
+        "_asserted_at",
+        "_deferred",
+        "suppressed",
+        "reasserted",
+    )
+
+    MUTE = settings.get("mute_code", 200)  # (K.ALT, K.KEYPAD_ZERO)
+    UNMUTE = settings.get("unmute_code", 201)  # (K.ALT, K.KEYPAD_ONE)
+    VOLUME_UP = settings.get("volume_up_code", 202)  # (K.ALT, K.KEYPAD_TWO)
+    VOLUME_DOWN = settings.get("volume_down_code", 203)  # (K.ALT, K.KEYPAD_THREE)
+    # Changes this soon after a report are collapsed into one (ms). 0 sends
+    # every change right away.
+    MUTE_WINDOW = 50
+    # Send the state again after this long without a report (ms)
+    REASSERT_PERIOD = 30_000
 
     def __init__(self, hid_device):
-        self._hid_device = hid_device
+        self.hid_queue = HIDQueue(hid_device, self.VOLUME_UP, self.VOLUME_DOWN)
         self._muted = None
+        # last state sent to the host, and when it last changed. Only a
+        # change opens MUTE_WINDOW: re-asserting the same state mustn't hold
+        # back the next key press.
+        self._reported = None
+        self._reported_at = ticks_ms()
+        # when the state was last sent at all, changed or not
+        self._asserted_at = self._reported_at
+        # changes waiting for the window to close
+        self._deferred = 0
+
+        # counters
+        # changes that didn't get a report of their own
+        self.suppressed = 0
+        self.reasserted = 0
+
         self.mute()
 
     @property
@@ -242,12 +170,31 @@ class Voicemeeter:
 
     @muted.setter
     def muted(self, value):
-        if value:
-            self._hid_device.send(self.MUTE)
-            self._muted = True
+        value = bool(value)
+        self._muted = value
+        if self._deferred:
+            self._deferred += 1
+        elif value == self._reported:
+            self.suppressed += 1
+        elif self._reported is not None and self._in_window(ticks_ms()):
+            self._deferred = 1
         else:
-            self._hid_device.send(self.UNMUTE)
-            self._muted = False
+            self._report()
+
+    def _in_window(self, now):
+        # (a report days old can look recent once ticks wrap, hence the 0)
+        return 0 <= ticks_diff(now, self._reported_at) < self.MUTE_WINDOW
+
+    def _report(self):
+        muted = self._muted
+        self.hid_queue.send_priority(self.MUTE if muted else self.UNMUTE)
+        self._reported = muted
+        self._reported_at = self._asserted_at = ticks_ms()
+
+    def _reassert(self):
+        self.hid_queue.send_priority(self.MUTE if self._reported else self.UNMUTE)
+        self._asserted_at = ticks_ms()
+        self.reasserted += 1
 
     def mute(self):
         self.muted = True
@@ -258,20 +205,110 @@ class Voicemeeter:
     def toggle(self):
         self.muted = not self.muted
 
+    def send(self, code):
+        # any consumer control code, right away
+        self.hid_queue.send_priority(code)
+
     def change_volume(self, change):
-        direction = int(copysign(1, change))
-        #              0               1                -1
-        keycombo = (None, self.VOLUME_UP, self.VOLUME_DOWN)[direction]
-        count = abs(change)
-        for _ in range(count):
-            self._hid_device.send(keycombo)
+        # Positive changes turn the volume up. The first step goes out now if
+        # the rate limit allows, the queue sends the rest later.
+        self.hid_queue.add_steps(change)
+        self.hid_queue.pump()
+
+    def register(self, tasks):
+        tasks.add("hid", self._pump, self.hid_queue.REPORT_PERIOD, scheduler.HID)
+
+    def _pump(self):
+        now = ticks_ms()
+        if self._deferred:
+            if not self._in_window(now):
+                self._send_deferred()
+        elif ticks_diff(now, self._asserted_at) >= self.REASSERT_PERIOD:
+            self._reassert()
+        self.hid_queue.pump()
+
+    def _send_deferred(self):
+        # every change in the window but one is suppressed, or all of them if
+        # they cancelled out
+        deferred = self._deferred
+        self._deferred = 0
+        if self._muted == self._reported:
+            self.suppressed += deferred
+        else:
+            self.suppressed += deferred - 1
+            self._report()
 
 
 voicemeeter = Voicemeeter(hid_keyboard)
+mark_boot("mute report sent")
+
+# Everything the keys and LEDs need
+from array import array
+import gc
+from heap import largest_free_block
+from adafruit_fancyled.adafruit_fancyled import expand_gradient, CRGB, denormalize
+import keypad
+from framebuffer import B, G, R, FrameBuffer
+from gestures import ANY, PRESS, QUICK, RELEASE, SLOW, GestureEngine
+import keymap
+from keymap import CONSUMER, LATCH, LAYER, MOMENTARY, NOTHING, VOLUME
+from nvm_store import NVMStore
+from ring_buffer import RingBuffer
+import rotaryio
+import scheduler
+
+
+"""
+NVM MANAGEMENT
+"""
+# Settings live in RAM and are written out after they stop changing. See
+# nvm_store.py.
+nvm_store = NVMStore(microcontroller.nvm)
+# How often to check whether the settings are due to be written (ms)
+NVM_FLUSH_PERIOD = const(1000)
+
+
+def fetch_nvm_sel_hour():
+    return nvm_store.selected, nvm_store.hour_offset
+
+
+def fetch_nvm_brightness():
+    if nvm_store.version < 2:
+        # Older versions stored neopixel's linear brightness (0-255). Find the
+        # level that's just as bright.
+        linear = nvm_store.brightness / 255
+        nvm_store.brightness = MacroKeys.level_from_linear(linear)
+        nvm_store.version = nvm_store.VERSION
+    return nvm_store.brightness
+
+
+def set_nvm_selected(value):
+    nvm_store.selected = value
+
+
+def set_nvm_hour(value):
+    nvm_store.hour_offset = value
+
+
+def set_nvm_brightness(value):
+    nvm_store.brightness = value
+
+
+def flush_nvm():
+    # A write blocks for tens of ms. While a key is held, its release is a
+    # mute report, so wait until it's out.
+    if macro_keys.pressed_mask:
+        return
+    nvm_store.flush_if_due()
+
 
 """
 MACROPAD HARDWARE
 """
+if TRACE_INPUT:
+    from input_trace import InputTrace
+
+    input_trace = InputTrace()
 
 #
 # ENCODER
@@ -281,10 +318,41 @@ encoder_button = keypad.Keys([board.BUTTON], value_when_pressed=False, pull=True
 
 
 class MacroEncoder:
+    """
+    Samples the encoder often, keeps a running estimate of how fast it's
+    turning, and scales each detent by the current mode's acceleration curve.
+    Slow turns make fine adjustments, a quick spin covers the whole range. The
+    button is polled on its own, slower schedule and debounced separately.
+    """
+
+    __slots__ = (
+        "_encoder_pos",
+        "_modes",
+        "velocity",
+        "_last_move_time",
+        "_last_press_time",
+    )
+
+    # Sample encoder position (ms)
+    ENCODER_PERIOD = settings.get("encoder_period", 5)
     # Check encoder presses (ms)
-    BUTTON_PERIOD = 100
-    # Check encoder position (ms)
-    ENCODER_PERIOD = 500
+    BUTTON_PERIOD = 20
+    # Ignore presses this soon after the last accepted one (ms)
+    BUTTON_DEBOUNCE = 150
+    # How much a new velocity sample moves the estimate (0-1)
+    VELOCITY_SMOOTHING = 0.5
+    # Forget the velocity after this long without movement (ms)
+    VELOCITY_TIMEOUT = 250
+    # Acceleration curves, one per mode, in the same order as self._modes.
+    # Each is ((detents per second, multiplier), ...), slowest first.
+    ACCELERATION = (
+        # brightness
+        ((0, 1), (10, 2), (20, 3)),
+        # volume
+        ((0, 1), (8, 2), (20, 3)),
+        # hour offset
+        ((0, 1),),
+    )
 
     def __init__(self):
         self._encoder_pos = encoder.position
@@ -294,32 +362,83 @@ class MacroEncoder:
             self._set_hour,
         )
 
-    async def tick(self):
-        while True:
-            # Check encoder position
-            if not self._encoder_pos == encoder.position:
-                # get delta, reset saved position
-                delta = self._encoder_pos - encoder.position
-                self._encoder_pos = encoder.position
-
-                # find current mode, run its function
-                if gui.showing_menu():
-                    self._set_menu_selection(delta)
-                else:
-                    mode_function = self._modes[gui.selected]
-                    mode_function(delta)
-
-            # Check encoder button
-            event = encoder_button.events.get()
-            if event and event.pressed:
-                self._toggle_menu()
-
-            # Next loop
-            await asyncio.sleep_ms(self.ENCODER_PERIOD)
+        # velocity estimate, in detents per second
+        self.velocity = 0
+        # (ticks_ms(), like the scheduler: monotonic() loses the ms after a
+        # few hours up)
+        self._last_move_time = ticks_ms()
+        self._last_press_time = ticks_add(ticks_ms(), -self.BUTTON_DEBOUNCE)
+
+    def register(self, tasks):
+        # turning the knob is input too, so it goes in line with the keys
+        tasks.add("encoder", self._sample_position, self.ENCODER_PERIOD, scheduler.KEYS)
+        tasks.add("enc button", self._poll_button, self.BUTTON_PERIOD, scheduler.KEYS)
+
+    # POSITION
+    def _sample_position(self):
+        position = encoder.position
+        if position == self._encoder_pos:
+            return
+        idle_mode.touch()
+        if TRACE_INPUT:
+            input_trace.encoder(position - self._encoder_pos)
+        # get delta, reset saved position
+        delta = self._encoder_pos - position
+        self._encoder_pos = position
+        self._update_velocity(delta)
+
+        # find current mode, run its function
+        if gui.showing_menu():
+            self._set_menu_selection(delta)
+        else:
+            selected = gui.selected
+            multiplier = self._get_multiplier(self.ACCELERATION[selected])
+            self._modes[selected](delta * multiplier)
 
+    def _update_velocity(self, delta):
+        """
+        Smooths detents-per-second samples, so one quick twitch doesn't send
+        the value flying. A pause resets the estimate.
+        """
+        now = ticks_ms()
+        elapsed = ticks_diff(now, self._last_move_time)
+        self._last_move_time = now
+        # (negative if the last move was so long ago that ticks wrapped)
+        if not 0 <= elapsed <= self.VELOCITY_TIMEOUT:
+            self.velocity = 0
+            return
+        sample = abs(delta) * 1000 / max(elapsed, self.ENCODER_PERIOD)
+        self.velocity += (sample - self.velocity) * self.VELOCITY_SMOOTHING
+
+    def _get_multiplier(self, curve):
+        multiplier = 1
+        for min_velocity, curve_multiplier in curve:
+            if self.velocity < min_velocity:
+                break
+            multiplier = curve_multiplier
+        return multiplier
+
+    # BUTTON
+    def _poll_button(self):
+        event = encoder_button.events.get()
+        if not (event and event.pressed):
+            return
+        idle_mode.touch()
+        if TRACE_INPUT:
+            input_trace.encoder_press()
+            if macro_keys.pressed_mask:
+                # a key is held: dump the trace instead of opening the menu
+                input_trace.dump()
+                return
+        now = ticks_ms()
+        if 0 <= ticks_diff(now, self._last_press_time) < self.BUTTON_DEBOUNCE:
+            return
+        self._last_press_time = now
+        self._toggle_menu()
+
+    # MODES
     def _set_brightness(self, delta):
-        pixel_buf.brightness += delta * 0.01
-        set_nvm_brightness(pixel_buf.brightness)
+        macro_keys.brightness += delta
 
     def _set_volume(self, delta):
         voicemeeter.change_volume(delta)
@@ -331,7 +450,13 @@ class MacroEncoder:
         gui.selected -= delta
 
     def _toggle_menu(self):
+        # clock -> menu -> (debug page ->) clock
         if gui.showing_menu():
+            if PROFILE:
+                gui.show_debug(health.lines())
+            else:
+                gui.show_clock()
+        elif gui.showing_debug():
             gui.show_clock()
         else:
             gui.show_menu()
@@ -342,8 +467,10 @@ macro_encoder = MacroEncoder()
 #
 # KEYS
 #
-pixel_buf = neopixel.NeoPixel(board.NEOPIXEL, 12, brightness=fetch_nvm_brightness())
-pixel_order = (2, 5, 8, 11, 1, 4, 7, 10, 0, 3, 6, 9)
+# Brightness is applied by MacroKeys' lookup table, so frames go out as they
+# are, and only when they changed
+pixel_buf = FrameBuffer(board.NEOPIXEL, 12)
+pixel_order = settings.get("pixel_order", (2, 5, 8, 11, 1, 4, 7, 10, 0, 3, 6, 9))
 
 # fmt: off
 # key_pins_portrait = (
@@ -357,7 +484,15 @@ key_pins_landscape = (
     board.KEY1, board.KEY4, board.KEY7, board.KEY10,
 )
 # fmt: on
-keys = keypad.Keys(key_pins_landscape, value_when_pressed=False, pull=True)
+# Scan the switches every 5 ms (keypad's default is 20 ms). keypad debounces by
+# only comparing scans, and MX switches settle well inside 5 ms.
+KEY_SCAN_INTERVAL = 0.005
+keys = keypad.Keys(
+    key_pins_landscape,
+    value_when_pressed=False,
+    pull=True,
+    interval=KEY_SCAN_INTERVAL,
+)
 
 
 class MacroKeys:
@@ -366,43 +501,147 @@ class MacroKeys:
     into HID commands and neopixel colors.
     """
 
+    __slots__ = (
+        "_last_event_time",
+        "_ani_offset",
+        "pressed_mask",
+        "events",
+        "_event",
+        "_gestures",
+        "_rocker",
+        "_reverse_rocker",
+        "_actions",
+        "_action_args",
+        "_layer_offset",
+        "_held_slots",
+        "_timed_key_history",
+        "_ripple_sprites",
+        "_ripple_frame",
+        "_paletes",
+        "_palete_windows",
+        "_ripple_pixel",
+        "_lut",
+        "_idle_lut",
+        "idle",
+        "_lit_windows",
+        "_brightness",
+    )
+
     # Configure timing:
-    # Update rainbow scroll
-    PASSIVE_FRAME_PERIOD = 100
-    # In sync mode, update button ripples every x frames
-    ACTIVE_FRAME_RATIO_SYNC = 2
-    # In sync mode, update button ripples
+    # Update rainbow scroll (ms). Frames are cheap table lookups, so this can be
+    # fast; see GRADIENT_LENGTH.
+    PASSIVE_FRAME_PERIOD = settings.get("passive_frame_period", 50)
+    # Update button ripples (ms)
     ACTIVE_FRAME_PERIOD = 100
-    # Check button presses (ms)
-    BUTTON_PERIOD = 100
-    # Check encoder position (ms)
-    ENCODER_PERIOD = 500
+    # Check button presses while the pad is idle (ms)
+    BUTTON_PERIOD = settings.get("button_period", 4)
+    # Check button presses while keys are held or were just released (ms)
+    BUTTON_PERIOD_ACTIVE = 1
+    # How long to keep checking at the active rate after the last event (ms)
+    BUTTON_ACTIVE_WINDOW = 500
 
     # Configure colors:
     # Longer gradients will result in a "slower" animation. The length of both
     # gradients don't have to be the same, but there'll be more of a jump when
-    # moving from one to the other.
-    MUTED_GRADIENT = expand_gradient(
+    # moving from one to the other. The scroll takes GRADIENT_LENGTH *
+    # PASSIVE_FRAME_PERIOD ms to go all the way around. These are the
+    # gradient stops, (position, (r, g, b)), each one is expanded the first
+    # time it's shown.
+    GRADIENT_LENGTH = 100
+    MUTED_GRADIENT = settings.get(
+        "muted_gradient",
         (
-            (0.60, CRGB(237, 42, 7)),
-            (0.80, CRGB(255, 61, 94)),
-            (0.90, CRGB(199, 152, 22)),
-            (1.0, CRGB(237, 42, 7)),
+            (0.60, (237, 42, 7)),
+            (0.80, (255, 61, 94)),
+            (0.90, (199, 152, 22)),
+            (1.0, (237, 42, 7)),
         ),
-        50,
     )
-    UNMUTED_GRADIENT = expand_gradient(
+    UNMUTED_GRADIENT = settings.get(
+        "unmuted_gradient",
         (
-            (0.60, CRGB(0, 212, 123)),
-            (0.80, CRGB(64, 230, 81)),
-            (0.90, CRGB(31, 240, 222)),
-            (1.0, CRGB(0, 212, 123)),
+            (0.60, (0, 212, 123)),
+            (0.80, (64, 230, 81)),
+            (0.90, (31, 240, 222)),
+            (1.0, (0, 212, 123)),
         ),
-        50,
     )
+    # While idle (see IdleMode), the brightness level is divided by this
+    IDLE_DIMMING = 4
     # Static riple color. A dynamic color is also available, see
-    # _do_active_passive_frame_sync.
-    RIPPLE_COLOR = CRGB(82, 150, 14)
+    # _animate_frame.
+    RIPPLE_COLOR = CRGB(*settings.get("ripple_color", (82, 150, 14)))
+    # How much one ripple covers the color under it (out of 256). Where ripples
+    # overlap they add up, to at most 256.
+    RIPPLE_ALPHA = 192
+    # Brightness is a level from 0 (off) to BRIGHTNESS_LEVELS. Levels are
+    # spaced evenly for the eye, not for the LED, so the dim end gets as many
+    # steps as the bright end.
+    BRIGHTNESS_LEVELS = 32
+    # LEDs are linear, eyes aren't. Colors and brightness levels go through
+    # this gamma on the way out.
+    GAMMA = 2.5
+    # Ripple sprites, one per history state. Each is centered on (2,3); see
+    # _build_ripple_sprites. Add more masks for longer ripples.
+    # fmt: off
+    RIPPLE_MASKS = (
+        # most recent history state
+        (
+            (0, 0, 0, 0, 0, 0, 0),
+            (0, 0, 0, 1, 0, 0, 0),
+            (0, 0, 1, 0, 1, 0, 0),
+            (0, 0, 0, 1, 0, 0, 0),
+            (0, 0, 0, 0, 0, 0, 0),
+        ),
+        # second history state
+        (
+            (0, 0, 0, 1, 0, 0, 0),
+            (0, 0, 1, 0, 1, 0, 0),
+            (0, 1, 0, 0, 0, 1, 0),
+            (0, 0, 1, 0, 1, 0, 0),
+            (0, 0, 0, 1, 0, 0, 0),
+        ),
+        # third history state
+        (
+            (0, 0, 1, 0, 1, 0, 0),
+            (0, 1, 0, 0, 0, 1, 0),
+            (1, 0, 0, 0, 0, 0, 1),
+            (0, 1, 0, 0, 0, 1, 0),
+            (0, 0, 1, 0, 1, 0, 0),
+        ),
+        # fourth history state
+        (
+            (0, 1, 0, 0, 0, 1, 0),
+            (1, 0, 0, 0, 0, 0, 1),
+            (0, 0, 0, 0, 0, 0, 0),
+            (1, 0, 0, 0, 0, 0, 1),
+            (0, 1, 0, 0, 0, 1, 0),
+        ),
+    )
+    # fmt: on
+
+    # Configure gestures. Each step is (event kind, key role, time since the
+    # previous step); see gestures.py. Only the rockers do anything so far.
+    # fmt: off
+    GESTURES = (
+        # press 1, press 2, release 1, release 2: latch the current mute state
+        ("rocker", ((PRESS, 0, ANY), (PRESS, 1, ANY), (RELEASE, 0, ANY), (RELEASE, 1, ANY))),
+        # press 1, press 2, release 2, release 1: latches too
+        ("reverse rocker", ((PRESS, 0, ANY), (PRESS, 1, ANY), (RELEASE, 1, ANY), (RELEASE, 0, ANY))),
+        ("double tap", ((PRESS, 0, ANY), (RELEASE, 0, QUICK), (PRESS, 0, QUICK), (RELEASE, 0, ANY))),
+        ("long press", ((PRESS, 0, ANY), (RELEASE, 0, SLOW))),
+        ("chord", ((PRESS, 0, ANY), (PRESS, 1, QUICK))),
+    )
+    # fmt: on
+
+    # Configure keys. One row of (action, argument) per layer, in key_number
+    # order (see key_pins_landscape); see keymap.py for the actions. Layer 0
+    # is active at boot. For example, to give the bottom row volume keys and a
+    # second layer of media keys (0xCD is play/pause):
+    #
+    #     ((MOMENTARY, 0),) * 9 + ((VOLUME, -1), (LAYER, 1), (VOLUME, 1)),
+    #     ((NOTHING, 0),) * 9 + ((CONSUMER, 0xCD), (LAYER, 0), (LATCH, 0)),
+    LAYERS = (((MOMENTARY, 0),) * 12,)
 
     """
     SETUP AND LOOPS
@@ -410,98 +649,279 @@ class MacroKeys:
 
     def __init__(self):
         # variable initial states
-        self._last_frame_time = monotonic()
+        self._last_event_time = ticks_ms()
         self._ani_offset = 0
-        self.pressed_keys = set()
-        self.gesture_history = [frozenset()] * 5
-        self._timed_key_history = [[]] * 5
+        # bit n is set while key n is held
+        self.pressed_mask = 0
+        # key events handled since boot
+        self.events = 0
+        self._event = keypad.Event()
+        self._gestures = GestureEngine(self.GESTURES)
+        self._actions, self._action_args = keymap.compile_layers(self.LAYERS, 12)
+        # offset of the active layer in the action tables
+        self._layer_offset = 0
+        # table slot each key was pressed in, so it's released on the same
+        # layer even if the layer changed in between
+        self._held_slots = array("H", [0] * 12)
+        self._rocker = self._gestures.index("rocker")
+        self._reverse_rocker = self._gestures.index("reverse rocker")
+        self._timed_key_history = RingBuffer(len(self.RIPPLE_MASKS))
+        self._ripple_sprites = self._build_ripple_sprites()
+        # at most one count per history state and key, so bytes are plenty
+        self._ripple_frame = bytearray(12)
+        # palettes as uint8 RGB triples, indexed by voicemeeter.unmuted. Built
+        # when first shown, so boot only pays for the state it starts in.
+        self._paletes = [None, None]
+        # pre-rendered palette windows, indexed the same way
+        self._palete_windows = [None, None]
+        self._ripple_pixel = tuple(denormalize(self.RIPPLE_COLOR))
+        # gamma and brightness, from uint8 color to uint8 LED value
+        self._lut = bytearray(256)
+        # the same at the idle brightness, see go_idle()
+        self._idle_lut = bytearray(256)
+        self.idle = False
+        # the palette windows through the lookup table, as framebuffer bytes.
+        # Built when first needed after a brightness change.
+        self._lit_windows = [None, None]
+        self._brightness = None
+        self.brightness = fetch_nvm_brightness()
+
+    @property
+    def brightness(self):
+        return self._brightness
 
-    def tick_sync(self):
+    @brightness.setter
+    def brightness(self, value):
+        value = min(self.BRIGHTNESS_LEVELS, max(value, 0))
+        if value == self._brightness:
+            return
+        self._brightness = value
+        self._build_lut(self._lut, value)
+        if self.idle:
+            self._build_lut(self._idle_lut, self._idle_level())
+        self._lit_windows[0] = self._lit_windows[1] = None
+        set_nvm_brightness(value)
+
+    def register(self, tasks):
         """
-        Call this method repeatedly to drive button reactions and to animate LEDs.
+        Keys go first in line, and also get the fast lane: pending key events
+        are handled before every task, not just when the keys task is due. The
+        two animation tasks share a priority, and ripples advance right after
+        the frame that was due at the same time.
         """
-        self._handle_button_events_sync()
-        # self._set_brightness_sync()
-        self._set_volume_sync()
-        self._do_active_passive_frame_sync()
-
-    def get_coroutines(self):
-        return (
-            self._handle_button_events(),
-            self._do_passive_frame(),
-            self._do_active_frame(),
+        tasks.fast_lane = self._drain_button_events
+        tasks.add(
+            "keys", self._handle_button_events, self.BUTTON_PERIOD, scheduler.KEYS
+        )
+        tasks.add(
+            "frame", self._do_passive_frame, self.PASSIVE_FRAME_PERIOD, scheduler.LEDS
+        )
+        tasks.add(
+            "ripple",
+            self._advance_timed_key_history,
+            self.ACTIVE_FRAME_PERIOD,
+            scheduler.LEDS,
         )
 
     """
     NEOPIXEL ANIMATION
     """
 
-    async def _do_passive_frame(self):
-        while True:
-            palete_length = self._animate_frame()
-            self._ani_offset = (self._ani_offset + 1) % palete_length
-            await asyncio.sleep_ms(self.PASSIVE_FRAME_PERIOD)
-
-    async def _do_active_frame(self):
-        while True:
-            self._advance_timed_key_history()
-            await asyncio.sleep_ms(self.ACTIVE_FRAME_PERIOD)
-
-    def _do_active_passive_frame_sync(self):
+    def _do_passive_frame(self):
         """
-        Runs on an interval to update pixels. Take note! This is slower than
-        _handle_button_events_sync. It keeps track of its own color cycle progress
-        (the _ani_offset variable), and also advances the _timed_key_history
-        queue (used by _get_press_ripple_frame).
+        Draws a frame and moves the color cycle along (the _ani_offset
+        variable). Ripples advance on their own, slower schedule; see
+        _advance_timed_key_history.
         """
-        next_frame_time = self._last_frame_time + self.PASSIVE_FRAME_PERIOD / 1000
-        if next_frame_time > monotonic():
-            # it's not time to perform an animation
-            return
-        # reset frame timer and run the next frame
-        self._last_frame_time = monotonic()
         palete_length = self._animate_frame()
+        self._ani_offset = (self._ani_offset + 1) % palete_length
 
-        # advance passive animation
-        self._ani_offset += 1
-        self._ani_offset %= palete_length
+    def _advance_timed_key_history(self):
+        self._timed_key_history.push(0)
 
-        # advance button ripple
-        if self._ani_offset % self.ACTIVE_FRAME_RATIO_SYNC:
-            self._advance_timed_key_history()
+    def go_idle(self):
+        """
+        Dims the LEDs and drops any ripples. Waking only clears self.idle:
+        the regular table and lit windows are left as they were.
+        """
+        self._build_lut(self._idle_lut, self._idle_level())
+        self._timed_key_history.clear()
+        self.idle = True
 
-    def _advance_timed_key_history(self):
-        self._timed_key_history.pop()
-        self._timed_key_history.insert(0, [])
+    def _idle_level(self):
+        # dim, but not off unless the LEDs already are
+        return self._brightness // self.IDLE_DIMMING or min(self._brightness, 1)
 
     def _animate_frame(self):
-        # Get base colors.
-        if voicemeeter.unmuted:
-            base_palete = self.UNMUTED_GRADIENT
-        else:
-            base_palete = self.MUTED_GRADIENT
-        base_colors = self._get_color_base(base_palete)
+        """
+        Everything here is integer math on uint8 colors. Pixels without a
+        ripple come straight from the lit windows. Ripples are blended before
+        the lookup table, so they fade into the base colors the same way at
+        every brightness.
+        """
+        # Get base colors. These are already in pixel order, as RGB bytes and
+        # as lit frames, ready for the wire.
+        unmuted = voicemeeter.unmuted
+        windows = self._palete_windows[unmuted]
+        if windows is None:
+            windows = self._load_palete(unmuted)
+        offset = self._ani_offset % len(windows)
+        window = windows[offset]
+        if self.idle:
+            # Dimmed, and without ripples. A few frames a second, so the
+            # window goes through the idle table here rather than being lit
+            # (and cached) ahead of time.
+            lut = self._idle_lut
+            frame = pixel_buf.buffer
+            for idx in range(0, 36, 3):
+                frame[idx + R] = lut[window[idx]]
+                frame[idx + G] = lut[window[idx + 1]]
+                frame[idx + B] = lut[window[idx + 2]]
+            pixel_buf.show()
+            return len(windows)
+        lit_windows = self._lit_windows[unmuted]
+        if lit_windows is None:
+            lit_windows = self._light_windows(windows)
+            self._lit_windows[unmuted] = lit_windows
+        lit_window = lit_windows[offset]
 
         # Draw the ripple. You could also animate the ripple color:
-        # ripple_color = self._get_color_pressed(pressed_palete)
-        ripple_color = self.RIPPLE_COLOR
-        for idx, color_emphasis in enumerate(self._get_press_ripple_frame()):
-            if color_emphasis:
-                base_colors[idx] = ripple_color
+        # ripple_r, ripple_g, ripple_b = self._get_color_pressed(
+        #     self._paletes[voicemeeter.unmuted]
+        # )
+        ripple_r, ripple_g, ripple_b = self._ripple_pixel
+        ripple = self._get_press_ripple_frame()
+        alpha_step = self.RIPPLE_ALPHA
+        lut = self._lut
+
+        # Compose the frame: the lit window, with any rippled pixels written
+        # over it. We have to use pixel_order since the Macropad is rotated.
+        # The ripple is still in key order, the base colors aren't. Composing
+        # is a few us of table lookups and there's one show() at the end, so
+        # key events don't need a turn in the middle of a frame any more.
+        frame = pixel_buf.buffer
+        frame[:] = lit_window
+        for color_idx in range(12):
+            alpha = ripple[color_idx] * alpha_step
+            if not alpha:
+                continue
+            pixel_idx = pixel_order[color_idx]
+            idx = pixel_idx * 3
+            if alpha >= 256:
+                r = ripple_r
+                g = ripple_g
+                b = ripple_b
+            else:
+                r = window[idx]
+                g = window[idx + 1]
+                b = window[idx + 2]
+                r += ((ripple_r - r) * alpha) >> 8
+                g += ((ripple_g - g) * alpha) >> 8
+                b += ((ripple_b - b) * alpha) >> 8
+            frame[idx + R] = lut[r]
+            frame[idx + G] = lut[g]
+            frame[idx + B] = lut[b]
+        # skipped if nothing changed, like a still frame at a steady offset
+        pixel_buf.show()
+
+        # Return the length of the selected palete for timing purposes
+        return len(windows)
+
+    @classmethod
+    def _level_scale(cls, level):
+        """
+        How much a brightness level scales colors, before gamma. Level 1 is
+        the dimmest setting that still lights a full channel; from there on,
+        the levels are evenly spaced.
+        """
+        if level <= 0:
+            return 0
+        lowest = (1 / 255) ** (1 / cls.GAMMA)
+        return lowest + (1 - lowest) * (level - 1) / (cls.BRIGHTNESS_LEVELS - 1)
 
-        # Update neopixels. We have to use _pixel_order since the Macropad is
-        # rotated.
-        for color_idx, pixel_idx in enumerate(pixel_order):
-            pixel_buf[pixel_idx] = denormalize(base_colors[color_idx])
+    @classmethod
+    def level_from_linear(cls, linear):
+        """
+        The level closest to a linear brightness (0-1), like neopixel's.
+        """
+        if linear <= 0:
+            return 0
+        lowest = (1 / 255) ** (1 / cls.GAMMA)
+        scale = linear ** (1 / cls.GAMMA)
+        level = 1 + (scale - lowest) / (1 - lowest) * (cls.BRIGHTNESS_LEVELS - 1)
+        return min(cls.BRIGHTNESS_LEVELS, max(1, round(level)))
+
+    def _build_lut(self, lut, level):
+        """
+        Runs when the brightness changes, not per frame. The brightness level
+        scales the color before gamma, which is what makes the levels even.
+        """
+        scale = self._level_scale(level) / 255
+        gamma = self.GAMMA
+        for value in range(256):
+            lut[value] = int(255 * (value * scale) ** gamma + 0.5)
 
-        # Return the length of the selected base_palete for timing purposes
-        return len(base_palete)
+    def _light_windows(self, windows):
+        """
+        Puts every palette window through the lookup table, into the
+        framebuffer's byte order. Runs on the first frame after a brightness
+        change, for the palette on show.
+        """
+        lut = self._lut
+        lit_windows = []
+        for window in windows:
+            lit = bytearray(len(window))
+            for idx in range(0, len(window), 3):
+                lit[idx + R] = lut[window[idx]]
+                lit[idx + G] = lut[window[idx + 1]]
+                lit[idx + B] = lut[window[idx + 2]]
+            lit_windows.append(lit)
+        return lit_windows
 
     # COLORS
-    def _get_color_base(self, palete):
+    def _load_palete(self, unmuted):
+        """
+        Runs the first time each state is shown. Expands its gradient and
+        renders the palette windows for it.
+        """
+        stops = self.UNMUTED_GRADIENT if unmuted else self.MUTED_GRADIENT
+        stops = [(position, CRGB(*rgb)) for position, rgb in stops]
+        palete = self._build_palete(expand_gradient(stops, self.GRADIENT_LENGTH))
+        self._paletes[unmuted] = palete
+        windows = self._build_palete_windows(palete)
+        self._palete_windows[unmuted] = windows
+        return windows
+
+    def _build_palete(self, gradient):
         """
-        Loops through a palete. When _ani_offset is within 12 positions of the
-        end of the palete, we need to also grab colors from the beginning. This
+        Converts a fancyled gradient into uint8 RGB triples, so no float color
+        is touched after this.
+        """
+        palete = bytearray(3 * len(gradient))
+        for idx in range(len(gradient)):
+            palete[3 * idx : 3 * idx + 3] = bytes(denormalize(gradient[idx]))
+        return bytes(palete)
+
+    def _build_palete_windows(self, palete):
+        """
+        Renders the 12 colors showing at every animation
+        offset, rearranged into pixel order as 36 RGB bytes, so a passive frame
+        is a table lookup instead of slicing palettes.
+        """
+        colors = [palete[idx : idx + 3] for idx in range(0, len(palete), 3)]
+        windows = []
+        for offset in range(len(colors)):
+            key_colors = self._get_color_base(colors, offset)
+            window = bytearray(36)
+            for color_idx, pixel_idx in enumerate(pixel_order):
+                window[3 * pixel_idx : 3 * pixel_idx + 3] = key_colors[color_idx]
+            windows.append(bytes(window))
+        return tuple(windows)
+
+    def _get_color_base(self, palete, offset):
+        """
+        Loops through a palete. When offset is within 12 positions of the end
+        of the palete, we need to also grab colors from the beginning. This
         could also be done with animation.colorcycle in the
         adafruit_led_animation library, but we want more control so that we can
         add ripple effects.
@@ -509,8 +929,8 @@ class MacroKeys:
         # Find the start and end positions for this animation offset. Divmod is
         # handy here, because it'll tell us if we went off the end of the
         # palete.
-        start = self._ani_offset % len(palete)
-        wrap, end = divmod(self._ani_offset + 12, len(palete))
+        start = offset % len(palete)
+        wrap, end = divmod(offset + 12, len(palete))
         # get colors
         if wrap:
             base_colors = palete[start:] + palete[:end]
@@ -520,22 +940,22 @@ class MacroKeys:
 
     def _get_color_pressed(self, palete):
         """
-        Currently unused. Un-comment code in _do_active_passive_frame_sync if you want the ripple
+        Currently unused. Un-comment code in _animate_frame if you want the ripple
         color to cycle, instead of being satic.
         """
         # grab a single color from the palete
-        base_color = palete[self._ani_offset]
+        idx = 3 * (self._ani_offset % (len(palete) // 3))
         # make it a bit brighter
-        return [v + 0.2 for v in base_color]
+        return (
+            min(255, palete[idx] + 51),
+            min(255, palete[idx + 1] + 51),
+            min(255, palete[idx + 2] + 51),
+        )
 
-    def _get_press_ripple_frame(self):
+    def _build_ripple_sprites(self):
         """
-        Uses masks to determine color alterations for rippling button press
-        effects. Instead of calculating which pixels have a ripple using an
-        expanding radius and a lot of math, it's faster and more fun to use
-        sprites! You could add additional animation frames (if you also add more
-        empty history frames to _timed_key_history in __init__), and create
-        fancier ripple patterns. Maybe they should sparkle?
+        Runs once at boot. Cuts every RIPPLE_MASKS entry down to the 4x3 grid
+        for every button, so animating a ripple is only a table lookup.
 
         Each mask is oversized, allowing for margins around the 4x3
         grid of buttons. If we were to drop the leftmost columns and bottommost
@@ -582,219 +1002,721 @@ class MacroKeys:
         row_start    = 3 - x
         row_end      = 7 - x
 
+        The results are flattened row by row into 12 cells, and all of them
+        packed into one bytes object: the sprite for (history_state, button)
+        starts at (history_state * 12 + button) * 12. That's 576 bytes for
+        four states, where tuples of tuples took kilobytes of heap.
+        """
+        sprites = bytearray(len(self.RIPPLE_MASKS) * 12 * 12)
+        start = 0
+        for mask in self.RIPPLE_MASKS:
+            for button in range(12):
+                y, x = divmod(button, 4)
+                col_start = 2 - y
+                col_end = 5 - y
+                row_start = 3 - x
+                row_end = 7 - x
+                for row in mask[col_start:col_end]:
+                    sprites[start : start + 4] = bytes(row[row_start:row_end])
+                    start += 4
+        return bytes(sprites)
+
+    def _get_press_ripple_frame(self):
+        """
+        Uses masks to determine color alterations for rippling button press
+        effects. Instead of calculating which pixels have a ripple using an
+        expanding radius and a lot of math, it's faster and more fun to use
+        sprites! You could add additional animation frames to RIPPLE_MASKS and
+        create fancier ripple patterns. Maybe they should sparkle?
+
+        Ripples created farther back in history have bigger circles than newer
+        ones. The returned list is reused from frame to frame, so copy it if
+        you need to keep it.
         """
-        # Go through each history state and create a mask for the keys pressed
-        # at that state. Ripples created farther back in history have bigger
-        # circles than newer ones.
-        masks = []
-        for button in self._timed_key_history[0]:
-            # most recent history state
-            mask = [
-                [0, 0, 0, 0, 0, 0, 0],
-                [0, 0, 0, 1, 0, 0, 0],
-                [0, 0, 1, 0, 1, 0, 0],
-                [0, 0, 0, 1, 0, 0, 0],
-                [0, 0, 0, 0, 0, 0, 0],
-            ]
-            y, x = divmod(button, 4)
-            col_start = 2 - y
-            col_end = 5 - y
-            row_start = 3 - x
-            row_end = 7 - x
-            trimmed = [row[row_start:row_end] for row in mask[col_start:col_end]]
-            masks.append(trimmed)
-        for button in self._timed_key_history[1]:
-            # second history state
-            mask = [
-                [0, 0, 0, 1, 0, 0, 0],
-                [0, 0, 1, 0, 1, 0, 0],
-                [0, 1, 0, 0, 0, 1, 0],
-                [0, 0, 1, 0, 1, 0, 0],
-                [0, 0, 0, 1, 0, 0, 0],
-            ]
-            y, x = divmod(button, 4)
-            col_start = 2 - y
-            col_end = 5 - y
-            row_start = 3 - x
-            row_end = 7 - x
-            trimmed = [row[row_start:row_end] for row in mask[col_start:col_end]]
-            masks.append(trimmed)
-        for button in self._timed_key_history[2]:
-            # third history state
-            mask = [
-                [0, 0, 1, 0, 1, 0, 0],
-                [0, 1, 0, 0, 0, 1, 0],
-                [1, 0, 0, 0, 0, 0, 1],
-                [0, 1, 0, 0, 0, 1, 0],
-                [0, 0, 1, 0, 1, 0, 0],
-            ]
-            y, x = divmod(button, 4)
-            col_start = 2 - y
-            col_end = 5 - y
-            row_start = 3 - x
-            row_end = 7 - x
-            trimmed = [row[row_start:row_end] for row in mask[col_start:col_end]]
-            masks.append(trimmed)
-        for button in self._timed_key_history[3]:
-            # fourth history state
-            mask = [
-                [0, 1, 0, 0, 0, 1, 0],
-                [1, 0, 0, 0, 0, 0, 1],
-                [0, 0, 0, 0, 0, 0, 0],
-                [1, 0, 0, 0, 0, 0, 1],
-                [0, 1, 0, 0, 0, 1, 0],
-            ]
-            y, x = divmod(button, 4)
-            col_start = 2 - y
-            col_end = 5 - y
-            row_start = 3 - x
-            row_end = 7 - x
-            trimmed = [row[row_start:row_end] for row in mask[col_start:col_end]]
-            masks.append(trimmed)
-        # Sum each pixel position. Ripple intersections could be made brighter
-        # in _do_active_passive_frame_sync because we're handing back sums instead of just
+        # Sum each pixel position. _animate_frame makes ripple intersections
+        # stronger, because we're handing back sums instead of just
         # true/false values.
-        summed_mask = []
-        for row in zip(*masks):
-            # note that zip(*[]) is the inverse of zip([])
-            columns = zip(*row)
-            summed_row = list(map(sum, columns))
-            summed_mask.append(summed_row)
-        # return a flat list
-        if not summed_mask:
-            # if all history states are empty, no masks will have been created
-            return [0] * 4 * 3
-        return summed_mask[0] + summed_mask[1] + summed_mask[2]
+        summed = self._ripple_frame
+        for idx in range(12):
+            summed[idx] = 0
+        sprites = self._ripple_sprites
+        history = self._timed_key_history
+        for stage in range(len(history)):
+            # each history state is a bitmask of the keys pressed during it
+            buttons = history[stage]
+            # 12 sprites of 12 cells per state
+            start = stage * 144
+            while buttons:
+                if buttons & 1:
+                    for idx in range(12):
+                        summed[idx] += sprites[start + idx]
+                buttons >>= 1
+                start += 12
+        return summed
 
     """
     MACRO BUTTONS AND GESTURES
     """
     # BUTTONS
-    def _handle_button_events_sync(self):
+    def _handle_button_event(self):
         """
-        Sends vm toggle commands on button presses and releases unless a rocker gesture was
-        performed.
+        Looks the key up in the active layer and does its action. MOMENTARY
+        keys send vm toggle commands on button presses and releases unless a
+        rocker gesture was performed. Returns the event, or None if the queue
+        was empty.
+
+        The action only needs the tables and the gesture engine, so its report
+        goes out before anything else is done with the event: ripples, history
+        and the input trace all wait until the host has it.
+
+        Events are read into one reusable keypad.Event, so a steady stream of
+        key presses doesn't allocate anything. The returned event is
+        overwritten by the next call.
         """
-        event = self._update_event_history()
-        if not event:
-            return
-        if self._recognize_rocker():
+        event = self._event
+        if not keys.events.get_into(event):
             return
-        elif self._recognize_toggle():
+        key_number = event.key_number
+        if event.pressed:
+            slot = self._layer_offset + key_number
+            self._held_slots[key_number] = slot
+        else:
+            slot = self._held_slots[key_number]
+        action = self._actions[slot]
+        if action == MOMENTARY:
+            # the gesture engine sees every event on these keys, along with
+            # its timestamp. See gestures.py.
+            self._gestures.advance(key_number, event.pressed, event.timestamp)
+            if self._recognize_toggle() and not self._recognize_rocker():
+                voicemeeter.toggle()
+        elif event.pressed:
+            self._press_action(action, self._action_args[slot])
+        self._update_event_history(event)
+        return event
+
+    def _press_action(self, action, argument):
+        if action == NOTHING:
+            # ripples, and nothing else
+            pass
+        elif action == LATCH:
             voicemeeter.toggle()
+        elif action == VOLUME:
+            voicemeeter.change_volume(argument)
+        elif action == CONSUMER:
+            voicemeeter.send(argument)
+        elif action == LAYER:
+            self.layer = argument
 
-    async def _handle_button_events(self):
+    @property
+    def layer(self):
+        return self._layer_offset // 12
+
+    @layer.setter
+    def layer(self, value):
+        # the tables were built for every layer at boot, this only moves the
+        # offset into them
+        if not 0 <= value < len(self.LAYERS):
+            raise ValueError(f"no layer {value}")
+        self._layer_offset = value * 12
+
+    def _drain_button_events(self):
         """
-        Sends vm toggle commands on button presses and releases unless a rocker gesture was
-        performed.
+        Handles every pending key event, so a burst of presses gets handled at
+        once instead of one per poll. This is the scheduler's fast lane.
         """
-        while True:
-            event = self._update_event_history()
-            if event:
-                if self._recognize_rocker():
-                    continue
-                elif self._recognize_toggle():
-                    voicemeeter.toggle()
-            await asyncio.sleep_ms(self.BUTTON_PERIOD)
+        while self._handle_button_event():
+            self._last_event_time = ticks_ms()
+            self.events += 1
+            if self.idle:
+                # the event's report is already out, waking can't delay it
+                idle_mode.wake()
+
+    def _handle_button_events(self):
+        """
+        Push-to-talk can't afford to clip the start of a sentence, so we poll
+        every few ms, on top of the fast lane. While keys are held (or were
+        just released, and might be part of a gesture), we poll even faster to
+        keep releases and rockers snappy. Returns the period until the next
+        poll (ms).
+        """
+        self._drain_button_events()
+        # (negative once the last event is days old and ticks have wrapped)
+        since_event = ticks_diff(ticks_ms(), self._last_event_time)
+        if self.pressed_mask or 0 <= since_event < self.BUTTON_ACTIVE_WINDOW:
+            return self.BUTTON_PERIOD_ACTIVE
+        return self.BUTTON_PERIOD
 
     # HISTORY
-    def _update_event_history(self):
-        """
-        Runs as often as possible to react to key events. We store information
-        from events in three places:
-
-        -- pressed_keys: this is a set of all currently pressed key numbers. We add to
-        the set when new keys are pressed, and remove when they're released.
-        Because this is a set (and not a list), it will only store unique
-        values. That shouldn't be important because keypad.Keys uses an event
-        queue, but I always treat state trackers with distrust.
-        -- gesture_history: this is how we remember what previous pressed_keys sets
-        looked like. We only need to remember a history long enough to look for
-        gestures. pop() and insert(0,) let this list act like a queue. We add to
-        the front and remove from the back, so that the first items are more
-        recent than the last ones.
-        -- _timed_key_history: this is just like gesture_history, but we don't
-        pop and insert items. Instead, we add key presses to the first history
-        list, and let _do_active_passive_frame_sync remove history states once per animation
-        cycle. If more than one key is pressed in a single animation cycle, the
-        key numbers will "pile up" and their ripples will all get animated at
-        the same time.
-        """
-        # get new event
-        event = keys.events.get()
-        if not event:
-            # nothing to update!
-            return
+    def _process_event(self, event):
+        # everything _handle_button_event does with a MOMENTARY key's event,
+        # minus the report
+        self._gestures.advance(event.key_number, event.pressed, event.timestamp)
+        self._update_event_history(event)
+
+    def _update_event_history(self, event):
+        """
+        Runs for every key event, once its mute report is out. Gestures are
+        the gesture engine's business (see gestures.py); here we store
+        information from events in two places:
+
+        -- pressed_mask: an int with one bit per key, set while the key is
+        held. Unlike a set, flipping a bit never allocates anything.
+        -- _timed_key_history: what the ripples are drawn from. It's a
+        RingBuffer of key masks, so pushing a new state overwrites the oldest
+        one in place, and index 0 is always the most recent. We don't push a
+        state on every event. Instead, we set key bits in the newest state,
+        and the "ripple" task (_advance_timed_key_history) pushes a fresh one
+        every ACTIVE_FRAME_PERIOD. If more than one key is pressed within one
+        of those, the bits will "pile up" and their ripples will all get
+        animated at the same time.
+        """
+        if TRACE_INPUT:
+            input_trace.key(event)
+        key_bit = 1 << event.key_number
         # update pressed keys
         if event.pressed:
-            self.pressed_keys.add(event.key_number)
-            self._timed_key_history[0].append(event.key_number)
+            self.pressed_mask |= key_bit
+            self._timed_key_history[0] = self._timed_key_history[0] | key_bit
         else:
-            self.pressed_keys.discard(event.key_number)
-        # update key history
-        self.gesture_history.pop()
-        self.gesture_history.insert(0, frozenset(self.pressed_keys))
-        return event
+            self.pressed_mask &= ~key_bit
 
     # GESTURES
     def _recognize_rocker(self):
         """
         A rocking gesture, where one key is pressed, then a second, then they
-        are released in the same order.
-
-        This logic is super dense, but it's surprising how much work we can do
-        in so few lines of code. First, we check the length of each gesture_history
-        state. If we don't see the right pattern, we don't need to do any more
-        work: it's not a rocking gesture. Maybe it was a single key
-        press-release, maybe it was a bunch of keys mashed at once. After that,
-        we can check the numbers of each key to confirm that it's a rocker
-        gesture. Because gesture_history is a list of sets, we can use the < and >
-        operators to check that they are proper subsets and supersets of each
-        other. mid_state must contain all of the keys (ie the one key) in both
-        new_state and old_state. Because we're using the proper superset/subset
-        operators instead of <= and >=, we also know that the button in
-        new_state is not in old_state. To be honest, I'm pretty sure you could
-        use only one of these (history length vs super/subset checks) and it
-        would still work just fine.
-
-        This is the only implemented gesture. I've included three other methods
-        that I thought would be helpful when I started coding, but turned out
-        not to have any use for my project. Maybe they would make displaying
-        information on the display easier? Maybe you could beep when a gesture
-        has ended?
-        """
-        if not tuple(map(lambda s: len(s), self.gesture_history)) == (0, 1, 2, 1, 0):
-            return
-        _, new_state, mid_state, old_state, _ = self.gesture_history
-        if new_state < mid_state > old_state:
-            return True
+        are released, in either order.
+
+        The gesture engine already did the work when the event came in, we
+        just need to ask it what it saw. Gestures are rows in the GESTURES
+        table, so there's no need to hand-write another one of these to
+        recognize something new. Maybe a double tap could show the menu? Maybe
+        you could beep when a gesture has ended?
+        """
+        recognized = self._gestures.recognized
+        return recognized == self._rocker or recognized == self._reverse_rocker
 
     def _gesture_ended(self):
-        # history states only ever change by one key
-        return bool(
-            len(self.gesture_history[0]) == 0 and len(self.gesture_history[1]) == 1
-        )
+        return self._gestures.ended
 
     def _gesture_started(self):
-        return bool(
-            len(self.gesture_history[0]) == 1 and len(self.gesture_history[1]) == 0
-        )
+        return self._gestures.started
 
     def _recognize_toggle(self):
         # returns true if a solo or multi-button press has begun or ended
-        last_two_historical_lengths = tuple(
-            map(lambda s: len(s), self.gesture_history[0:2])
-        )
-        # recognize start of toggle
-        if last_two_historical_lengths == (1, 0):
-            return True
-        # recognize end of toggle
-        if last_two_historical_lengths == (0, 1):
-            return True
-        # else additional keys were pressed
+        return self._gestures.started or self._gestures.ended
 
 
 macro_keys = MacroKeys()
+macro_keys._do_passive_frame()
+mark_boot("first LED frame")
+
+"""
+CLOCK
+"""
+from adafruit_display_text import label
+import adafruit_ds3231
+from screen import Screen
+from terminalio import FONT
+from wallclock import WallClock
+
+rtc = adafruit_ds3231.DS3231(board.I2C())
+# Reads rtc every WallClock.RESYNC_PERIOD, and counts ticks in between. Tell
+# the time with wall_clock, not rtc: that's an I2C read every time.
+wall_clock = WallClock(rtc)
+
+
+class GraphicalUserInterface:
+    __slots__ = (
+        "_selected",
+        "_hour_offset",
+        "d",
+        "screen",
+        "l",
+        "_shown_time",
+        "m",
+        "_highlighted",
+        "debug",
+    )
+
+    WHITE = (255, 255, 255)
+    BLACK = (0, 0, 0)
+    # Send pending label changes to the display (ms). Changes in between are
+    # batched into one refresh.
+    REFRESH_PERIOD = 50
+
+    def __init__(self):
+        # fetch values from NVM
+        mem_selected, mem_hour = fetch_nvm_sel_hour()
+        self._selected = mem_selected % 3
+        self._hour_offset = mem_hour
+
+        # display init
+        self.d = board.DISPLAY
+        self.d.rotation = 90
+        self.screen = Screen(self.d)
+
+        # create clock label
+        self.l = label.Label(FONT, text="20\n15", scale=4)
+        self.l.x = 10
+        self.l.y = 25
+        # minutes since midnight currently on the label
+        self._shown_time = -1
+        # update and show
+        self._update_clock_label()
+        self.show_clock()
+        self.screen.refresh()
+
+        # menu, built the first time it's shown
+        self.m = None
+        # index of the highlighted menu line
+        self._highlighted = None
+        # debug page, built the first time it's shown (PROFILE only)
+        self.debug = None
+
+    # NVM-stored properties
+    @property
+    def selected(self):
+        return self._selected
+
+    @selected.setter
+    def selected(self, value):
+        value %= 3
+        self._selected = value
+        self._update_selection()
+        set_nvm_selected(value)
+
+    @property
+    def hour_offset(self):
+        return self._hour_offset
+
+    @hour_offset.setter
+    def hour_offset(self, value):
+        value = min(4, max(value, -4))
+        self._hour_offset = value
+        self._update_clock_label()
+        set_nvm_hour(value)
+
+    # SCHEDULED TASKS
+    def register(self, tasks):
+        # the label is already up to date, so the first update can wait
+        tasks.add("clock", self._tick_clock, 60_000, scheduler.CLOCK, delay=1000)
+        tasks.add("display", self._refresh, self.REFRESH_PERIOD, scheduler.CLOCK)
+        # the first resync finds where in its second the boot read was taken
+        tasks.add(
+            "rtc",
+            wall_clock.resync,
+            wall_clock.RESYNC_PERIOD,
+            scheduler.CLOCK,
+            delay=5000,
+        )
+
+    def _refresh(self):
+        # Like an NVM write, a full refresh blocks for tens of ms, so it waits
+        # for held keys to be released (and their mute report to go out).
+        if macro_keys.pressed_mask:
+            return
+        self.screen.refresh()
+
+    def _tick_clock(self):
+        self._update_clock_label()
+        # Do subsequent updates at the top of the minute
+        return wall_clock.ms_to_next_minute()
+
+    # CLOCK
+    def show_clock(self):
+        self.screen.show(self.l)
+
+    def _update_clock_label(self):
+        """
+        Only builds a new string when the minute (or the hour offset) changed.
+        Most calls end after the comparison, and none of them touch I2C.
+        """
+        minutes = wall_clock.seconds_today() // 60
+        hour = (minutes // 60 + self.hour_offset) % 24
+        minute = minutes % 60
+        shown_time = hour * 60 + minute
+        if shown_time == self._shown_time:
+            return
+        self._shown_time = shown_time
+        self.screen.set_text(self.l, f"{hour:0>2}\n{minute:0>2}")
+
+    # MENU
+    def show_menu(self):
+        if not self.m:
+            self._build_menu()
+        self._update_selection()
+        self.screen.show(self.m.text_group)
+
+    def showing_menu(self):
+        return self.m is not None and self.screen.root is self.m.text_group
+
+    def _build_menu(self):
+        # loaded on first use, it isn't needed for the clock
+        from adafruit_simple_text_display import SimpleTextDisplay as SimTex
+
+        self.m = SimTex(colors=[self.WHITE])
+        self.m[0].text = "  ENCODER  "
+        self.m[1].text = "  FUNCTION "
+        self.m[2].text = "~~~~~~~~~~~"
+        self.m[3].text = "Brightness "
+        self.m[4].text = "Volume     "
+        self.m[5].text = "Hour offset"
+
+    def _update_selection(self):
+        """
+        Moves the highlight. Only the line losing it and the line gaining it
+        change, so only those two get redrawn.
+        """
+        if not self.m:
+            # nothing to do until the menu is first shown
+            return
+        idx = self.selected + 3
+        if idx == self._highlighted:
+            return
+        if self._highlighted is not None:
+            old = self.m[self._highlighted]
+            self.screen.set_colors(old, self.WHITE, self.BLACK)
+        self.screen.set_colors(self.m[idx], self.BLACK, self.WHITE)
+        self._highlighted = idx
+
+    # DEBUG PAGE
+    def show_debug(self, lines):
+        if not self.debug:
+            from adafruit_simple_text_display import SimpleTextDisplay as SimTex
+
+            self.debug = SimTex(colors=[self.WHITE])
+        self.update_debug(lines)
+        self.screen.show(self.debug.text_group)
+
+    def showing_debug(self):
+        return self.debug is not None and self.screen.root is self.debug.text_group
+
+    def update_debug(self, lines):
+        for idx in range(len(lines)):
+            self.screen.set_text(self.debug[idx], lines[idx])
+
+
+gui = GraphicalUserInterface()
+mark_boot("first clock draw")
+
+# Now that everything urgent is up, check whether settings.json changed since
+# it was cached. If it did, it's parsed and cached (the NVM write erases a
+# flash sector), and code.py starts over with the new values.
+if settings.sync(microcontroller.nvm):
+    print("settings.json changed, reloading")
+    import supervisor
+
+    supervisor.reload()
+mark_boot("settings.json checked")
+
+"""
+IDLE
+"""
+
+
+class IdleMode:
+    """
+    Nobody needs a smooth rainbow at 3 am. After TIMEOUT ms without a key
+    event, a held key or an encoder move, the pad goes idle: frames slow down
+    to FRAME_PERIOD, ripples stop advancing (there's nothing to ripple), the
+    encoder is sampled every ENCODER_PERIOD, and the LEDs dim (see
+    MacroKeys.go_idle). The keys are polled exactly as often as ever.
+
+    The next key event wakes it up, but only after that event's report went
+    out, same as always. Waking only flips flags and moves deadlines: the next
+    frame is drawn at full brightness straight away, from tables that never
+    went anywhere.
+
+    The scheduler adds up the time it sleeps between tasks. Time spent in a
+    state minus time asleep is time spent running tasks, so report() can say
+    how busy the CPU was in each.
+    """
+
+    __slots__ = (
+        "idle",
+        "entered",
+        "elapsed",
+        "busy",
+        "_tasks",
+        "_frame_task",
+        "_ripple_task",
+        "_encoder_task",
+        "_events",
+        "_touched_at",
+        "_since",
+        "_slept_since",
+    )
+
+    # Go idle after this long untouched (ms). 0 never goes idle.
+    TIMEOUT = settings.get("idle_timeout", 300) * 1000
+    # Check whether it's time to (ms)
+    CHECK_PERIOD = 1000
+    # Draw frames this often while idle (ms)
+    FRAME_PERIOD = 250
+    # Sample the encoder this often while idle (ms). Any move wakes it.
+    ENCODER_PERIOD = 50
+    # Ripples don't advance while idle. This is as good as never (ms).
+    RIPPLE_PERIOD = 60_000
+
+    def __init__(self):
+        self.idle = False
+        # times the pad went idle
+        self.entered = 0
+        # ms spent in each state, and ms of that running tasks: [active, idle]
+        self.elapsed = [0, 0]
+        self.busy = [0, 0]
+        self._tasks = None
+        self._frame_task = None
+        self._ripple_task = None
+        self._encoder_task = None
+        self._events = 0
+        self._touched_at = ticks_ms()
+        self._since = ticks_ms()
+        self._slept_since = 0
+
+    def register(self, tasks):
+        self._tasks = tasks
+        self._frame_task = tasks.find("frame")
+        self._ripple_task = tasks.find("ripple")
+        self._encoder_task = tasks.find("encoder")
+        self._events = macro_keys.events
+        self._slept_since = tasks.slept
+        if self.TIMEOUT:
+            tasks.add("idle", self._check, self.CHECK_PERIOD, scheduler.CLOCK)
+
+    def touch(self):
+        """
+        For input that isn't a key event: the encoder.
+        """
+        self._touched_at = ticks_ms()
+        if self.idle:
+            self.wake()
+
+    def _check(self):
+        if self.idle:
+            return
+        now = ticks_ms()
+        if macro_keys.events != self._events or macro_keys.pressed_mask:
+            # PTT counts as use, however long the key is held
+            self._events = macro_keys.events
+            self._touched_at = now
+        elif ticks_diff(now, self._touched_at) >= self.TIMEOUT:
+            self._sleep()
+
+    def _sleep(self):
+        self._account()
+        self.idle = True
+        self.entered += 1
+        macro_keys.go_idle()
+        tasks = self._tasks
+        tasks.reschedule(self._frame_task, self.FRAME_PERIOD)
+        tasks.reschedule(self._ripple_task, self.RIPPLE_PERIOD, self.RIPPLE_PERIOD)
+        tasks.reschedule(self._encoder_task, self.ENCODER_PERIOD)
+
+    def wake(self):
+        self._account()
+        self.idle = False
+        macro_keys.idle = False
+        self._touched_at = ticks_ms()
+        tasks = self._tasks
+        tasks.reschedule(self._frame_task, macro_keys.PASSIVE_FRAME_PERIOD)
+        tasks.reschedule(self._ripple_task, macro_keys.ACTIVE_FRAME_PERIOD)
+        tasks.reschedule(self._encoder_task, macro_encoder.ENCODER_PERIOD)
+
+    # DUTY CYCLE
+    def _account(self):
+        """
+        Adds the time since the last call to the current state.
+        """
+        now = ticks_ms()
+        slept = self._tasks.slept
+        elapsed = ticks_diff(now, self._since)
+        asleep = ticks_diff(slept, self._slept_since)
+        state = 1 if self.idle else 0
+        self.elapsed[state] += elapsed
+        # a sleep is counted when it starts, so this can dip below 0
+        self.busy[state] += max(0, elapsed - asleep)
+        self._since = now
+        self._slept_since = slept
+
+    def duty_cycle(self, idle):
+        """
+        Share of the time in a state spent running tasks (%).
+        """
+        self._account()
+        state = 1 if idle else 0
+        if not self.elapsed[state]:
+            return 0.0
+        return 100 * self.busy[state] / self.elapsed[state]
+
+    def report(self):
+        print(
+            f"      idle: {self.duty_cycle(False):.1f}% busy active "
+            f"({self.elapsed[0] // 1000} s), {self.duty_cycle(True):.1f}% busy "
+            f"idle ({self.elapsed[1] // 1000} s), idle {self.entered} times"
+        )
+
+
+"""
+ALLOCATION AUDIT
+"""
+
+
+def audit_allocations(iterations=100):
+    """
+    The event and frame loops run forever, so anything they allocate turns
+    into GC pauses in the middle of an animation. This runs both on canned
+    events and prints how many bytes each one allocated. Both should print 0.
+    """
+    events = [
+        keypad.Event(key_number, pressed, 0)
+        for key_number, pressed in ((5, True), (6, True), (5, False), (6, False))
+    ]
+
+    def event_loop(iterations):
+        for _ in range(iterations):
+            for event in events:
+                macro_keys._process_event(event)
+                macro_keys._recognize_rocker()
+                macro_keys._recognize_toggle()
+
+    def frame_loop(iterations):
+        for _ in range(iterations):
+            macro_keys._advance_timed_key_history()
+            macro_keys._animate_frame()
+
+    # one pass of each first, so one-off setup doesn't count
+    event_loop(1)
+    frame_loop(1)
+
+    gc.collect()
+    start = gc.mem_alloc()
+    event_loop(iterations)
+    event_bytes = gc.mem_alloc() - start
+
+    gc.collect()
+    start = gc.mem_alloc()
+    frame_loop(iterations)
+    frame_bytes = gc.mem_alloc() - start
+
+    print(f"allocated: {event_bytes} B in event loop, {frame_bytes} B in frame loop")
+    return event_bytes, frame_bytes
+
+
+"""
+TELEMETRY
+"""
+if TELEMETRY:
+    import struct
+    import telemetry
+    import usb_cdc
+
+    class TelemetryLink:
+        """
+        Answers commands from host/monitor.py and sends it telemetry every
+        `period` ms. See telemetry.py for the frames.
+        """
+
+        # Check for commands (ms)
+        POLL_PERIOD = 50
+        # Default time between telemetry frames (ms). SET_PERIOD changes it, 0
+        # stops them.
+        PERIOD = 1000
+
+        def __init__(self, serial):
+            self.channel = telemetry.Channel(serial)
+            self.period = self.PERIOD
+            self._sent_at = ticks_ms()
+            # filled in and packed every period, instead of a new tuple
+            fields = len(telemetry.TELEMETRY_FIELDS)
+            self._values = [0] * (fields + telemetry.HISTOGRAM_BUCKETS)
+            self._frame_task = None
+
+        def register(self, tasks):
+            self._frame_task = tasks.find("frame")
+            tasks.add("telemetry", self._poll, self.POLL_PERIOD, scheduler.CLOCK)
+
+        def _poll(self):
+            for kind, payload in self.channel.commands():
+                self._handle(kind, payload)
+            now = ticks_ms()
+            if self.period and ticks_diff(now, self._sent_at) >= self.period:
+                self._sent_at = now
+                self._send_telemetry()
+
+        def _handle(self, kind, payload):
+            if kind == telemetry.REQUEST_STATE:
+                self.channel.send(telemetry.STATE, self._state())
+                return
+            if kind == telemetry.SET_BRIGHTNESS:
+                fmt = telemetry.SET_BRIGHTNESS_FORMAT
+            elif kind == telemetry.SET_PERIOD:
+                fmt = telemetry.SET_PERIOD_FORMAT
+            else:
+                self.channel.ack(kind, telemetry.UNKNOWN_COMMAND)
+                return
+            if len(payload) != struct.calcsize(fmt):
+                self.channel.ack(kind, telemetry.BAD_ARGUMENT)
+                return
+            (value,) = struct.unpack(fmt, payload)
+            if kind == telemetry.SET_BRIGHTNESS:
+                if value > macro_keys.BRIGHTNESS_LEVELS:
+                    self.channel.ack(kind, telemetry.BAD_ARGUMENT)
+                    return
+                macro_keys.brightness = value
+            else:
+                self.period = value
+            self.channel.ack(kind)
+
+        def _send_telemetry(self):
+            hid_queue = voicemeeter.hid_queue
+            frame_task = self._frame_task
+            values = self._values
+            values[0] = ticks_ms()
+            values[1] = voicemeeter.muted
+            values[2] = macro_keys.brightness
+            values[3] = macro_keys.events & 0xFFFFFFFF
+            values[4] = (hid_queue.sent + hid_queue.priority_sent) & 0xFFFFFFFF
+            values[5] = voicemeeter.suppressed & 0xFFFFFFFF
+            values[6] = voicemeeter.reasserted & 0xFFFFFFFF
+            values[7] = frame_task.runs & 0xFFFFFFFF
+            values[8] = frame_task.overruns & 0xFFFFFFFF
+            values[9] = min(frame_task.max_late, 0xFFFF)
+            values[10] = gc.mem_free()
+            if PROFILE:
+                histogram = tasks.run_times["frame"]
+                for idx in range(telemetry.HISTOGRAM_BUCKETS):
+                    values[11 + idx] = histogram[idx]
+            self.channel.send_telemetry(values)
+
+        def _state(self):
+            """
+            Only sent when asked for, so it's fine for this to allocate.
+            """
+            payload = struct.pack(
+                telemetry.STATE_FORMAT,
+                voicemeeter.muted,
+                macro_keys.brightness,
+                gui.selected,
+                gui.hour_offset,
+                nvm_store.version,
+                self.period,
+                gc.mem_free(),
+            )
+            for task in tasks.tasks:
+                name = task.name.encode()
+                record = struct.pack(
+                    telemetry.TASK_FORMAT,
+                    task.runs & 0xFFFFFFFF,
+                    task.overruns & 0xFFFFFFFF,
+                    min(task.max_late, 0xFFFF),
+                    task.priority,
+                    len(name),
+                )
+                if len(payload) + len(record) + len(name) > telemetry.MAX_PAYLOAD:
+                    break
+                payload += record + name
+            return payload
 
 
 """
@@ -805,16 +1727,56 @@ while keys.events.get():
     pass
 
 
-if __name__ == "__main__" and USE_ASYNC:
-    print("starting in async mode")
-    coro = []
-    coro.extend(macro_keys.get_coroutines())
-    coro.append(gui.tick())
-    coro.append(macro_encoder.tick())
-    gathered = asyncio.gather(*coro)
-    asyncio.run(gathered)
-elif __name__ == "__main__":
-    print("starting in sync mode")
-    while True:
-        macro_keys.tick_sync()
-        gui.tick_sync()
+# One scheduler runs everything, whichever loop drives it. See scheduler.py.
+if PROFILE:
+    from profiler import HealthMonitor, ProfiledScheduler
+
+    tasks = ProfiledScheduler()
+else:
+    tasks = scheduler.Scheduler()
+macro_keys.register(tasks)
+voicemeeter.register(tasks)
+macro_encoder.register(tasks)
+gui.register(tasks)
+tasks.add("nvm", flush_nvm, NVM_FLUSH_PERIOD, scheduler.CLOCK)
+# after the tasks it slows down
+idle_mode = IdleMode()
+idle_mode.register(tasks)
+
+if PROFILE:
+    # Loop health goes to the console every HealthMonitor.CONSOLE_EVERY
+    # samples, and to the debug page (click past the menu) while it's shown.
+    # For the largest free block too, run health.report(largest_block=True)
+    # from the REPL.
+    health = HealthMonitor(tasks, voicemeeter, pixel_buf, idle_mode, gui.screen)
+
+    def sample_health():
+        health.sample()
+        if gui.showing_debug():
+            gui.update_debug(health.lines())
+
+    tasks.add("health", sample_health, health.SAMPLE_PERIOD, scheduler.CLOCK)
+
+# The data port is only there if boot.py enabled it
+if TELEMETRY and usb_cdc.data:
+    telemetry_link = TelemetryLink(usb_cdc.data)
+    telemetry_link.register(tasks)
+
+
+def main():
+    if AUDIT_ALLOCATIONS:
+        audit_allocations()
+
+    report_boot()
+    if USE_ASYNC:
+        print("starting in async mode")
+        import asyncio
+
+        asyncio.run(tasks.run_async(asyncio.sleep_ms))
+    else:
+        print("starting in sync mode")
+        tasks.run_sync(sleep)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+# autocopy
+
+"""
+FRAMEBUFFER
+
+The LEDs' end of the frame loop. A frame is composed straight into `buffer`,
+as the bytes that go down the wire: PIXEL_BYTES per pixel, in the strip's
+byte order (R, G and B are the offsets of each channel in a pixel), pixels in
+strip order. show() then sends the whole frame with one neopixel_write, and
+only if it differs from the last frame sent.
+
+There are two buffers, and show() swaps them instead of copying, so `buffer`
+is a different bytearray after every frame that was sent. Read it again for
+every frame, and write every byte of it: it holds an older frame.
+"""
+
+from digitalio import DigitalInOut, Direction
+from micropython import const
+from neopixel_write import neopixel_write
+
+PIXEL_BYTES = const(3)
+# Channel offsets in a pixel, for the Macropad's GRB pixels
+R = const(1)
+G = const(0)
+B = const(2)
+
+
+class FrameBuffer:
+    def __init__(self, pin, n):
+        self.n = n
+        self._pin = DigitalInOut(pin)
+        self._pin.direction = Direction.OUTPUT
+        self.buffer = bytearray(n * PIXEL_BYTES)
+        self._sent = bytearray(n * PIXEL_BYTES)
+
+        # counters
+        self.sent = 0
+        self.skipped = 0
+
+        # start from a known, dark, strip
+        neopixel_write(self._pin, self._sent)
+
+    def show(self):
+        """
+        Sends the frame in `buffer` if it changed. Returns whether it did.
+        """
+        buffer = self.buffer
+        if buffer == self._sent:
+            self.skipped += 1
+            return False
+        neopixel_write(self._pin, buffer)
+        self.buffer = self._sent
+        self._sent = buffer
+        self.sent += 1
+        return True
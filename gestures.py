@@ -0,0 +1,192 @@
+# autocopy
+
+"""
+GESTURES
+
+A gesture is a short sequence of key presses and releases, like the rocker:
+press one key, press a second, release the first, release the second. Gestures
+are described in a table (see MacroKeys.GESTURES) and compiled at boot into a
+tree of states. Each keypad event then costs one list lookup per gesture in
+progress, however many gestures the table holds.
+
+Every step in the table names three things:
+
+-- the kind of event: PRESS or RELEASE.
+-- the key's role. The key that starts the gesture is role 0, the next
+different key to be pressed is role 1. Any third key ends the attempt.
+-- how long since the gesture's previous event: QUICK, NORMAL, SLOW, or a
+combination like ANY. Timing comes from the keypad event timestamps, so a busy
+loop doesn't turn a quick double tap into a slow one.
+
+Gestures always start with the first key going down while no others are held.
+"""
+
+from micropython import const
+
+# keypad timestamps come from supervisor.ticks_ms(), which wraps
+from ticks import ticks_diff
+
+PRESS = const(0)
+RELEASE = const(1)
+
+# Timing classes. Combine them with |.
+QUICK = const(0b001)
+NORMAL = const(0b010)
+SLOW = const(0b100)
+ANY = const(QUICK | NORMAL | SLOW)
+
+_ROLES = const(2)
+_TIMINGS = const(3)
+_TOKENS = const(2 * _ROLES * _TIMINGS)
+
+
+class _State:
+    __slots__ = ("gesture", "next")
+
+    def __init__(self):
+        # index of the gesture that ends here, if any
+        self.gesture = None
+        # next state, indexed by event token
+        self.next = [None] * _TOKENS
+
+
+class GestureEngine:
+    # Gaps shorter than this are QUICK (ms)
+    QUICK_MS = 250
+    # Gaps at least this long are SLOW (ms). Anything between is NORMAL.
+    SLOW_MS = 600
+
+    def __init__(self, table):
+        self.names = tuple(name for name, _ in table)
+        self._root = _State()
+        # Gestures can overlap: the second press of a double tap might also be
+        # the first press of a rocker. One attempt (a cursor) starts on every
+        # first press, and we need as many as the most first presses a single
+        # gesture contains.
+        cursors = 1
+        for gesture, (name, steps) in enumerate(table):
+            self._add(gesture, name, steps)
+            cursors = max(cursors, self._count_first_presses(steps))
+
+        self._states = [None] * cursors
+        self._role_keys = [-1] * (cursors * _ROLES)
+        self._times = [0] * cursors
+        self._next_cursor = 0
+        self._last_time = 0
+
+        self.pressed_count = 0
+        # set by advance()
+        self.recognized = None
+        self.started = False
+        self.ended = False
+
+    def index(self, name):
+        return self.names.index(name)
+
+    # COMPILING
+    def _add(self, gesture, name, steps):
+        frontier = [self._root]
+        for kind, role, timing in steps:
+            if kind not in (PRESS, RELEASE) or role not in (0, 1):
+                raise ValueError(f"bad step in gesture {name}")
+            if not 0 < timing <= ANY:
+                raise ValueError(f"bad timing in gesture {name}")
+            children = []
+            for timing_idx in range(_TIMINGS):
+                if not timing & (1 << timing_idx):
+                    continue
+                token = self._token(kind, role, timing_idx)
+                for state in frontier:
+                    child = state.next[token]
+                    if child is None:
+                        child = state.next[token] = _State()
+                    children.append(child)
+            frontier = children
+        for state in frontier:
+            if state.gesture not in (None, gesture):
+                clash = self.names[state.gesture]
+                raise ValueError(f"gestures {clash} and {name} are identical")
+            state.gesture = gesture
+
+    def _count_first_presses(self, steps):
+        held = 0
+        first_presses = 0
+        for kind, _, _ in steps:
+            if kind == PRESS:
+                if not held:
+                    first_presses += 1
+                held += 1
+            else:
+                held -= 1
+        return first_presses
+
+    @staticmethod
+    def _token(kind, role, timing_idx):
+        return (kind * _ROLES + role) * _TIMINGS + timing_idx
+
+    def _timing_idx(self, gap):
+        if gap < self.QUICK_MS:
+            return 0
+        if gap < self.SLOW_MS:
+            return 1
+        return 2
+
+    # RECOGNIZING
+    def advance(self, key_number, pressed, timestamp):
+        """
+        Feed one keypad event. Afterwards, `recognized` is the index of the
+        gesture this event completed (or None), and `started`/`ended` tell
+        whether it was the first key down or the last key up.
+        """
+        self.recognized = None
+        if not pressed and not self.pressed_count:
+            # a release whose press we never saw, like a key held through
+            # boot: it ends nothing and can't be part of a gesture
+            self.started = self.ended = False
+            return
+        self.pressed_count += 1 if pressed else -1
+        self.started = pressed and self.pressed_count == 1
+        self.ended = not pressed and self.pressed_count == 0
+        kind = PRESS if pressed else RELEASE
+
+        # advance attempts in progress
+        role_keys = self._role_keys
+        for cursor in range(len(self._states)):
+            state = self._states[cursor]
+            if state is None:
+                continue
+            role_idx = cursor * _ROLES
+            if key_number == role_keys[role_idx]:
+                role = 0
+            elif key_number == role_keys[role_idx + 1]:
+                role = 1
+            elif pressed and role_keys[role_idx + 1] < 0:
+                role = 1
+            else:
+                self._states[cursor] = None
+                continue
+            gap = ticks_diff(timestamp, self._times[cursor])
+            state = state.next[self._token(kind, role, self._timing_idx(gap))]
+            self._states[cursor] = state
+            if state is None:
+                continue
+            role_keys[role_idx + role] = key_number
+            self._times[cursor] = timestamp
+            if self.recognized is None:
+                self.recognized = state.gesture
+
+        # the first key down starts a new attempt
+        if self.started:
+            cursor = self._next_cursor
+            self._next_cursor = (cursor + 1) % len(self._states)
+            gap = ticks_diff(timestamp, self._last_time)
+            token = self._token(PRESS, 0, self._timing_idx(gap))
+            state = self._root.next[token]
+            self._states[cursor] = state
+            role_keys[cursor * _ROLES] = key_number
+            role_keys[cursor * _ROLES + 1] = -1
+            self._times[cursor] = timestamp
+            if state is not None and self.recognized is None:
+                self.recognized = state.gesture
+
+        self._last_time = timestamp
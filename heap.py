@@ -0,0 +1,36 @@
+# autocopy
+
+"""
+HEAP
+
+gc.mem_free() says how much heap is left, not whether it's in one piece. After
+a while the heap is a patchwork, and an allocation can fail (or force a long
+collection) with plenty free in total. largest_free_block() finds the biggest
+allocation that would succeed right now, by trying them: a binary search of
+bytearray sizes, collecting after each one.
+
+That's a dozen collections, tens of ms on the Macropad, so it belongs in
+reports, never in the loop.
+"""
+
+import gc
+
+# Stop searching once the answer is this close (B)
+GRANULARITY = 256
+
+
+def largest_free_block():
+    gc.collect()
+    low = 0
+    high = gc.mem_free() + 1
+    while high - low > GRANULARITY:
+        size = (low + high) // 2
+        try:
+            block = bytearray(size)
+        except MemoryError:
+            high = size
+            continue
+        del block
+        gc.collect()
+        low = size
+    return low
@@ -0,0 +1,100 @@
+# autocopy
+
+"""
+HID QUEUE
+
+ConsumerControl.send() blocks until the host has polled both the press and the
+release report. Sending a burst of volume steps from inside the encoder task
+used to block every other task, key handling included, for the whole burst.
+
+HIDQueue keeps volume steps as a single signed count instead: turning the
+knob up three detents and back down two leaves one step to send, not five.
+pump() sends at most one step per REPORT_PERIOD, so the host (and Voicemeeter)
+never sees a flood. Mute and unmute don't wait in line at all.
+"""
+
+from ticks import ticks_add, ticks_diff, ticks_ms
+
+
+class HIDQueue:
+    # Minimum time between queued reports (ms)
+    REPORT_PERIOD = 20
+    # Most steps that can be waiting. Anything past this is dropped: nobody
+    # wants the volume to keep moving for seconds after they let go.
+    MAX_PENDING_STEPS = 25
+
+    def __init__(self, hid_device, increment, decrement):
+        self._hid_device = hid_device
+        self._increment = increment
+        self._decrement = decrement
+        self._steps = 0
+        self._last_sent = ticks_add(ticks_ms(), -self.REPORT_PERIOD)
+
+        # counters
+        self.sent = 0
+        self.priority_sent = 0
+        self.cancelled = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    @property
+    def depth(self):
+        """
+        Number of reports waiting to be sent.
+        """
+        return abs(self._steps)
+
+    def send_priority(self, code):
+        """
+        Sends right away, ahead of any queued steps and regardless of the rate
+        limit. Use it for reports that can't wait, like mute and unmute.
+        """
+        self._hid_device.send(code)
+        self._last_sent = ticks_ms()
+        self.priority_sent += 1
+
+    def add_steps(self, change):
+        """
+        Queues change steps: positive for increment, negative for decrement.
+        Steps in the opposite direction of what's waiting cancel out first.
+        """
+        steps = self._steps
+        if steps and (steps > 0) != (change > 0):
+            self.cancelled += min(abs(steps), abs(change))
+        steps += change
+
+        limit = self.MAX_PENDING_STEPS
+        if steps > limit:
+            self.dropped += steps - limit
+            steps = limit
+        elif steps < -limit:
+            self.dropped += -limit - steps
+            steps = -limit
+
+        self._steps = steps
+        self.max_depth = max(self.max_depth, abs(steps))
+
+    def clear(self):
+        self.dropped += abs(self._steps)
+        self._steps = 0
+
+    def pump(self):
+        """
+        Sends one queued step if the rate limit allows. Call it at least every
+        REPORT_PERIOD.
+        """
+        if not self._steps:
+            return False
+        now = ticks_ms()
+        # (negative once the last report is days old and ticks have wrapped)
+        if 0 <= ticks_diff(now, self._last_sent) < self.REPORT_PERIOD:
+            return False
+        if self._steps > 0:
+            self._hid_device.send(self._increment)
+            self._steps -= 1
+        else:
+            self._hid_device.send(self._decrement)
+            self._steps += 1
+        self._last_sent = now
+        self.sent += 1
+        return True
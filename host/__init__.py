@@ -0,0 +1,3 @@
+"""
+Host-side tools for developing code.py off the device.
+"""
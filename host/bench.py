@@ -0,0 +1,369 @@
+"""
+Microbenchmarks for the frame and event paths: code.py, loaded in the emulator,
+with each hot function timed on its own, in a loop, on the host.
+
+    python -m host.bench --save           # record baselines on this computer
+    python -m host.bench                  # compare with them
+    python -m host.bench --margin 0.5     # allow 50% slower before failing
+    python -m host.bench --only ripple    # just the benchmarks matching this
+
+Each benchmark reports the best time per call out of a few repeats, and the
+most heap a single call had in use at once (under tracemalloc, so temporaries
+count too, but objects CPython hands out from its free lists don't). Exits 1
+if a benchmark is slower than its baseline by more than --margin, or allocates
+more than ALLOCATION_SLACK over it.
+
+Allocations carry over from computer to computer, so their baselines are in
+the repo, in host/bench_baseline.json. CPython allocates every int past 256,
+where MicroPython doesn't allocate small ints at all, so a few dozen bytes is
+normal. The number to watch is whether it grows.
+
+Times don't carry over: host timings say nothing about the Macropad's, and
+only compare with ones recorded on the same computer and Python. So they're
+only checked once --save has put a time baseline in host/bench_times.json,
+which stays out of git, and only on the computer that saved it: run --save
+before changing anything. Pick a margin to suit the computer; a busy or
+virtual one can swing by half from run to run.
+"""
+
+import argparse
+import gc
+import itertools
+import json
+import pathlib
+import platform
+import sys
+import time
+import tracemalloc
+
+from host.emulator import Emulator
+
+BASELINE_PATH = pathlib.Path(__file__).with_name("bench_baseline.json")
+TIMES_PATH = pathlib.Path(__file__).with_name("bench_times.json")
+
+# Default slowdown allowed over the baseline, as a fraction
+MARGIN = 0.25
+# Each repeat runs for about this long (s), and the best one counts
+REPEAT_TIME = 0.005
+REPEATS = 10
+# Every benchmark is timed once a round, and its best round counts. A busy
+# moment on the host slows one round of one benchmark, not the whole result.
+ROUNDS = 3
+# Calls looked at for allocations
+ALLOCATION_CALLS = 20
+# Allocations can go up by this much before they count as a regression (B).
+# Where a counter happens to be decides whether CPython allocates an int for
+# it; any new container or buffer is bigger than this.
+ALLOCATION_SLACK = 32
+
+
+"""
+BENCHMARKS
+"""
+
+
+def _ripples(macro_keys, count):
+    # `count` ripples on keys 0 up, spread over every stage of the history
+    history = macro_keys._timed_key_history
+    history.clear()
+    for key_number in range(count):
+        stage = key_number % len(history)
+        history[stage] = history[stage] | 1 << key_number
+
+
+def _offsets(length):
+    # the start, the last offset before the palette wraps, halfway through the
+    # wrap, and the last offset
+    return (0, length - 12, length - 6, length - 1)
+
+
+def benchmarks(code):
+    """
+    (name, function) for every benchmark, set up and ready to call.
+    """
+    macro_keys = code.macro_keys
+    voicemeeter = code.voicemeeter
+    unmuted = voicemeeter.unmuted
+    windows = macro_keys._palete_windows[unmuted]
+    if windows is None:
+        windows = macro_keys._load_palete(unmuted)
+    length = len(windows)
+
+    for count in range(13):
+        yield f"ripple_frame {count:>2} ripples", _ripple_frame(macro_keys, count)
+
+    palete = macro_keys._paletes[unmuted]
+    colors = [palete[idx : idx + 3] for idx in range(0, len(palete), 3)]
+    for offset in _offsets(length):
+        yield f"color_base @{offset}", _color_base(macro_keys, colors, offset)
+
+    for offset in _offsets(length):
+        yield f"animate_frame @{offset}", _animate(macro_keys, offset, length, 0)
+    yield f"animate_frame @{length - 1} 12 ripples", _animate(
+        macro_keys, length - 1, length, 12
+    )
+
+    yield "event + rocker", _events(code)
+
+    for burst in (1, 5, 25):
+        yield f"change_volume burst {burst:>2}", _volume_burst(voicemeeter, burst)
+
+
+def _ripple_frame(macro_keys, count):
+    def run():
+        _ripples(macro_keys, count)
+        return macro_keys._get_press_ripple_frame
+
+    return run
+
+
+def _color_base(macro_keys, colors, offset):
+    def run():
+        get_color_base = macro_keys._get_color_base
+        return lambda: get_color_base(colors, offset)
+
+    return run
+
+
+def _animate(macro_keys, offset, length, ripples):
+    # Alternates between offset and the one after it, so every frame differs
+    # and goes out: the cost of a frame that moved, not of one that was
+    # skipped. The last offset alternates with the first, across the wrap.
+    def run():
+        _ripples(macro_keys, ripples)
+        macro_keys.idle = False
+        next_offset = itertools.cycle((offset, (offset + 1) % length)).__next__
+
+        def frame():
+            macro_keys._ani_offset = next_offset()
+            macro_keys._animate_frame()
+
+        return frame
+
+    return run
+
+
+def _events(code):
+    # A rocker on two MOMENTARY keys, over and over: what _handle_button_event
+    # does with every event past the report, one event per call
+    def run():
+        macro_keys = code.macro_keys
+        events = [
+            code.keypad.Event(key_number, pressed, 0)
+            for key_number, pressed in ((5, True), (6, True), (5, False), (6, False))
+        ]
+        next_event = itertools.cycle(events).__next__
+
+        def event():
+            macro_keys._process_event(next_event())
+            macro_keys._recognize_rocker()
+
+        return event
+
+    return run
+
+
+def _volume_burst(voicemeeter, burst):
+    # `burst` detents in a row, like a quick spin of the knob, then the queue
+    # is emptied for the next one
+    def run():
+        change_volume = voicemeeter.change_volume
+        hid_queue = voicemeeter.hid_queue
+
+        def spin():
+            for _ in range(burst):
+                change_volume(1)
+            hid_queue.clear()
+
+        return spin
+
+    return run
+
+
+"""
+MEASURING
+"""
+
+
+def calls_per_repeat(function):
+    calls = 1
+    while True:
+        start = time.perf_counter_ns()
+        for _ in range(calls):
+            function()
+        elapsed = time.perf_counter_ns() - start
+        if elapsed >= REPEAT_TIME * 1e9 / 10:
+            break
+        calls *= 2
+    return max(1, int(calls * REPEAT_TIME * 1e9 / elapsed))
+
+
+def time_per_call(function, calls):
+    """
+    Best time per call out of REPEATS runs (ns), with the GC off like timeit.
+    """
+    best = None
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(REPEATS):
+            start = time.perf_counter_ns()
+            for _ in range(calls):
+                function()
+            elapsed = time.perf_counter_ns() - start
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        if enabled:
+            gc.enable()
+    return best / calls
+
+
+def _peak_per_call(function):
+    tracemalloc.start()
+    try:
+        worst = 0
+        for _ in range(ALLOCATION_CALLS):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            function()
+            worst = max(worst, tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+    return worst
+
+
+def bytes_per_call(function):
+    """
+    The most a single call had allocated at once, over ALLOCATION_CALLS calls,
+    less what measuring a call that does nothing comes to.
+    """
+    return max(0, _peak_per_call(function) - _peak_per_call(_nothing))
+
+
+def _nothing():
+    pass
+
+
+def run_benchmarks(only=None):
+    """
+    Returns {name: {"ns": time per call, "bytes": allocated per call}}.
+    """
+    emu = Emulator()
+    code = emu.load()
+    selected = [
+        (name, setup) for name, setup in benchmarks(code) if not only or only in name
+    ]
+    results = {}
+    calls = {}
+    with emu._shadowing():
+        for _ in range(ROUNDS):
+            # the benchmarks share macro_keys, so each one is set up again
+            # before every round of it
+            for name, setup in selected:
+                function = setup()
+                # once first, so one-off setup doesn't count
+                function()
+                if name not in calls:
+                    calls[name] = calls_per_repeat(function)
+                    results[name] = {"ns": None, "bytes": bytes_per_call(function)}
+                ns = round(time_per_call(function, calls[name]))
+                best = results[name]["ns"]
+                results[name]["ns"] = ns if best is None else min(best, ns)
+    return results
+
+
+def machine():
+    # host timings only compare on the same computer and Python
+    return (
+        f"{platform.node()} {platform.machine()} "
+        f"{platform.python_implementation()} {platform.python_version()}"
+    )
+
+
+def load_json(path, default):
+    if not path.exists():
+        return default
+    return json.loads(path.read_text())
+
+
+def save_json(path, value):
+    path.write_text(json.dumps(value, indent=2, sort_keys=True) + "\n")
+
+
+def compare(results, allocations, times, margin):
+    """
+    Returns a line per benchmark and whether any of them regressed. Times are
+    only checked against ones saved on this machine.
+    """
+    same_machine = times["machine"] == machine()
+    lines = []
+    failed = False
+    for name, result in results.items():
+        line = f"{name:<36} {result['ns'] / 1000:9.2f} us {result['bytes']:6} B"
+        problems = []
+        base_ns = times["benchmarks"].get(name) if same_machine else None
+        if base_ns is not None:
+            ratio = result["ns"] / base_ns
+            line += f"   x{ratio:.2f}"
+            if ratio > 1 + margin:
+                problems.append("SLOWER")
+        base_bytes = allocations.get(name)
+        if base_bytes is None:
+            problems.append("(no baseline)")
+        elif result["bytes"] > base_bytes + ALLOCATION_SLACK:
+            problems.append(f"ALLOCATES (was {base_bytes} B)")
+            failed = True
+        failed = failed or "SLOWER" in problems
+        lines.append(f"{line} {' '.join(problems)}".rstrip())
+    if not same_machine:
+        lines.append("no times saved on this machine, only allocations checked")
+    return lines, failed
+
+
+"""
+COMMAND LINE
+"""
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--baseline", type=pathlib.Path, default=BASELINE_PATH)
+    parser.add_argument("--times", type=pathlib.Path, default=TIMES_PATH)
+    parser.add_argument(
+        "--margin",
+        type=float,
+        default=MARGIN,
+        help=f"slowdown allowed, as a fraction (default {MARGIN})",
+    )
+    parser.add_argument(
+        "--save", action="store_true", help="record new allocation and time baselines"
+    )
+    parser.add_argument("--only", default=None, metavar="TEXT")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.only)
+    allocations = load_json(args.baseline, {})
+    times = load_json(args.times, {"machine": None, "benchmarks": {}})
+    if args.save:
+        # --only updates the baselines it ran, and keeps the others
+        if not args.only:
+            allocations = {}
+        if not args.only or times["machine"] != machine():
+            times = {"machine": machine(), "benchmarks": {}}
+        for name, result in results.items():
+            allocations[name] = result["bytes"]
+            times["benchmarks"][name] = result["ns"]
+        save_json(args.baseline, allocations)
+        save_json(args.times, times)
+        print(f"saved {len(results)} baselines to {args.baseline} and {args.times}")
+        return 0
+
+    lines, failed = compare(results, allocations, times, args.margin)
+    print("\n".join(lines))
+    if failed:
+        print(f"regressed past the baseline (margin {args.margin:.0%})")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,400 @@
+"""
+Runs code.py on a Linux box against the fake hardware in host/hardware.py.
+
+The emulator loads code.py as a module (the `__main__` block stays asleep),
+then runs its main() on a virtual clock, asyncio loop or sync loop. Key
+presses, encoder turns and encoder clicks are scheduled on that clock, so they
+land at exact times no matter how fast the host is.
+
+    python -m host.emulator --seconds 5 --tap 0.5:3 --turn 2:-4
+    python -m host.emulator --sync --speed 1 --tap 1:0:0.3
+    python -m host.emulator --seconds 60 --profile
+    python -m host.emulator --trace --tap 0.5:3 > session.log
+    python -m host.emulator --cdc --seconds 600
+
+code.py's top-level settings (USE_ASYNC, REPL_MODE, ...) are overridden by
+rewriting their assignment lines before the module is compiled.
+
+--cdc connects the usb_cdc data port to a pty and prints its path, for
+host/monitor.py to open like a real Macropad. It runs in real time unless
+--speed says otherwise.
+"""
+
+import argparse
+import asyncio as _host_asyncio
+import calendar
+import cProfile
+import contextlib
+import gc as _host_gc
+import math
+import pstats
+import re
+import selectors
+import sys
+import time as _host_time
+import tracemalloc
+from pathlib import Path
+from types import ModuleType
+
+from host.hardware import EmulationStopped, Hardware, Reload, VirtualClock
+
+ROOT = Path(__file__).resolve().parent.parent
+CODE_PATH = ROOT / "code.py"
+
+
+"""
+ASYNCIO ON VIRTUAL TIME
+"""
+
+
+class VirtualTimeSelector:
+    """
+    The event loop blocks in select() until its next timer is due. Instead of
+    blocking, we move the virtual clock forward by the same amount.
+    """
+
+    def __init__(self, clock):
+        self._clock = clock
+        self._selector = selectors.DefaultSelector()
+
+    def select(self, timeout=None):
+        ready = self._selector.select(0)
+        if ready or timeout == 0:
+            return ready
+        if timeout is None:
+            raise RuntimeError("every task is waiting, but not on the clock")
+        now_ns = self._clock.monotonic_ns()
+        self._clock.advance_to_ns(now_ns + math.ceil(timeout * 1e9))
+        return self._selector.select(0)
+
+    def register(self, fileobj, events, data=None):
+        return self._selector.register(fileobj, events, data)
+
+    def unregister(self, fileobj):
+        return self._selector.unregister(fileobj)
+
+    def modify(self, fileobj, events, data=None):
+        return self._selector.modify(fileobj, events, data)
+
+    def get_key(self, fileobj):
+        return self._selector.get_key(fileobj)
+
+    def get_map(self):
+        return self._selector.get_map()
+
+    def close(self):
+        self._selector.close()
+
+
+class VirtualEventLoop(_host_asyncio.SelectorEventLoop):
+    def __init__(self, clock):
+        super().__init__(VirtualTimeSelector(clock))
+        self._virtual_clock = clock
+
+    def time(self):
+        return self._virtual_clock.monotonic()
+
+
+def circuitpython_asyncio(loop):
+    """
+    CircuitPython's asyncio is a uasyncio port: it has sleep_ms(), and
+    gather() is a coroutine that can be handed straight to run().
+    """
+    shim = ModuleType("asyncio")
+    for name in (
+        "CancelledError",
+        "Event",
+        "Lock",
+        "Task",
+        "TimeoutError",
+        "create_task",
+        "current_task",
+        "sleep",
+        "wait_for",
+    ):
+        setattr(shim, name, getattr(_host_asyncio, name))
+
+    async def sleep_ms(ms):
+        await _host_asyncio.sleep(ms / 1000)
+
+    async def gather(*aws, return_exceptions=False):
+        return await _host_asyncio.gather(*aws, return_exceptions=return_exceptions)
+
+    shim.sleep_ms = sleep_ms
+    shim.gather = gather
+    shim.run = loop.run_until_complete
+    shim.get_event_loop = lambda: loop
+    return shim
+
+
+def circuitpython_time(clock):
+    shim = ModuleType("time")
+    shim.monotonic = clock.monotonic
+    shim.monotonic_ns = clock.monotonic_ns
+    shim.sleep = clock.sleep
+    shim.struct_time = _host_time.struct_time
+    shim.localtime = _host_time.gmtime
+    # CircuitPython has no time zones: mktime is localtime's inverse
+    shim.mktime = calendar.timegm
+    shim.time = lambda: int(clock.monotonic())
+    return shim
+
+
+def circuitpython_gc():
+    """
+    MicroPython's gc can report heap use. The closest CPython gets is
+    tracemalloc, which only sees what's still alive when you ask: CPython frees
+    most garbage the moment it's dropped. Use these numbers to spot allocations
+    that stick around, and the device for the real count.
+    """
+    shim = ModuleType("gc")
+    heap_size = 192 * 1024
+
+    def mem_alloc():
+        if not tracemalloc.is_tracing():
+            return 0
+        _host_gc.collect()
+        return tracemalloc.get_traced_memory()[0]
+
+    shim.collect = _host_gc.collect
+    shim.enable = _host_gc.enable
+    shim.disable = _host_gc.disable
+    shim.isenabled = _host_gc.isenabled
+    shim.mem_alloc = mem_alloc
+    shim.mem_free = lambda: heap_size - mem_alloc()
+    return shim
+
+
+"""
+EMULATOR
+"""
+
+
+class Emulator:
+    """
+    One emulated Macropad running code.py.
+
+    After load(), the code.py module is available as `emu.code`, so tests and
+    benchmarks can poke at macro_keys, voicemeeter, gui and friends directly.
+    """
+
+    def __init__(self, use_async=True, speed=None, repl_mode=False, overrides=None):
+        self.use_async = use_async
+        self.clock = VirtualClock(speed)
+        self.hardware = Hardware(self.clock)
+        self.hardware.build()
+        self.loop = VirtualEventLoop(self.clock)
+        self.overrides = {"USE_ASYNC": use_async, "REPL_MODE": repl_mode}
+        self.overrides.update(overrides or {})
+        self.code = None
+        # CircuitPython's versions of host modules. They're swapped in while
+        # code.py loads and runs, since it imports some of them lazily.
+        self.shadowed = {
+            "asyncio": circuitpython_asyncio(self.loop),
+            "gc": circuitpython_gc(),
+            "time": circuitpython_time(self.clock),
+        }
+
+    @contextlib.contextmanager
+    def _shadowing(self):
+        saved = {name: sys.modules.get(name) for name in self.shadowed}
+        self.hardware.install(sys.modules)
+        sys.modules.update(self.shadowed)
+        try:
+            yield
+        finally:
+            for name, original in saved.items():
+                if original is None:
+                    sys.modules.pop(name, None)
+                else:
+                    sys.modules[name] = original
+
+    # SETUP
+    def load(self):
+        source = CODE_PATH.read_text()
+        for name, value in self.overrides.items():
+            source, count = re.subn(
+                rf"^{name} = .*$", f"{name} = {value!r}", source, count=1, flags=re.M
+            )
+            if not count:
+                raise KeyError(f"code.py has no top-level {name} setting")
+
+        if str(ROOT) not in sys.path:
+            sys.path.insert(0, str(ROOT))
+        while True:
+            module = ModuleType("macropad_code")
+            module.__file__ = str(CODE_PATH)
+            # code.py's own modules sit next to it, and get imported fresh so
+            # they bind to this emulator's hardware and clock
+            for path in ROOT.glob("*.py"):
+                sys.modules.pop(path.stem, None)
+            try:
+                with self._shadowing():
+                    exec(compile(source, str(CODE_PATH), "exec"), module.__dict__)
+                break
+            except Reload:
+                # a soft reload: the hardware, NVM and clock carry on
+                continue
+        self.code = module
+        return module
+
+    # INPUT SCRIPTING
+    def press(self, key_number, at):
+        self.clock.call_at(at, lambda: self.code.keys.press(key_number))
+
+    def release(self, key_number, at):
+        self.clock.call_at(at, lambda: self.code.keys.release(key_number))
+
+    def tap(self, key_number, at, hold=0.15):
+        self.press(key_number, at)
+        self.release(key_number, at + hold)
+
+    def turn(self, detents, at):
+        self.clock.call_at(at, lambda: self.code.encoder.turn(detents))
+
+    def click(self, at, hold=0.1):
+        self.clock.call_at(at, lambda: self.code.encoder_button.press(0))
+        self.clock.call_at(at + hold, lambda: self.code.encoder_button.release(0))
+
+    # RUNNING
+    def run(self, seconds):
+        """
+        Run the selected main loop for `seconds` of virtual time.
+        """
+        if self.code is None:
+            self.load()
+        self.clock.stop_at = self.clock.monotonic() + seconds
+        try:
+            with self._shadowing():
+                self.code.main()
+        except EmulationStopped:
+            pass
+        finally:
+            self.clock.stop_at = None
+            if self.use_async:
+                self._cancel_tasks()
+
+    def _cancel_tasks(self):
+        tasks = _host_asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            self.loop.run_until_complete(
+                _host_asyncio.gather(*tasks, return_exceptions=True)
+            )
+
+    # RESULTS
+    @property
+    def hid_reports(self):
+        """
+        (virtual time, consumer code) for every report sent.
+        """
+        return self.hardware.hid_log
+
+    def summary(self):
+        return {
+            "virtual seconds": round(self.clock.monotonic(), 3),
+            "HID reports": len(self.hardware.hid_log),
+            "mute suppressed": self.code.voicemeeter.suppressed,
+            "mute re-asserted": self.code.voicemeeter.reasserted,
+            "NeoPixel transfers": self.hardware.pixels.shows,
+            "LED frames skipped": self.code.pixel_buf.skipped,
+            "went idle": self.code.idle_mode.entered,
+            "% busy active": round(self.code.idle_mode.duty_cycle(False), 2),
+            "% busy idle": round(self.code.idle_mode.duty_cycle(True), 2),
+            "NVM writes": self.hardware.nvm.writes,
+            "I2C reads": self.hardware.i2c.reads,
+            "clock drift ppm": self.code.wall_clock.drift_ppm,
+            "clock max error ms": self.code.wall_clock.max_error,
+            "display refreshes": self.hardware.display.refreshes,
+            "display blocked ms": round(self.hardware.display.refresh_time * 1000, 1),
+            "label writes": self.hardware.display.label_writes,
+            "task overruns": sum(task.overruns for task in self.code.tasks.tasks),
+        }
+
+
+"""
+COMMAND LINE
+"""
+
+
+def _times(spec, count):
+    parts = [float(part) for part in spec.split(":")]
+    if len(parts) < count:
+        raise argparse.ArgumentTypeError(f"expected {count} ':'-separated values")
+    return parts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sync", action="store_true", help="run the sync loop")
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument(
+        "--speed", type=float, default=None, help="1 = real time; default: flat out"
+    )
+    parser.add_argument("--repl", action="store_true", help="keep REPL_MODE on")
+    parser.add_argument("--tap", action="append", default=[], metavar="AT:KEY[:HOLD]")
+    parser.add_argument("--turn", action="append", default=[], metavar="AT:DETENTS")
+    parser.add_argument("--click", action="append", default=[], metavar="AT")
+    parser.add_argument("--profile", action="store_true", help="cProfile the run")
+    parser.add_argument(
+        "--audit-allocations",
+        action="store_true",
+        help="run code.py's allocation audit under tracemalloc first",
+    )
+    parser.add_argument(
+        "--trace", action="store_true", help="record input and dump it at the end"
+    )
+    parser.add_argument(
+        "--cdc", action="store_true", help="put the usb_cdc data port on a pty"
+    )
+    parser.add_argument(
+        "--rtc-drift", type=float, default=0, metavar="PPM", help="DS3231 runs fast"
+    )
+    args = parser.parse_args(argv)
+    if args.cdc and args.speed is None:
+        args.speed = 1.0
+
+    overrides = {"TRACE_INPUT": 1} if args.trace else None
+    emu = Emulator(
+        use_async=not args.sync,
+        speed=args.speed,
+        repl_mode=args.repl,
+        overrides=overrides,
+    )
+    emu.load()
+    emu.code.rtc.drift_ppm = args.rtc_drift
+    for spec in args.tap:
+        at, key, *hold = _times(spec, 2)
+        emu.tap(int(key), at, *hold)
+    for spec in args.turn:
+        at, detents = _times(spec, 2)
+        emu.turn(int(detents), at)
+    for spec in args.click:
+        emu.click(float(spec))
+    if args.cdc:
+        print(f"usb_cdc data port: {emu.hardware.serial.attach_pty()}", flush=True)
+    if args.audit_allocations:
+        tracemalloc.start()
+        emu.code.audit_allocations()
+        tracemalloc.stop()
+
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.runcall(emu.run, args.seconds)
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+    else:
+        emu.run(args.seconds)
+
+    for at, code in emu.hid_reports:
+        print(f"{at:10.4f}s  HID {code}")
+    for name, value in emu.summary().items():
+        print(f"{name:>20}: {value}")
+    emu.code.tasks.report()
+    emu.code.gui.screen.report()
+    if args.trace:
+        emu.code.input_trace.dump()
+
+
+if __name__ == "__main__":
+    main()
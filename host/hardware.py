@@ -0,0 +1,756 @@
+"""
+Stand-ins for the CircuitPython modules code.py imports at the top of the file.
+
+Nothing in here talks to real hardware. Every fake is driven by a VirtualClock,
+so the emulator can run code.py in real time (to watch it) or as fast as the
+host allows (to measure it). Blocking hardware operations (NeoPixel writes,
+I2C reads, HID reports, display refreshes) charge a modelled cost to the clock.
+The costs are rough figures for the Macropad RP2040, not measurements, but they
+are enough to see which code path blocks which.
+"""
+
+import calendar
+import heapq
+import os
+import time as _host_time
+import tty
+from types import ModuleType
+
+# Modelled blocking costs, in seconds
+NEOPIXEL_SHOW_COST = 0.000_45  # 12 pixels * 24 bits * 1.25 us, plus overhead
+HID_REPORT_COST = 0.002  # press + release report, one 1 ms USB frame each
+I2C_READ_COST = 0.000_8  # DS3231 datetime: 7 bytes at 100 kHz
+DISPLAY_REFRESH_COST = 0.025  # full 128x64 SH1106 frame over SPI
+DISPLAY_REFRESH_OVERHEAD = 0.001  # per refresh, however little changed
+NVM_WRITE_COST = 0.045  # 4 kB flash sector erase + program
+
+# supervisor.ticks_ms() wraps at 2**29
+TICKS_PERIOD = 1 << 29
+
+
+class EmulationStopped(Exception):
+    """Raised by the clock when the emulation's run time is over."""
+
+
+class Reload(Exception):
+    """Raised by supervisor.reload(): code.py starts over."""
+
+
+def _reload():
+    raise Reload()
+
+
+"""
+TIME
+"""
+
+
+class VirtualClock:
+    """
+    A nanosecond counter that only moves when something advances it. Timers
+    scheduled with call_at fire in order as the clock passes them, which is how
+    scripted key presses and encoder turns arrive "during" a sleep.
+
+    speed=None runs as fast as possible. speed=1.0 paces the clock against the
+    host's wall time, speed=10.0 runs ten times faster than real time.
+    """
+
+    def __init__(self, speed=None):
+        self.speed = speed
+        self.stop_at = None
+        self._now_ns = 0
+        self._timers = []
+        self._timer_seq = 0
+        self._real_origin = _host_time.perf_counter()
+
+    # READING
+    def monotonic(self):
+        return self._now_ns / 1e9
+
+    def monotonic_ns(self):
+        return self._now_ns
+
+    def ticks_ms(self):
+        return (self._now_ns // 1_000_000) % TICKS_PERIOD
+
+    # TIMERS
+    def call_at(self, when, callback):
+        self.call_at_ns(int(when * 1e9), callback)
+
+    def call_at_ns(self, when_ns, callback):
+        self._timer_seq += 1
+        heapq.heappush(self._timers, (when_ns, self._timer_seq, callback))
+
+    def call_later(self, delay, callback):
+        self.call_at(self.monotonic() + delay, callback)
+
+    # ADVANCING
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def charge(self, seconds):
+        """
+        Account for time spent blocked inside a (fake) hardware call.
+        """
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        self.advance_to_ns(self._now_ns + max(0, round(seconds * 1e9)))
+
+    def advance_to_ns(self, when_ns):
+        stop_ns = None if self.stop_at is None else int(self.stop_at * 1e9)
+        if stop_ns is not None and when_ns > stop_ns:
+            when_ns = stop_ns
+        while self._timers and self._timers[0][0] <= when_ns:
+            timer_ns, _, callback = heapq.heappop(self._timers)
+            if timer_ns > self._now_ns:
+                self._set_now(timer_ns)
+            callback()
+        if when_ns > self._now_ns:
+            self._set_now(when_ns)
+        if stop_ns is not None and self._now_ns >= stop_ns:
+            raise EmulationStopped()
+
+    def _set_now(self, now_ns):
+        self._now_ns = now_ns
+        if self.speed:
+            real_target = self._real_origin + now_ns / 1e9 / self.speed
+            delay = real_target - _host_time.perf_counter()
+            if delay > 0:
+                _host_time.sleep(delay)
+
+
+"""
+KEYPAD
+"""
+
+
+class Event:
+    def __init__(self, key_number=0, pressed=True, timestamp=None):
+        self.key_number = key_number
+        self.pressed = pressed
+        self.timestamp = timestamp
+
+    @property
+    def released(self):
+        return not self.pressed
+
+    def __eq__(self, other):
+        return self.key_number == other.key_number and self.pressed == other.pressed
+
+    def __hash__(self):
+        return hash((self.key_number, self.pressed))
+
+    def __repr__(self):
+        state = "pressed" if self.pressed else "released"
+        return f"<Event: key_number {self.key_number} {state}>"
+
+
+class EventQueue:
+    def __init__(self, max_events):
+        self._events = []
+        self._max_events = max_events
+        self.overflowed = False
+
+    def get(self):
+        if not self._events:
+            return None
+        return self._events.pop(0)
+
+    def get_into(self, event):
+        if not self._events:
+            return False
+        queued = self._events.pop(0)
+        event.key_number = queued.key_number
+        event.pressed = queued.pressed
+        event.timestamp = queued.timestamp
+        return True
+
+    def clear(self):
+        self._events.clear()
+        self.overflowed = False
+
+    def __len__(self):
+        return len(self._events)
+
+    def __bool__(self):
+        return bool(self._events)
+
+    def _put(self, event):
+        if len(self._events) >= self._max_events:
+            self.overflowed = True
+            return
+        self._events.append(event)
+
+
+class Keys:
+    """
+    keypad.Keys scans every `interval` seconds and queues an event for each key
+    whose state changed since the previous scan. A change therefore becomes
+    visible at the next scan boundary, not when the switch closes. Emulator
+    code flips the switches with press() and release().
+    """
+
+    def __init__(
+        self, pins, *, value_when_pressed, pull=True, interval=0.020, max_events=64
+    ):
+        self._clock = _clock_for(self)
+        self.key_count = len(pins)
+        self.events = EventQueue(max_events)
+        self._interval_ns = max(1, int(interval * 1e9))
+        self._physical = [False] * self.key_count
+        self._reported = [False] * self.key_count
+        self._scan_pending = False
+
+    def reset(self):
+        self._reported = [False] * self.key_count
+        self.events.clear()
+
+    # emulator API
+    def press(self, key_number):
+        self._set_switch(key_number, True)
+
+    def release(self, key_number):
+        self._set_switch(key_number, False)
+
+    def inject(self, key_number, pressed):
+        """
+        Queues an event right now, stamped with the current tick, without
+        waiting for a scan. For replaying events that were already debounced.
+        """
+        self._physical[key_number] = pressed
+        self._reported[key_number] = pressed
+        self.events._put(Event(key_number, pressed, self._clock.ticks_ms()))
+
+    def _set_switch(self, key_number, closed):
+        self._physical[key_number] = closed
+        if self._scan_pending:
+            return
+        self._scan_pending = True
+        now_ns = self._clock.monotonic_ns()
+        next_scan_ns = (now_ns // self._interval_ns + 1) * self._interval_ns
+        self._clock.call_at_ns(next_scan_ns, self._scan)
+
+    def _scan(self):
+        self._scan_pending = False
+        timestamp = self._clock.ticks_ms()
+        for key_number, closed in enumerate(self._physical):
+            if closed != self._reported[key_number]:
+                self._reported[key_number] = closed
+                self.events._put(Event(key_number, closed, timestamp))
+
+
+"""
+ROTARY ENCODER
+"""
+
+
+class IncrementalEncoder:
+    def __init__(self, pin_a, pin_b, divisor=4):
+        self.position = 0
+        self.divisor = divisor
+
+    def deinit(self):
+        pass
+
+    # emulator API
+    def turn(self, detents):
+        self.position += detents
+
+
+"""
+NEOPIXELS
+"""
+
+
+class NeoPixelWire:
+    """
+    neopixel_write, which framebuffer.py sends whole frames with: raw GRB
+    bytes for the whole strip, one transfer per call. The last frame is kept
+    as it came, in a reused buffer, so the allocation audit doesn't see it.
+    """
+
+    def __init__(self):
+        self._clock = _clock_for(self)
+        self.shows = 0
+        self._wire = bytearray()
+        # set to a list to collect (virtual time, frame) for every transfer
+        self.frame_log = None
+
+    @property
+    def frame(self):
+        """
+        The last frame sent, as (r, g, b) pixels like NeoPixel's.
+        """
+        wire = self._wire
+        return tuple(
+            (wire[idx + 1], wire[idx], wire[idx + 2]) for idx in range(0, len(wire), 3)
+        )
+
+    def neopixel_write(self, pin, buf):
+        self.shows += 1
+        if len(self._wire) != len(buf):
+            self._wire = bytearray(len(buf))
+        self._wire[:] = buf
+        self._clock.charge(NEOPIXEL_SHOW_COST)
+        if self.frame_log is not None:
+            self.frame_log.append((self._clock.monotonic(), self.frame))
+
+
+"""
+NVM
+"""
+
+
+class NVM:
+    """
+    microcontroller.nvm: a 4 kB flash sector that reads as erased (0xFF) until
+    written. Every assignment is one erase/program cycle on the RP2040, however
+    few bytes change, so that's what we count.
+    """
+
+    def __init__(self, size=4096):
+        self._clock = _clock_for(self)
+        self._data = bytearray(b"\xff" * size)
+        self.writes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __getitem__(self, index):
+        return self._data[index]
+
+    def __setitem__(self, index, value):
+        self._data[index] = value
+        self.writes += 1
+        self._clock.charge(NVM_WRITE_COST)
+
+
+"""
+CLOCK CHIP
+"""
+
+
+class I2C:
+    def __init__(self):
+        self.reads = 0
+
+
+class DS3231:
+    """
+    Wall time is the virtual clock plus an epoch. Reads go over the (fake) I2C
+    bus, which counts them and charges for them.
+    """
+
+    # 2021-11-05 09:41:00, a Friday
+    DEFAULT_EPOCH = 1636105260
+
+    def __init__(self, i2c):
+        self._clock = _clock_for(self)
+        self._i2c = i2c
+        self._epoch = self.DEFAULT_EPOCH
+        self.reads = 0
+        # how much faster than the virtual clock the chip runs, to try out
+        # wallclock.py's drift tracking (ppm)
+        self.drift_ppm = 0
+
+    def _elapsed(self):
+        return self._clock.monotonic() * (1 + self.drift_ppm / 1_000_000)
+
+    @property
+    def datetime(self):
+        self.reads += 1
+        self._i2c.reads += 1
+        self._clock.charge(I2C_READ_COST)
+        return _host_time.gmtime(self._epoch + int(self._elapsed()))
+
+    @datetime.setter
+    def datetime(self, value):
+        self._epoch = int(calendar.timegm(value) - self._elapsed())
+
+
+"""
+DISPLAY
+"""
+
+
+class Group(list):
+    def __init__(self, *, scale=1, x=0, y=0):
+        super().__init__()
+        self.scale = scale
+        self.x = x
+        self.y = y
+        self.hidden = False
+
+
+class HeadlessDisplay:
+    """
+    board.DISPLAY without the pixels. It remembers what is shown and counts
+    refreshes. With auto_refresh on, any change to a shown label schedules one
+    background refresh at the next 60 Hz frame, like displayio does.
+
+    Like displayio, a refresh only sends the areas that changed: its cost is
+    DISPLAY_REFRESH_COST scaled by the area of the labels written since the
+    last one (a new root group dirties the whole screen).
+    """
+
+    FRAME_PERIOD = 1 / 60
+
+    def __init__(self):
+        self._clock = _clock_for(self)
+        self.width = 128
+        self.height = 64
+        self.rotation = 0
+        self.auto_refresh = True
+        self.root_group = None
+        self.refreshes = 0
+        self.label_writes = 0
+        self.refresh_time = 0
+        self._refresh_pending = False
+        self._dirty_area = 0
+
+    def show(self, group):
+        self.root_group = group
+        self._mark_dirty(self.width * self.height)
+
+    def refresh(self, *, target_frames_per_second=None, minimum_frames_per_second=0):
+        self.refreshes += 1
+        full = self.width * self.height
+        dirty = min(self._dirty_area, full) / full
+        self._dirty_area = 0
+        cost = DISPLAY_REFRESH_OVERHEAD + DISPLAY_REFRESH_COST * dirty
+        self.refresh_time += cost
+        self._clock.charge(cost)
+        return True
+
+    def _shows(self, group):
+        root = self.root_group
+        if group is root:
+            return True
+        return isinstance(root, Group) and any(child is group for child in root)
+
+    def _mark_dirty(self, area):
+        self._dirty_area += area
+        if not self.auto_refresh or self._refresh_pending:
+            return
+        self._refresh_pending = True
+        self._clock.call_later(self.FRAME_PERIOD, self._auto_refresh)
+
+    def _auto_refresh(self):
+        self._refresh_pending = False
+        self.refresh()
+
+
+class Label(Group):
+    """
+    adafruit_display_text.label.Label. Only the attributes code.py touches are
+    kept, and each write is reported to the display. Like the real one, it's a
+    Group holding the tile grid its glyphs are drawn into.
+    """
+
+    def __init__(
+        self,
+        font=None,
+        *,
+        text="",
+        color=0xFFFFFF,
+        background_color=None,
+        scale=1,
+        x=0,
+        y=0,
+        **kwargs,
+    ):
+        super().__init__(scale=scale, x=x, y=y)
+        self.append(object())
+        self._display = _display_for(self)
+        self.font = font
+        self._text = text
+        self._color = color
+        self._background_color = background_color
+
+    def _write(self):
+        display = self._display
+        display.label_writes += 1
+        if display._shows(self):
+            display._mark_dirty(self._area())
+
+    def _area(self):
+        # terminalio's FONT is 6x12
+        lines = self._text.split("\n")
+        width = max(len(line) for line in lines) * 6 * self.scale
+        return width * len(lines) * 12 * self.scale
+
+    @property
+    def text(self):
+        return self._text
+
+    @text.setter
+    def text(self, value):
+        self._text = value
+        self._write()
+
+    @property
+    def color(self):
+        return self._color
+
+    @color.setter
+    def color(self, value):
+        self._color = value
+        self._write()
+
+    @property
+    def background_color(self):
+        return self._background_color
+
+    @background_color.setter
+    def background_color(self, value):
+        self._background_color = value
+        self._write()
+
+
+class SimpleTextDisplay:
+    """
+    adafruit_simple_text_display.SimpleTextDisplay: lines are created on first
+    access and stacked in one group.
+    """
+
+    def __init__(
+        self,
+        title=None,
+        title_color=0xFFFFFF,
+        title_scale=1,
+        text_scale=1,
+        font=None,
+        colors=None,
+        display=None,
+    ):
+        self._display = display or _display_for(self)
+        self._font = font
+        self._colors = colors or (0xFFFFFF,)
+        self._text_scale = text_scale
+        self._lines = []
+        self.text_group = Group()
+
+    def __getitem__(self, item):
+        while len(self._lines) <= item:
+            idx = len(self._lines)
+            line = Label(
+                self._font,
+                color=self._colors[idx % len(self._colors)],
+                scale=self._text_scale,
+                y=idx * 12 * self._text_scale + 6,
+            )
+            self._lines.append(line)
+            self.text_group.append(line)
+        return self._lines[item]
+
+    def show(self):
+        self._display.show(self.text_group)
+
+
+"""
+HID
+"""
+
+
+class ConsumerControl:
+    def __init__(self, devices):
+        self._clock = _clock_for(self)
+
+    def send(self, consumer_code):
+        self._clock.charge(HID_REPORT_COST)
+        _hid_log_for(self).append((self._clock.monotonic(), consumer_code))
+
+    def press(self, consumer_code):
+        self.send(consumer_code)
+
+    def release(self):
+        pass
+
+
+class Keycode:
+    ALT = 0xE2
+    KEYPAD_ZERO = 0x62
+    KEYPAD_ONE = 0x59
+    KEYPAD_TWO = 0x5A
+    KEYPAD_THREE = 0x5B
+
+
+"""
+USB CDC
+"""
+
+
+class Serial:
+    """
+    usb_cdc.data. Nobody is listening at first (connected is False), like a
+    port no program has opened. The emulator's end is either in memory (set
+    connected, then use host_write() and `written`) or a pty, from
+    attach_pty(), for a real program like host/monitor.py to open.
+    """
+
+    def __init__(self):
+        self.connected = False
+        self.timeout = 1
+        self.write_timeout = None
+        self.written = bytearray()
+        self._inbox = bytearray()
+        self._master = None
+        self._slave = None
+
+    def attach_pty(self):
+        """
+        Returns the path of the pty's device end.
+        """
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        os.set_blocking(self._master, False)
+        self.connected = True
+        return os.ttyname(self._slave)
+
+    def host_write(self, data):
+        self._inbox.extend(data)
+
+    @property
+    def in_waiting(self):
+        if self._master is not None:
+            try:
+                self._inbox.extend(os.read(self._master, 4096))
+            except (BlockingIOError, OSError):
+                pass
+        return len(self._inbox)
+
+    def read(self, size=1):
+        data = bytes(self._inbox[:size])
+        del self._inbox[:size]
+        return data
+
+    def write(self, data):
+        if self._master is None:
+            self.written.extend(data)
+            return len(data)
+        try:
+            return os.write(self._master, data)
+        except BlockingIOError:
+            return 0
+
+
+"""
+MODULE ASSEMBLY
+"""
+
+# The hardware being built right now. Fakes look their clock, display and HID
+# log up here so that their constructors keep CircuitPython's signatures.
+_current = {}
+
+
+def _clock_for(_):
+    return _current["clock"]
+
+
+def _display_for(_):
+    return _current["display"]
+
+
+def _hid_log_for(_):
+    return _current["hid_log"]
+
+
+class Hardware:
+    """
+    One Macropad's worth of fake modules. install() points sys.modules at them
+    and must happen before code.py is imported.
+    """
+
+    PINS = (
+        "BUTTON",
+        "ROTA",
+        "ROTB",
+        "NEOPIXEL",
+        "SCL",
+        "SDA",
+        "SPEAKER",
+        "SPEAKER_ENABLE",
+    ) + tuple(f"KEY{i}" for i in range(1, 13))
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.hid_log = []
+        self.nvm = None
+        self.pixels = None
+        self.i2c = None
+        self.display = None
+        self.serial = None
+        self.modules = {}
+
+    def build(self):
+        _current.update(clock=self.clock, hid_log=self.hid_log)
+        self.nvm = NVM()
+        self.pixels = NeoPixelWire()
+        self.i2c = I2C()
+        self.display = HeadlessDisplay()
+        _current["display"] = self.display
+
+        board = self._module("board")
+        for pin in self.PINS:
+            setattr(board, pin, pin)
+        board.I2C = lambda: self.i2c
+        board.DISPLAY = self.display
+
+        self._module("supervisor", ticks_ms=self.clock.ticks_ms, reload=_reload)
+        self._module("micropython", const=lambda value: value)
+        self._module("keypad", Keys=Keys, Event=Event, EventQueue=EventQueue)
+        self._module("rotaryio", IncrementalEncoder=IncrementalEncoder)
+        self._module("neopixel_write", neopixel_write=self.pixels.neopixel_write)
+        self._module("microcontroller", nvm=self.nvm)
+        self._module("adafruit_ds3231", DS3231=DS3231)
+        self._module("displayio", Group=Group)
+        self._module("terminalio", FONT=object())
+        display_text = self._module("adafruit_display_text")
+        display_text.label = self._module("adafruit_display_text.label", Label=Label)
+        self._module(
+            "adafruit_simple_text_display", SimpleTextDisplay=SimpleTextDisplay
+        )
+        self._module(
+            "digitalio", DigitalInOut=_DigitalInOut, Pull=_Pull, Direction=_Direction
+        )
+        self._module("usb_hid", devices=[])
+        self.serial = Serial()
+        self._module("usb_cdc", data=self.serial, console=None)
+        hid = self._module("adafruit_hid")
+        hid.consumer_control = self._module(
+            "adafruit_hid.consumer_control", ConsumerControl=ConsumerControl
+        )
+        hid.keycode = self._module("adafruit_hid.keycode", Keycode=Keycode)
+        return self.modules
+
+    def install(self, sys_modules):
+        _current.update(clock=self.clock, hid_log=self.hid_log, display=self.display)
+        sys_modules.update(self.modules)
+
+    def _module(self, name, **attributes):
+        module = ModuleType(name)
+        module.__dict__.update(attributes)
+        self.modules[name] = module
+        return module
+
+
+class _DigitalInOut:
+    def __init__(self, pin):
+        self.pin = pin
+        self.value = False
+        self.pull = None
+        self.direction = None
+
+    def deinit(self):
+        pass
+
+
+class _Pull:
+    UP = "UP"
+    DOWN = "DOWN"
+
+
+class _Direction:
+    INPUT = "INPUT"
+    OUTPUT = "OUTPUT"
@@ -0,0 +1,148 @@
+"""
+Input-to-HID latency: how long after a switch closes (or opens) does the mute
+or unmute report go out? With --encoder: how long after a detent does the
+volume report go out?
+
+Single taps are scheduled at random phases against every periodic task, so
+the percentiles cover the whole polling window. Each switch change is paired
+with the first report that follows it.
+
+    python -m host.latency --taps 500
+    python -m host.latency --taps 500 --sync
+    python -m host.latency --taps 200 --encoder
+    python -m host.latency --taps 500 --load
+    python -m host.latency --taps 200 --idle
+
+--load measures under full animation load: every tap leaves ripples running,
+and the debug page is up, so the display redraws every second on top of the
+LED frames. Any task that's running when the switch changes delays the report,
+so the max here is the figure to watch.
+
+--idle lets the pad go idle (see IdleMode in code.py) before every tap, so
+each press is also the one that wakes it. Waking shouldn't cost the press
+anything.
+"""
+
+import argparse
+import random
+
+from host.emulator import Emulator
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    idx = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def quiet(emu):
+    # the periodic health report would drown out ours
+    if hasattr(emu.code, "health"):
+        emu.code.health.CONSOLE_EVERY = 0
+
+
+# With --idle: idle timeout, and the extra gap between taps that it needs (s)
+IDLE_TIMEOUT = 1.0
+IDLE_GAP = 2.5
+
+
+def measure(taps=200, use_async=True, seed=1, key_number=5, load=False, idle=False):
+    """
+    Returns a list of switch-change-to-report latencies in milliseconds.
+    """
+    rng = random.Random(seed)
+    emu = Emulator(use_async=use_async)
+    emu.load()
+    quiet(emu)
+    if load:
+        # clock -> menu -> debug page
+        emu.code.macro_encoder._toggle_menu()
+        emu.code.macro_encoder._toggle_menu()
+    if idle:
+        emu.code.IdleMode.TIMEOUT = int(IDLE_TIMEOUT * 1000)
+
+    # leave room for the boot mute report
+    at = 0.5
+    changes = []
+    for _ in range(taps):
+        hold = rng.uniform(0.12, 0.35)
+        emu.tap(key_number, at, hold)
+        changes.extend((at, at + hold))
+        at += hold + rng.uniform(0.25, 0.6) + (IDLE_GAP if idle else 0)
+    emu.run(at + 0.5)
+    if idle:
+        assert emu.code.idle_mode.entered >= taps, "taps didn't all come from idle"
+
+    reports = [t for t, _ in emu.hid_reports if t >= changes[0]]
+    latencies = []
+    for changed_at in changes:
+        sent_at = next((t for t in reports if t >= changed_at), None)
+        if sent_at is not None:
+            latencies.append((sent_at - changed_at) * 1000)
+    return latencies
+
+
+def measure_encoder(turns=200, use_async=True, seed=1):
+    """
+    Detent-to-action: single detents in volume mode, each paired with the
+    first volume report that follows it. Returns milliseconds.
+    """
+    rng = random.Random(seed)
+    emu = Emulator(use_async=use_async)
+    emu.load()
+    quiet(emu)
+    emu.code.gui.selected = 1
+
+    at = 0.5
+    detents = []
+    for _ in range(turns):
+        emu.turn(rng.choice((-1, 1)), at)
+        detents.append(at)
+        at += rng.uniform(0.6, 1.2)
+    emu.run(at + 0.5)
+
+    mute_codes = (emu.code.voicemeeter.MUTE, emu.code.voicemeeter.UNMUTE)
+    reports = [t for t, code in emu.hid_reports if code not in mute_codes]
+    latencies = []
+    for turned_at in detents:
+        sent_at = next((t for t in reports if t >= turned_at), None)
+        if sent_at is not None:
+            latencies.append((sent_at - turned_at) * 1000)
+    return latencies
+
+
+def report(latencies):
+    return (
+        f"n={len(latencies)}  "
+        f"p50={percentile(latencies, 0.50):.1f} ms  "
+        f"p99={percentile(latencies, 0.99):.1f} ms  "
+        f"max={max(latencies):.1f} ms"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--taps", type=int, default=200)
+    parser.add_argument("--sync", action="store_true")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--encoder", action="store_true", help="measure detent-to-action instead"
+    )
+    parser.add_argument("--load", action="store_true", help="keep the display busy too")
+    parser.add_argument("--idle", action="store_true", help="tap from idle every time")
+    args = parser.parse_args(argv)
+    mode = "sync" if args.sync else "async"
+    if args.encoder:
+        latencies = measure_encoder(args.taps, not args.sync, args.seed)
+        print(f"{mode} detent-to-HID: {report(latencies)}")
+    else:
+        latencies = measure(
+            args.taps, not args.sync, args.seed, load=args.load, idle=args.idle
+        )
+        load = " under load" if args.load else ""
+        idle = " from idle" if args.idle else ""
+        print(f"{mode} press-to-HID{load}{idle}: {report(latencies)}")
+
+
+if __name__ == "__main__":
+    main()
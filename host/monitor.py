@@ -0,0 +1,219 @@
+"""
+An asyncio client for the telemetry channel (see telemetry.py): watch any
+number of Macropads, and send them commands, without touching the REPL.
+
+    python -m host.monitor /dev/ttyACM1
+    python -m host.monitor /dev/ttyACM1 /dev/ttyACM3 --period 250
+    python -m host.monitor /dev/ttyACM1 --brightness 12 --state
+
+The Macropad's data port is the second serial port it shows up as. To try
+this without one, run the emulator with --cdc and point this at the pty it
+prints. In a program:
+
+    device = await Device.open("/dev/ttyACM1")
+    await device.set_brightness(12)
+    print(await device.telemetry())
+    device.close()
+"""
+
+import argparse
+import asyncio
+import os
+import struct
+import tty
+from collections import namedtuple
+
+# telemetry.py sits next to code.py, in the repo root
+import telemetry
+
+Telemetry = namedtuple("Telemetry", telemetry.TELEMETRY_FIELDS + ("frame_histogram",))
+State = namedtuple("State", telemetry.STATE_FIELDS + ("tasks",))
+TaskState = namedtuple("TaskState", ("name",) + telemetry.TASK_FIELDS[:-1])
+
+# Telemetry frames kept for telemetry() to return. Older ones are dropped.
+TELEMETRY_BACKLOG = 16
+# How long to wait for a reply to a command (s)
+REPLY_TIMEOUT = 1.0
+
+
+class DeviceError(Exception):
+    """The Macropad turned a command down."""
+
+
+def decode(kind, payload):
+    """
+    Turns a frame from the Macropad into a Telemetry, a State, or an
+    (command, status) ACK.
+    """
+    if kind == telemetry.TELEMETRY:
+        values = struct.unpack(telemetry.TELEMETRY_FORMAT, payload)
+        fields = len(telemetry.TELEMETRY_FIELDS)
+        return Telemetry(*values[:fields], values[fields:])
+    if kind == telemetry.STATE:
+        offset = struct.calcsize(telemetry.STATE_FORMAT)
+        values = struct.unpack_from(telemetry.STATE_FORMAT, payload)
+        tasks = []
+        record_size = struct.calcsize(telemetry.TASK_FORMAT)
+        while offset < len(payload):
+            *record, name_length = struct.unpack_from(
+                telemetry.TASK_FORMAT, payload, offset
+            )
+            offset += record_size
+            name = payload[offset : offset + name_length].decode()
+            offset += name_length
+            tasks.append(TaskState(name, *record))
+        return State(*values, tuple(tasks))
+    if kind == telemetry.ACK:
+        return struct.unpack(telemetry.ACK_FORMAT, payload)
+    raise ValueError(f"unknown frame kind {kind:#x}")
+
+
+class Device:
+    """
+    One Macropad's data port. A background task reads frames as they come:
+    telemetry is queued for telemetry(), replies go to whoever is waiting.
+    """
+
+    def __init__(self, reader, transport, name=""):
+        """
+        reader is an asyncio.StreamReader, transport is where commands get
+        written. open() makes both for a serial port.
+        """
+        self.name = name
+        self._reader = reader
+        self._transport = transport
+        self._frames = telemetry.FrameReader()
+        self._telemetry = asyncio.Queue(TELEMETRY_BACKLOG)
+        self._replies = {}
+        self._read_task = asyncio.ensure_future(self._read())
+        self.latest = None
+
+    @classmethod
+    async def open(cls, path):
+        """
+        Opens a serial port (or the emulator's pty) in raw mode.
+        """
+        fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        tty.setraw(fd)
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, "rb", 0)
+        )
+        transport, _ = await loop.connect_write_pipe(
+            asyncio.Protocol, os.fdopen(os.dup(fd), "wb", 0)
+        )
+        return cls(reader, transport, path)
+
+    def close(self):
+        self._read_task.cancel()
+        self._transport.close()
+
+    async def _read(self):
+        while True:
+            data = await self._reader.read(256)
+            if not data:
+                break
+            for kind, payload in self._frames.feed(data):
+                self._dispatch(kind, decode(kind, payload))
+
+    def _dispatch(self, kind, message):
+        if kind == telemetry.TELEMETRY:
+            self.latest = message
+            if self._telemetry.full():
+                self._telemetry.get_nowait()
+            self._telemetry.put_nowait(message)
+            return
+        # replies are matched to commands by kind: an ACK names its command
+        key = message[0] if kind == telemetry.ACK else kind
+        waiters = self._replies.get(key)
+        if waiters:
+            waiter = waiters.pop(0)
+            if not waiter.done():
+                waiter.set_result(message)
+
+    async def _request(self, kind, payload, reply_key):
+        waiter = asyncio.get_running_loop().create_future()
+        self._replies.setdefault(reply_key, []).append(waiter)
+        self._transport.write(telemetry.encode(kind, payload))
+        try:
+            return await asyncio.wait_for(waiter, REPLY_TIMEOUT)
+        finally:
+            waiters = self._replies.get(reply_key)
+            if waiters and waiter in waiters:
+                waiters.remove(waiter)
+
+    async def _command(self, kind, payload):
+        _, status = await self._request(kind, payload, kind)
+        if status != telemetry.OK:
+            raise DeviceError(f"{self.name}: command {kind:#x} failed ({status})")
+
+    # COMMANDS
+    async def telemetry(self):
+        """
+        The next telemetry frame, oldest first.
+        """
+        return await self._telemetry.get()
+
+    async def state(self):
+        return await self._request(telemetry.REQUEST_STATE, b"", telemetry.STATE)
+
+    async def set_brightness(self, level):
+        payload = struct.pack(telemetry.SET_BRIGHTNESS_FORMAT, level)
+        await self._command(telemetry.SET_BRIGHTNESS, payload)
+
+    async def set_period(self, ms):
+        """
+        Time between telemetry frames (ms). 0 stops them.
+        """
+        payload = struct.pack(telemetry.SET_PERIOD_FORMAT, ms)
+        await self._command(telemetry.SET_PERIOD, payload)
+
+
+def format_telemetry(name, frame):
+    state = "muted" if frame.muted else "LIVE"
+    return (
+        f"{name}: {state:>5}  brightness {frame.brightness:>2}  "
+        f"keys {frame.key_events}  hid {frame.hid_reports} "
+        f"({frame.mute_suppressed} suppressed, {frame.mute_reasserted} re-asserted)  "
+        f"frames {frame.frames} ({frame.frame_overruns} overruns, "
+        f"{frame.frame_max_late} ms max late)  heap {frame.free_heap}"
+    )
+
+
+async def watch(path, args):
+    device = await Device.open(path)
+    try:
+        if args.period is not None:
+            await device.set_period(args.period)
+        if args.brightness is not None:
+            await device.set_brightness(args.brightness)
+        if args.state:
+            print(f"{path}: {await device.state()}")
+        received = 0
+        while not args.count or received < args.count:
+            print(format_telemetry(path, await device.telemetry()), flush=True)
+            received += 1
+    finally:
+        device.close()
+
+
+async def watch_all(args):
+    await asyncio.gather(*(watch(path, args) for path in args.ports))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("ports", nargs="+", help="data ports (or emulator ptys)")
+    parser.add_argument("--brightness", type=int, help="set the brightness level")
+    parser.add_argument("--period", type=int, help="ms between telemetry frames")
+    parser.add_argument("--state", action="store_true", help="print a state dump")
+    parser.add_argument(
+        "--count", type=int, default=0, help="stop after this many frames each"
+    )
+    args = parser.parse_args(argv)
+    asyncio.run(watch_all(args))
+
+
+if __name__ == "__main__":
+    main()
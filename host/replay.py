@@ -0,0 +1,147 @@
+"""
+Replays an input trace (see input_trace.py) through code.py on the emulator
+and prints everything that came out: each key event with the gestures it
+completed, each HID report, and with --frames each NeoPixel transfer.
+
+The input is a console log holding a trace dump, or the raw trace bytes.
+Events land at their recorded times, relative to the first one, so gesture
+timing is exactly what was captured on the device. Save the output once, and
+--expect will flag any change in what the same input does:
+
+    python -m host.replay session.log --out session.expected
+    python -m host.replay session.log --expect session.expected
+    python -m host.replay session.log --sync --frames
+
+To make a trace without a device, run the emulator with --trace.
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+from host.emulator import Emulator
+
+# Time between boot and the first replayed event (s)
+LEAD_IN = 0.5
+# How long replayed encoder clicks are held (s)
+CLICK_HOLD = 0.05
+
+
+def load_trace(path):
+    """
+    Returns [(seconds after the first record, kind, value), ...].
+    """
+    # input_trace sits next to code.py, and only imports once the emulator has
+    # put the fake supervisor module in place
+    import input_trace
+    from ticks import ticks_diff
+
+    data = Path(path).read_bytes()
+    if input_trace.DUMP_START.encode() in data:
+        data = input_trace.read_dump(data.decode(errors="replace"))
+    records = list(input_trace.decode(data))
+    if not records:
+        return []
+    first = records[0][0]
+    return [
+        (ticks_diff(timestamp, first) / 1000, kind, value)
+        for timestamp, kind, value in records
+    ]
+
+
+def replay(path, use_async=True, frames=False):
+    """
+    Returns (emulator, output lines).
+    """
+    emu = Emulator(use_async=use_async)
+    code = emu.load()
+    import input_trace
+
+    trace = load_trace(path)
+    for at, kind, value in trace:
+        at += LEAD_IN
+        if kind == input_trace.KEY_PRESS:
+            emu.clock.call_at(at, lambda key=value: code.keys.inject(key, True))
+        elif kind == input_trace.KEY_RELEASE:
+            emu.clock.call_at(at, lambda key=value: code.keys.inject(key, False))
+        elif kind == input_trace.ENCODER:
+            emu.clock.call_at(at, lambda change=value: code.encoder.turn(change))
+        elif kind == input_trace.ENCODER_PRESS:
+            emu.clock.call_at(at, lambda: code.encoder_button.inject(0, True))
+            release_at = at + CLICK_HOLD
+            emu.clock.call_at(release_at, lambda: code.encoder_button.inject(0, False))
+
+    # note what the recognizers made of every key event
+    macro_keys = code.macro_keys
+    handle_event = macro_keys._handle_button_event
+    key_log = []
+
+    def logged_handle_event(self):
+        event = handle_event()
+        if event:
+            key_log.append(
+                (
+                    emu.clock.monotonic(),
+                    event.key_number,
+                    event.pressed,
+                    macro_keys._recognize_rocker(),
+                    macro_keys._recognize_toggle(),
+                )
+            )
+        return event
+
+    # on the class: MacroKeys has __slots__, so its instances take no new
+    # attributes. Every load() builds a fresh code module, so this stays put.
+    code.MacroKeys._handle_button_event = logged_handle_event
+    if frames:
+        emu.hardware.pixels.frame_log = []
+
+    end = LEAD_IN + (trace[-1][0] if trace else 0) + 1
+    emu.run(end)
+
+    lines = []
+    for at, key, pressed, rocker, toggle in key_log:
+        state = "down" if pressed else "up"
+        gestures = " rocker" * rocker + " toggle" * toggle
+        lines.append((at, f"{at:10.4f} KEY {key} {state}{gestures}"))
+    for at, consumer_code in emu.hid_reports:
+        lines.append((at, f"{at:10.4f} HID {consumer_code}"))
+    for at, frame in emu.hardware.pixels.frame_log or ():
+        pixels = "".join(f"{r:02x}{g:02x}{b:02x}" for r, g, b in frame)
+        lines.append((at, f"{at:10.4f} LED {pixels}"))
+    # sorted() is stable: at equal times, keys come before reports and frames
+    return emu, [line for _, line in sorted(lines, key=lambda item: item[0])]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("trace", help="console log with a trace dump, or raw bytes")
+    parser.add_argument("--sync", action="store_true", help="run the sync loop")
+    parser.add_argument("--frames", action="store_true", help="log NeoPixel frames")
+    parser.add_argument("--out", help="write the output here instead of stdout")
+    parser.add_argument("--expect", help="compare the output against this file")
+    args = parser.parse_args(argv)
+
+    emu, lines = replay(args.trace, not args.sync, args.frames)
+    if args.out:
+        Path(args.out).write_text("".join(line + "\n" for line in lines))
+    elif not args.expect:
+        for line in lines:
+            print(line)
+
+    for name, value in emu.summary().items():
+        print(f"{name:>20}: {value}")
+
+    if args.expect:
+        expected = Path(args.expect).read_text().splitlines()
+        for idx in range(max(len(expected), len(lines))):
+            want = expected[idx] if idx < len(expected) else "(nothing)"
+            got = lines[idx] if idx < len(lines) else "(nothing)"
+            if want != got:
+                print(f"line {idx + 1} differs:\n  expected {want}\n  got      {got}")
+                sys.exit(1)
+        print(f"replay matches {args.expect} ({len(lines)} lines)")
+
+
+if __name__ == "__main__":
+    main()
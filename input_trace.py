@@ -0,0 +1,114 @@
+# autocopy
+
+"""
+INPUT TRACE
+
+Records every key event, encoder movement and encoder click, with its
+timestamp, into a fixed bytearray in RAM. When it's full, the oldest records
+are overwritten, so it always holds the last CAPACITY inputs. dump() prints it
+to the serial console as base64, and host/replay.py plays it back through
+code.py on the emulator.
+
+Records are RECORD_FORMAT: ticks_ms (4 bytes), kind (1 byte), value (1 signed
+byte). Writing one is a pack_into() at an offset, so recording doesn't
+allocate.
+"""
+
+import binascii
+import struct
+
+from ticks import ticks_ms
+
+KEY_PRESS = 0
+KEY_RELEASE = 1
+# value is the change in encoder.position
+ENCODER = 2
+ENCODER_PRESS = 3
+
+RECORD_FORMAT = "<IBb"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+DUMP_START = "--- input trace ---"
+DUMP_END = "--- end of input trace ---"
+
+
+class InputTrace:
+    # Records kept (6 bytes each)
+    CAPACITY = 512
+
+    def __init__(self):
+        self._buffer = bytearray(self.CAPACITY * RECORD_SIZE)
+        self._next = 0
+        self.recorded = 0
+
+    def _record(self, timestamp, kind, value):
+        struct.pack_into(
+            RECORD_FORMAT,
+            self._buffer,
+            self._next * RECORD_SIZE,
+            timestamp,
+            kind,
+            value,
+        )
+        self._next += 1
+        if self._next == self.CAPACITY:
+            self._next = 0
+        self.recorded += 1
+
+    def key(self, event):
+        kind = KEY_PRESS if event.pressed else KEY_RELEASE
+        self._record(event.timestamp, kind, event.key_number)
+
+    def encoder(self, change):
+        change = min(127, max(change, -128))
+        self._record(ticks_ms(), ENCODER, change)
+
+    def encoder_press(self):
+        self._record(ticks_ms(), ENCODER_PRESS, 0)
+
+    def clear(self):
+        self._next = 0
+        self.recorded = 0
+
+    def dump(self, chunk=48):
+        """
+        Prints the trace, oldest record first, between DUMP_START and
+        DUMP_END. Copy everything between the markers (or the whole console
+        log) into a file for host/replay.py.
+        """
+        buffer = self._buffer
+        if self.recorded < self.CAPACITY:
+            data = buffer[: self._next * RECORD_SIZE]
+        else:
+            split = self._next * RECORD_SIZE
+            data = buffer[split:] + buffer[:split]
+        print(DUMP_START)
+        for start in range(0, len(data), chunk):
+            print(binascii.b2a_base64(data[start : start + chunk]).decode().strip())
+        print(DUMP_END)
+
+
+def decode(data):
+    """
+    Yields (ticks_ms, kind, value) for each record in a dumped trace.
+    """
+    for offset in range(0, len(data) - RECORD_SIZE + 1, RECORD_SIZE):
+        yield struct.unpack_from(RECORD_FORMAT, data, offset)
+
+
+def read_dump(text):
+    """
+    Finds the last dump in a console log and returns its raw bytes.
+    """
+    lines = text.splitlines()
+    starts = [idx for idx, line in enumerate(lines) if line.strip() == DUMP_START]
+    if not starts:
+        raise ValueError("no input trace dump found")
+    start = starts[-1]
+    data = bytearray()
+    for line in lines[start + 1 :]:
+        line = line.strip()
+        if line == DUMP_END:
+            return bytes(data)
+        data += binascii.a2b_base64(line)
+    raise ValueError("input trace dump is cut short")
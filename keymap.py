@@ -0,0 +1,53 @@
+# autocopy
+
+"""
+KEYMAP
+
+What each key does, per layer. A layer is a row of (action, argument) pairs,
+one per key_number:
+
+-- (MOMENTARY, 0): push-to-talk, or push-to-mute after a rocker. These keys
+are the only ones the gesture engine sees, so a volume key pressed in the
+middle doesn't end a push-to-talk.
+-- (LATCH, 0): toggles the mute on press, and leaves it.
+-- (VOLUME, steps): volume up (positive) or down (negative) on press.
+-- (CONSUMER, code): sends any consumer control code on press.
+-- (LAYER, layer): switches to another layer on press.
+-- (NOTHING, 0): ripples, and nothing else.
+
+compile_layers() flattens the layers into two tables, at boot: actions (a
+bytearray) and their arguments (an array), both indexed by layer * keys +
+key_number. Dispatching an event is two index lookups, with no dicts, strings
+or allocation, and switching layers only changes the offset into the tables.
+"""
+
+from micropython import const
+from array import array
+
+NOTHING = const(0)
+MOMENTARY = const(1)
+LATCH = const(2)
+VOLUME = const(3)
+CONSUMER = const(4)
+LAYER = const(5)
+
+
+def compile_layers(layers, keys):
+    """
+    Returns (actions, arguments). Raises ValueError if a layer is the wrong
+    size, an action is unknown, or a LAYER action points at a missing layer.
+    """
+    actions = bytearray(len(layers) * keys)
+    arguments = array("h", [0] * (len(layers) * keys))
+    for layer_idx, layer in enumerate(layers):
+        if len(layer) != keys:
+            raise ValueError(f"layer {layer_idx} has {len(layer)} keys, not {keys}")
+        for key_number, (action, argument) in enumerate(layer):
+            if not NOTHING <= action <= LAYER:
+                raise ValueError(f"bad action on layer {layer_idx}, key {key_number}")
+            if action == LAYER and not 0 <= argument < len(layers):
+                raise ValueError(f"no layer {argument} to switch to")
+            slot = layer_idx * keys + key_number
+            actions[slot] = action
+            arguments[slot] = argument
+    return actions, arguments
@@ -0,0 +1,187 @@
+# autocopy
+
+"""
+NVM STORE
+
+Every write to microcontroller.nvm is a blocking flash erase and program (the
+whole 4 kB sector on the RP2040), and flash only survives so many of those.
+Turning the encoder used to write on every detent. Instead, NVMStore keeps the
+settings in RAM and only writes them once they've stopped changing.
+
+Each write is a small, checksummed record placed in the slot after the last
+one. On boards that erase NVM page by page, rotating through slots spreads the
+wear; on the RP2040 the sector is erased regardless, so what bounds the wear is
+MIN_FLUSH_INTERVAL. At boot we scan every slot and keep the newest record that
+checks out, so a write interrupted by a power cut costs one change, not the
+whole configuration.
+"""
+
+from binascii import crc32
+from struct import pack_into, unpack_from
+from time import monotonic
+
+
+class NVMStore:
+    MAGIC = 0x4D
+    # Version 2: brightness is a MacroKeys brightness level. Version 1 (and the
+    # pre-NVMStore bytes, version 0) held neopixel brightness * 255. Older
+    # records still load; code.py converts the brightness.
+    VERSION = 2
+    OLDEST_VERSION = 1
+    # magic, version, sequence, selected, hour offset, brightness
+    RECORD_FORMAT = "<BBHBbB"
+    # Record size, including the CRC32 stored in its last four bytes
+    RECORD_SIZE = 16
+    # Byte range of the NVM that records rotate through. settings.py keeps its
+    # cache above it.
+    AREA_START = 0
+    AREA_END = 2048
+
+    # Write this long after the last change (s)
+    FLUSH_DELAY = 5
+    # Never write more often than this (s). That caps flash erases at 1440 a
+    # day, even if someone spins the encoder non-stop.
+    MIN_FLUSH_INTERVAL = 60
+
+    def __init__(self, nvm):
+        self._nvm = nvm
+        self._record = bytearray(self.RECORD_SIZE)
+        self._slot_count = (self.AREA_END - self.AREA_START) // self.RECORD_SIZE
+
+        self._slot = -1
+        self._sequence = 0
+        self._selected = 0
+        self._hour_offset = 0
+        self._brightness = 0
+        # format version of what was loaded
+        self.version = self.VERSION
+        if not self._load():
+            self._load_legacy()
+
+        self._dirty = False
+        self._changed_at = 0
+        self._flushed_at = None
+        self.writes = 0
+
+    # STORED VALUES
+    @property
+    def selected(self):
+        return self._selected
+
+    @selected.setter
+    def selected(self, value):
+        if value != self._selected:
+            self._selected = value
+            self._mark_dirty()
+
+    @property
+    def hour_offset(self):
+        return self._hour_offset
+
+    @hour_offset.setter
+    def hour_offset(self, value):
+        if value != self._hour_offset:
+            self._hour_offset = value
+            self._mark_dirty()
+
+    @property
+    def brightness(self):
+        # 0-255, what it means depends on the version (see VERSION)
+        return self._brightness
+
+    @brightness.setter
+    def brightness(self, value):
+        if value != self._brightness:
+            self._brightness = value
+            self._mark_dirty()
+
+    @property
+    def dirty(self):
+        return self._dirty
+
+    def _mark_dirty(self):
+        self._dirty = True
+        self._changed_at = monotonic()
+
+    # WRITING
+    def flush_if_due(self):
+        """
+        Cheap enough to call on every loop. Writes only once the values have
+        been left alone for FLUSH_DELAY, and not sooner than MIN_FLUSH_INTERVAL
+        after the previous write.
+        """
+        if not self._dirty:
+            return False
+        now = monotonic()
+        if now - self._changed_at < self.FLUSH_DELAY:
+            return False
+        if self._flushed_at is not None:
+            if now - self._flushed_at < self.MIN_FLUSH_INTERVAL:
+                return False
+        self.flush()
+        return True
+
+    def flush(self):
+        self._sequence = (self._sequence + 1) & 0xFFFF
+        self._slot = (self._slot + 1) % self._slot_count
+
+        record = self._record
+        pack_into(
+            self.RECORD_FORMAT,
+            record,
+            0,
+            self.MAGIC,
+            self.VERSION,
+            self._sequence,
+            self._selected,
+            self._hour_offset,
+            self._brightness,
+        )
+        pack_into("<I", record, self.RECORD_SIZE - 4, crc32(record[:-4]))
+
+        start = self.AREA_START + self._slot * self.RECORD_SIZE
+        self._nvm[start : start + self.RECORD_SIZE] = record
+        self.writes += 1
+        self.version = self.VERSION
+        self._dirty = False
+        self._flushed_at = monotonic()
+
+    # READING
+    def _load(self):
+        """
+        Finds the newest valid record. Sequence numbers wrap, so "newer" means
+        less than half the sequence space ahead.
+        """
+        area = bytes(self._nvm[self.AREA_START : self.AREA_END])
+        size = self.RECORD_SIZE
+        best = None
+        for slot in range(self._slot_count):
+            record = area[slot * size : (slot + 1) * size]
+            if record[0] != self.MAGIC:
+                continue
+            if not self.OLDEST_VERSION <= record[1] <= self.VERSION:
+                continue
+            if unpack_from("<I", record, size - 4)[0] != crc32(record[:-4]):
+                continue
+            fields = unpack_from(self.RECORD_FORMAT, record)
+            sequence = fields[2]
+            if best is None or (sequence - best[1][2]) & 0xFFFF < 0x8000:
+                best = (slot, fields)
+
+        if best is None:
+            return False
+        self._slot, fields = best
+        _, self.version, self._sequence, self._selected, self._hour_offset = fields[:5]
+        self._brightness = fields[5]
+        return True
+
+    def _load_legacy(self):
+        """
+        Before NVMStore, byte 0 packed the selection and hour offset, and byte
+        1 held the brightness. Carry those over so an upgrade keeps settings.
+        """
+        mem_sel_hour = self._nvm[0]
+        self._selected = mem_sel_hour & 0b000_000_11
+        self._hour_offset = ((mem_sel_hour & 0b000_111_00) >> 2) - 4
+        self._brightness = self._nvm[1]
+        self.version = 0
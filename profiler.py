@@ -0,0 +1,190 @@
+# autocopy
+
+"""
+PROFILER
+
+Where does the loop's time go? ProfiledScheduler is a drop-in Scheduler that
+times every task run, and HealthMonitor samples the rest once a second: HID
+reports sent, free heap. Both are cheap enough to leave running: a task run
+costs two extra ticks_ms() calls and a couple of array increments, and nothing
+allocates until a report is printed.
+
+Times come from supervisor.ticks_ms(), so they're whole milliseconds. Most
+task runs take well under one and land in the first bucket. That's fine: what
+we're after is the runs that take several.
+
+code.py only imports this module when PROFILE is on. With PROFILE off, the
+plain Scheduler runs and none of this is loaded.
+"""
+
+from array import array
+import gc
+
+from heap import largest_free_block
+from ring_buffer import RingBuffer
+from scheduler import Scheduler
+from ticks import ticks_diff, ticks_ms
+
+# Histogram buckets, by milliseconds: 0, 1, 2-3, 4-7, 8-15, 16-31, 32-63, 64+
+BUCKETS = 8
+BUCKET_LABELS = ("0", "1", "2", "4", "8", "16", "32", "64")
+
+
+def bucket(ms):
+    idx = 0
+    while ms > 0 and idx < BUCKETS - 1:
+        ms >>= 1
+        idx += 1
+    return idx
+
+
+def percentile(histogram, fraction):
+    """
+    The lowest bucket (as a label) that holds `fraction` of the samples.
+    """
+    total = sum(histogram)
+    if not total:
+        return "-"
+    needed = total * fraction
+    seen = 0
+    for idx in range(BUCKETS):
+        seen += histogram[idx]
+        if seen >= needed:
+            return BUCKET_LABELS[idx]
+    return BUCKET_LABELS[-1]
+
+
+def format_histogram(histogram):
+    return " ".join(
+        f"{BUCKET_LABELS[idx]}:{histogram[idx]}"
+        for idx in range(BUCKETS)
+        if histogram[idx]
+    )
+
+
+class ProfiledScheduler(Scheduler):
+    def __init__(self):
+        Scheduler.__init__(self)
+        # run times, one histogram per task name
+        self.run_times = {}
+        # how late tasks started, all tasks together
+        self.jitter = array("L", [0] * BUCKETS)
+        # longest single run, during which nothing else could run (ms)
+        self.max_stall = 0
+        self.max_stall_task = None
+
+    def add(self, name, callback, period, priority, delay=0):
+        self.run_times[name] = array("L", [0] * BUCKETS)
+        return Scheduler.add(self, name, callback, period, priority, delay)
+
+    def _run(self, task, late):
+        start = ticks_ms()
+        Scheduler._run(self, task, late)
+        elapsed = ticks_diff(ticks_ms(), start)
+        self.run_times[task.name][bucket(elapsed)] += 1
+        self.jitter[bucket(late)] += 1
+        if elapsed > self.max_stall:
+            self.max_stall = elapsed
+            self.max_stall_task = task.name
+
+    def report(self):
+        Scheduler.report(self)
+        print("run times (ms bucket:runs)")
+        for task in self.tasks:
+            print(f"{task.name:>10}: {format_histogram(self.run_times[task.name])}")
+        print(f"    jitter: {format_histogram(self.jitter)}")
+        print(f"     stall: {self.max_stall} ms in {self.max_stall_task}")
+
+
+class HealthMonitor:
+    # Sample HID and heap (ms)
+    SAMPLE_PERIOD = 1000
+    # Print a report to the serial console every this many samples. 0 to only
+    # report on demand.
+    CONSOLE_EVERY = 30
+    # Free heap samples to keep
+    HEAP_HISTORY = 60
+
+    def __init__(self, tasks, voicemeeter, pixels, idle_mode, screen):
+        self.tasks = tasks
+        self.voicemeeter = voicemeeter
+        self.pixels = pixels
+        self.idle_mode = idle_mode
+        self.screen = screen
+        self.hid_queue = voicemeeter.hid_queue
+        self.hid_per_second = 0
+        self.max_hid_per_second = 0
+        self.free_heap = RingBuffer(self.HEAP_HISTORY, "L")
+        self.min_free_heap = gc.mem_free()
+        self._hid_sent = self._hid_total()
+        self._samples = 0
+
+    def _hid_total(self):
+        return self.hid_queue.sent + self.hid_queue.priority_sent
+
+    def sample(self):
+        hid_sent = self._hid_total()
+        self.hid_per_second = (hid_sent - self._hid_sent) * 1000 // self.SAMPLE_PERIOD
+        self._hid_sent = hid_sent
+        if self.hid_per_second > self.max_hid_per_second:
+            self.max_hid_per_second = self.hid_per_second
+
+        free = gc.mem_free()
+        self.free_heap.push(free)
+        if free < self.min_free_heap:
+            self.min_free_heap = free
+
+        self._samples += 1
+        if self.CONSOLE_EVERY and self._samples % self.CONSOLE_EVERY == 0:
+            self.report()
+
+    def report(self, largest_block=False):
+        """
+        The periodic report leaves out the largest free block: finding it is
+        a dozen collections (see heap.py), and this runs as a task. Ask for it
+        when reporting on demand.
+        """
+        self.tasks.report()
+        print(
+            f"       hid: {self.hid_per_second}/s now, "
+            f"{self.max_hid_per_second}/s max"
+        )
+        print(
+            f"      mute: {self.voicemeeter.suppressed} suppressed, "
+            f"{self.voicemeeter.reasserted} re-asserted"
+        )
+        print(
+            f"      leds: {self.pixels.sent} frames sent, "
+            f"{self.pixels.skipped} unchanged and skipped"
+        )
+        self.idle_mode.report()
+        screen = self.screen
+        print(
+            f"    screen: {screen.refreshes} refreshes, "
+            f"{screen.last_refresh_ms} ms last, {screen.max_refresh_ms} ms max"
+        )
+        heap = (
+            f"      heap: {self.free_heap[0]} B free now, {self.min_free_heap} B lowest"
+        )
+        if largest_block:
+            heap += f", largest block {largest_free_block()} B"
+        print(heap)
+
+    def lines(self):
+        """
+        A short summary for the debug page: p99 run times of the busiest
+        tasks, then the loop's health.
+        """
+        run_times = self.tasks.run_times
+        return (
+            "   DEBUG   ",
+            f"key  {percentile(run_times['keys'], 0.99):>3} ms",
+            f"frm  {percentile(run_times['frame'], 0.99):>3} ms",
+            f"enc  {percentile(run_times['encoder'], 0.99):>3} ms",
+            f"clk  {percentile(run_times['clock'], 0.99):>3} ms",
+            f"late {percentile(self.tasks.jitter, 0.99):>3} ms",
+            f"stall{self.tasks.max_stall:>3} ms",
+            f"hid  {self.hid_per_second:>3} /s",
+            f"disp{self.screen.last_refresh_ms:>3}/{self.screen.max_refresh_ms:<3}",
+            f"heap {self.free_heap[0] // 1024:>3} kB",
+        )
@@ -0,0 +1,46 @@
+# autocopy
+
+"""
+RING BUFFER
+
+A fixed-size history of small integers, newest first. Pushing overwrites the
+oldest entry in place, so keeping a history never allocates. Compare that to a
+list, where pop() and insert(0, ...) shuffle every item along and the new item
+is usually a freshly allocated object.
+"""
+
+from array import array
+
+
+class RingBuffer:
+    def __init__(self, capacity, typecode="H"):
+        self._items = array(typecode, [0] * capacity)
+        self._capacity = capacity
+        self._newest = 0
+
+    def __len__(self):
+        return self._capacity
+
+    def __getitem__(self, age):
+        # age 0 is the newest entry, len - 1 the oldest
+        idx = self._newest - age
+        if idx < 0:
+            idx += self._capacity
+        return self._items[idx]
+
+    def __setitem__(self, age, value):
+        idx = self._newest - age
+        if idx < 0:
+            idx += self._capacity
+        self._items[idx] = value
+
+    def push(self, value):
+        newest = self._newest + 1
+        if newest == self._capacity:
+            newest = 0
+        self._newest = newest
+        self._items[newest] = value
+
+    def clear(self):
+        for idx in range(self._capacity):
+            self._items[idx] = 0
@@ -0,0 +1,170 @@
+# autocopy
+
+"""
+SCHEDULER
+
+Every periodic job on the Macropad (scanning keys, sending HID reports,
+drawing LED frames, updating the clock) is a Task with a period and a
+priority. There is one Scheduler, and both the sync and the async main loop
+are just different ways of waiting for its next deadline, so the timing is the
+same whichever one you pick.
+
+Deadlines are absolute. A task due at t runs next at t + period, not at
+"whenever it finished" + period, so the small delays of a busy loop don't add
+up into drift. If a task falls more than a whole period behind, the periods it
+missed are counted as overruns and skipped: we'd rather drop a frame than draw
+three in a row to catch up.
+
+When several tasks are due, the one with the lowest priority number runs
+first, and then the scheduler looks again. A key event that arrives while the
+LEDs are waiting their turn still goes first.
+
+Tasks can't be interrupted, though, so a key event that arrives while a frame
+is being drawn has to wait for it. The fast lane is a callback that runs at the
+start of every pass, before any task, due or not: once the frame is done, the
+keys go next even if their task isn't due for a few more ms. Long tasks can
+call it themselves halfway through.
+"""
+
+from micropython import const
+from ticks import ticks_add, ticks_diff, ticks_ms
+
+# Priorities, most urgent first
+KEYS = const(0)
+HID = const(1)
+LEDS = const(2)
+CLOCK = const(3)
+
+
+class Task:
+    __slots__ = (
+        "name",
+        "callback",
+        "period",
+        "priority",
+        "deadline",
+        "runs",
+        "overruns",
+        "max_late",
+    )
+
+    def __init__(self, name, callback, period, priority, deadline):
+        self.name = name
+        self.callback = callback
+        # (ms)
+        self.period = period
+        self.priority = priority
+        self.deadline = deadline
+
+        # counters
+        self.runs = 0
+        self.overruns = 0
+        # latest this task has started after its deadline (ms)
+        self.max_late = 0
+
+
+class Scheduler:
+    def __init__(self):
+        self.tasks = []
+        # runs before every task, see the module docstring
+        self.fast_lane = None
+        # ms spent asleep between tasks. It wraps like ticks do, so take
+        # differences with ticks_diff. Elapsed time minus this is time spent
+        # running tasks.
+        self.slept = 0
+
+    def add(self, name, callback, period, priority, delay=0):
+        """
+        Runs callback() every `period` ms, first after `delay` ms. If the
+        callback returns a number, that's the period until its next run: a task
+        can speed itself up or slow itself down without rescheduling.
+        """
+        task = Task(name, callback, period, priority, ticks_add(ticks_ms(), delay))
+        tasks = self.tasks
+        idx = 0
+        # keep tasks sorted by priority, in the order they were added
+        while idx < len(tasks) and tasks[idx].priority <= priority:
+            idx += 1
+        tasks.insert(idx, task)
+        return task
+
+    def reschedule(self, task, period, delay=0):
+        """
+        Changes a task's period now, instead of after its next run, and runs
+        it next after `delay` ms.
+        """
+        task.period = period
+        task.deadline = ticks_add(ticks_ms(), delay)
+
+    def find(self, name):
+        for task in self.tasks:
+            if task.name == name:
+                return task
+        return None
+
+    def run_once(self):
+        """
+        Runs the most urgent task that's due, if any. Returns how long until
+        the next deadline (ms), 0 if something else is due already.
+        """
+        if self.fast_lane is not None:
+            self.fast_lane()
+        now = ticks_ms()
+        wait = None
+        for task in self.tasks:
+            late = ticks_diff(now, task.deadline)
+            if late >= 0:
+                self._run(task, late)
+                return 0
+            if wait is None or -late < wait:
+                wait = -late
+        return wait
+
+    def _run(self, task, late):
+        period = task.callback()
+        if period is not None:
+            task.period = period
+        else:
+            period = task.period
+        task.runs += 1
+        if late > task.max_late:
+            task.max_late = late
+
+        deadline = ticks_add(task.deadline, period)
+        behind = ticks_diff(ticks_ms(), deadline)
+        if behind > 0:
+            # a whole period slipped by: skip it rather than run twice
+            missed = behind // period + 1
+            task.overruns += missed
+            deadline = ticks_add(deadline, missed * period)
+        task.deadline = deadline
+
+    # MAIN LOOPS
+    def run_sync(self, sleep):
+        """
+        sleep is time.sleep. Sleeping instead of spinning lets CircuitPython
+        run its background tasks (USB included) in the meantime.
+        """
+        while True:
+            wait = self.run_once()
+            if wait:
+                self.slept = ticks_add(self.slept, wait)
+                sleep(wait / 1000)
+
+    async def run_async(self, sleep_ms):
+        """
+        sleep_ms is asyncio.sleep_ms. Yields to other coroutines on every pass,
+        even when something else is due right away.
+        """
+        while True:
+            wait = self.run_once()
+            self.slept = ticks_add(self.slept, wait)
+            await sleep_ms(wait)
+
+    # REPORTING
+    def report(self):
+        for task in self.tasks:
+            print(
+                f"{task.name:>10}: {task.runs} runs, {task.overruns} overruns, "
+                f"{task.max_late} ms max late"
+            )
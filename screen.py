@@ -0,0 +1,81 @@
+# autocopy
+
+"""
+SCREEN
+
+With auto_refresh on, displayio redraws whenever anything shown has changed,
+at a moment of its choosing. A refresh blocks everything else for as long as
+the SPI transfer takes, so a redraw landing in the middle of a key press delays
+the mute report.
+
+Screen turns auto_refresh off and refreshes only when something changed, from
+a scheduled task that runs after the keys, HID and LEDs had their turn. Writes
+that don't change anything are dropped before they reach displayio, so they
+don't mark anything dirty: displayio only sends the areas of labels that were
+touched, and the less we touch, the shorter the refresh.
+"""
+
+from ticks import ticks_diff, ticks_ms
+
+
+class Screen:
+    def __init__(self, display):
+        self.display = display
+        display.auto_refresh = False
+        self.root = None
+        self.dirty = False
+
+        # counters
+        self.refreshes = 0
+        self.skipped_writes = 0
+        # how long refreshes blocked for (ms)
+        self.last_refresh_ms = 0
+        self.max_refresh_ms = 0
+        self.total_refresh_ms = 0
+
+    def show(self, group):
+        if group is self.root:
+            return
+        self.root = group
+        self.display.show(group)
+        self.dirty = True
+
+    def set_text(self, label, text):
+        if label.text == text:
+            self.skipped_writes += 1
+            return
+        label.text = text
+        self.dirty = True
+
+    def set_colors(self, label, color, background_color):
+        if label.color == color and label.background_color == background_color:
+            self.skipped_writes += 1
+            return
+        label.color = color
+        label.background_color = background_color
+        self.dirty = True
+
+    def refresh(self):
+        """
+        Sends everything that changed since the last refresh in one go. Cheap
+        to call when nothing did.
+        """
+        if not self.dirty:
+            return
+        start = ticks_ms()
+        self.display.refresh()
+        elapsed = ticks_diff(ticks_ms(), start)
+        self.dirty = False
+
+        self.refreshes += 1
+        self.last_refresh_ms = elapsed
+        self.total_refresh_ms += elapsed
+        if elapsed > self.max_refresh_ms:
+            self.max_refresh_ms = elapsed
+
+    def report(self):
+        average = self.total_refresh_ms / max(1, self.refreshes)
+        print(
+            f"display: {self.refreshes} refreshes, {average:.1f} ms average, "
+            f"{self.max_refresh_ms} ms max, {self.skipped_writes} writes skipped"
+        )
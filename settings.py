@@ -0,0 +1,279 @@
+# autocopy
+
+"""
+SETTINGS
+
+Timing, colors, HID codes, the pixel order and the idle timeout can be
+changed in settings.json on CIRCUITPY, without editing code.py. Every setting
+is optional: anything left out keeps the value in code.py. For example:
+
+    {
+        "passive_frame_period": 40,
+        "ripple_color": [255, 255, 255],
+        "muted_gradient": [[0.0, [255, 0, 0]], [0.5, [80, 0, 0]], [1.0, [255, 0, 0]]],
+        "mute_code": 200
+    }
+
+Parsing JSON at every power-up costs time and heap, so the file is validated
+and compiled into a small binary record, kept in the upper half of the NVM
+(NVMStore has the lower half). Boot unpacks the record without opening the
+file, so the mute report doesn't wait for CIRCUITPY. Once everything urgent is
+up, sync() checks the file's CRC-32 against the one the record was compiled
+from. The JSON is only parsed again once the file changes, and then code.py
+reloads to use it.
+
+Record layout, little-endian: RECORD_HEADER (magic, format, body length, CRC
+of settings.json), then the body (a bitmask of the settings present, then each
+present setting in FIELDS order), then the CRC-32 of header and body.
+"""
+
+from binascii import crc32
+import json
+import struct
+
+# relative, so the emulator finds the one next to code.py
+PATH = "settings.json"
+
+# Name in settings.json, and how it's stored
+PERIOD = 0  # ms, "<H"
+GRADIENT = 1  # count "B", then count stops of position * 10000, r, g, b "<HBBB"
+COLOR = 2  # r, g, b "BBB"
+CODE = 3  # consumer control code, "<H"
+PIXEL_ORDER = 4  # 12 pixel indexes "12B"
+SECONDS = 5  # s, "<H"
+# fmt: off
+FIELDS = (
+    ("passive_frame_period", PERIOD),
+    ("button_period", PERIOD),
+    ("encoder_period", PERIOD),
+    ("muted_gradient", GRADIENT),
+    ("unmuted_gradient", GRADIENT),
+    ("ripple_color", COLOR),
+    ("mute_code", CODE),
+    ("unmute_code", CODE),
+    ("volume_up_code", CODE),
+    ("volume_down_code", CODE),
+    ("pixel_order", PIXEL_ORDER),
+    ("idle_timeout", SECONDS),
+)
+# fmt: on
+MAX_PERIOD = 60_000
+MAX_STOPS = 16
+# Gradient positions are stored as whole numbers, in steps of 1 / POSITION_SCALE.
+# Decimal, so positions like 0.6 come back from the cache unchanged.
+POSITION_SCALE = 10_000
+
+MAGIC = 0x53
+FORMAT = 1
+RECORD_HEADER = "<BBHI"
+HEADER_SIZE = struct.calcsize(RECORD_HEADER)
+# Byte range of the NVM the record lives in
+AREA_START = 2048
+AREA_END = 4096
+
+
+class Settings:
+    def __init__(self, values=None, source="defaults", record=None):
+        self._values = values or {}
+        # where the values came from: "defaults" (no settings.json), "cache",
+        # "settings.json" (parsed, and cached by save()), or an error message
+        self.source = source
+        # a freshly compiled record, waiting for save()
+        self._record = record
+
+    def get(self, name, default):
+        return self._values.get(name, default)
+
+    @classmethod
+    def cached(cls, nvm):
+        """
+        The values in the NVM record, whichever settings.json they were
+        compiled from, or the defaults if there's no record. Only reads the
+        NVM.
+        """
+        values = decode(nvm)
+        if values is None:
+            return cls()
+        return cls(values, "cache")
+
+    @classmethod
+    def load(cls, nvm, path=PATH):
+        """
+        Never raises: with a broken settings.json, it prints why and returns
+        the defaults.
+        """
+        try:
+            with open(path, "rb") as file:
+                text = file.read()
+        except OSError:
+            return cls()
+        source_crc = crc32(text) & 0xFFFFFFFF
+        values = decode(nvm, source_crc)
+        if values is not None:
+            return cls(values, "cache")
+        try:
+            values = validate(json.loads(text))
+        except ValueError as error:
+            print(f"settings.json: {error}. Using the defaults.")
+            return cls(source=f"error: {error}")
+        return cls(values, "settings.json", encode(values, source_crc))
+
+    def save(self, nvm):
+        """
+        Writes the record compiled by load(), if there is one.
+        """
+        if self._record is None:
+            return
+        nvm[AREA_START : AREA_START + len(self._record)] = self._record
+        self._record = None
+
+    def sync(self, nvm, path=PATH):
+        """
+        Checks settings.json against these (cached) values and brings the NVM
+        record up to date with it. Returns True if the values changed, so
+        code.py has to reload to use them.
+
+        Reading the file, and after a change parsing it and writing the NVM
+        (which erases a flash sector, tens of ms), is why code.py calls this
+        once the mute has been reported and the first frames are out.
+        """
+        current = Settings.load(nvm, path)
+        if current._record is not None:
+            current.save(nvm)
+        elif current.source != "cache" and nvm[AREA_START] == MAGIC:
+            # no settings.json, or a broken one: boot with the defaults
+            nvm[AREA_START] = 0
+        return current._values != self._values
+
+
+# VALIDATING
+def _int(name, value, low, high):
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise ValueError(f"{name} should be a whole number")
+    if not low <= value <= high:
+        raise ValueError(f"{name} should be between {low} and {high}")
+    return value
+
+
+def _color(name, value):
+    if not isinstance(value, list) or len(value) != 3:
+        raise ValueError(f"{name} should be [red, green, blue]")
+    return tuple(_int(name, channel, 0, 255) for channel in value)
+
+
+def validate(raw):
+    """
+    Checks parsed settings.json and returns {name: value} with values in the
+    form code.py uses. Raises ValueError, naming the first problem.
+    """
+    if not isinstance(raw, dict):
+        raise ValueError("should hold one {...} object")
+    kinds = dict(FIELDS)
+    values = {}
+    for name, value in raw.items():
+        if name not in kinds:
+            raise ValueError(f"unknown setting {name}")
+        kind = kinds[name]
+        if kind == PERIOD:
+            values[name] = _int(name, value, 1, MAX_PERIOD)
+        elif kind == CODE:
+            values[name] = _int(name, value, 1, 0xFFFF)
+        elif kind == SECONDS:
+            values[name] = _int(name, value, 0, 0xFFFF)
+        elif kind == COLOR:
+            values[name] = _color(name, value)
+        elif kind == GRADIENT:
+            if not isinstance(value, list) or not 2 <= len(value) <= MAX_STOPS:
+                raise ValueError(f"{name} should have 2 to {MAX_STOPS} stops")
+            stops = []
+            for stop in value:
+                if not isinstance(stop, list) or len(stop) != 2:
+                    raise ValueError(f"{name} stops should be [position, color]")
+                position, color = stop
+                if not isinstance(position, (int, float)) or not 0 <= position <= 1:
+                    raise ValueError(f"{name} positions should be 0.0 to 1.0")
+                if stops and position < stops[-1][0]:
+                    raise ValueError(f"{name} positions should go up")
+                stops.append((position, _color(name, color)))
+            values[name] = tuple(stops)
+        else:
+            if not isinstance(value, list) or len(value) != 12:
+                raise ValueError(f"{name} should have 12 pixel indexes")
+            for idx in value:
+                _int(name, idx, 0, 11)
+            if len(set(value)) != 12:
+                raise ValueError(f"{name} should hold each of 0 to 11 once")
+            values[name] = tuple(value)
+    return values
+
+
+# COMPILING
+def encode(values, source_crc):
+    """
+    Compiles validated values into a record.
+    """
+    present = 0
+    body = bytearray(2)
+    for bit, (name, kind) in enumerate(FIELDS):
+        if name not in values:
+            continue
+        present |= 1 << bit
+        value = values[name]
+        if kind == PERIOD or kind == CODE or kind == SECONDS:
+            body += struct.pack("<H", value)
+        elif kind == COLOR or kind == PIXEL_ORDER:
+            body += bytes(value)
+        else:
+            body.append(len(value))
+            for position, (r, g, b) in value:
+                body += struct.pack("<HBBB", round(position * POSITION_SCALE), r, g, b)
+    struct.pack_into("<H", body, 0, present)
+    header = struct.pack(RECORD_HEADER, MAGIC, FORMAT, len(body), source_crc)
+    record = header + body
+    return record + struct.pack("<I", crc32(record) & 0xFFFFFFFF)
+
+
+def decode(nvm, source_crc=None):
+    """
+    Returns the values in the NVM record if it checks out and was compiled
+    from a file with source_crc (or any file, if None), None otherwise.
+    """
+    header = bytes(nvm[AREA_START : AREA_START + HEADER_SIZE])
+    magic, version, length, record_source = struct.unpack(RECORD_HEADER, header)
+    if magic != MAGIC or version != FORMAT:
+        return None
+    if source_crc is not None and record_source != source_crc:
+        return None
+    end = AREA_START + HEADER_SIZE + length
+    if end + 4 > AREA_END:
+        return None
+    record = bytes(nvm[AREA_START:end])
+    (expected,) = struct.unpack("<I", bytes(nvm[end : end + 4]))
+    if crc32(record) & 0xFFFFFFFF != expected:
+        return None
+
+    (present,) = struct.unpack_from("<H", record, HEADER_SIZE)
+    offset = HEADER_SIZE + 2
+    values = {}
+    for bit, (name, kind) in enumerate(FIELDS):
+        if not present & (1 << bit):
+            continue
+        if kind == PERIOD or kind == CODE or kind == SECONDS:
+            (values[name],) = struct.unpack_from("<H", record, offset)
+            offset += 2
+        elif kind == COLOR:
+            values[name] = tuple(record[offset : offset + 3])
+            offset += 3
+        elif kind == PIXEL_ORDER:
+            values[name] = tuple(record[offset : offset + 12])
+            offset += 12
+        else:
+            count = record[offset]
+            offset += 1
+            stops = []
+            for _ in range(count):
+                position, r, g, b = struct.unpack_from("<HBBB", record, offset)
+                stops.append((position / POSITION_SCALE, (r, g, b)))
+                offset += 5
+            values[name] = tuple(stops)
+    return values
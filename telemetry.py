@@ -0,0 +1,197 @@
+# autocopy
+
+"""
+TELEMETRY
+
+A binary channel on the usb_cdc data port (boot.py turns it on), so a host can
+watch the Macropad and send it commands without scraping the REPL console.
+host/monitor.py is the other end.
+
+Every message is one frame:
+
+    SYNC | kind (1 byte) | length (1 byte) | payload | CRC-32 (4 bytes)
+
+The CRC covers kind, length and payload. A reader that starts mid-stream, or
+misses bytes, skips ahead to the next SYNC byte whose frame checks out.
+Payloads are little-endian structs, one format per kind, listed below along
+with their field names. Everything in here runs on the Macropad and on the
+host alike.
+"""
+
+import binascii
+import struct
+
+SYNC = 0xA5
+HEADER_FORMAT = "<BBB"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+CRC_FORMAT = "<I"
+CRC_SIZE = struct.calcsize(CRC_FORMAT)
+MAX_PAYLOAD = 255
+
+# Device to host
+TELEMETRY = 0x01
+STATE = 0x02
+ACK = 0x03
+# Host to device
+SET_BRIGHTNESS = 0x10
+REQUEST_STATE = 0x11
+SET_PERIOD = 0x12
+
+# ACK statuses
+OK = 0
+BAD_ARGUMENT = 1
+UNKNOWN_COMMAND = 2
+
+# Sent every telemetry period. Counters count up from boot. The frame
+# histogram is frame run times by ms bucket (see profiler.py), all zeros
+# without PROFILE.
+# fmt: off
+TELEMETRY_FORMAT = "<IBBIIIIIIHI8I"
+TELEMETRY_FIELDS = (
+    "ticks_ms", "muted", "brightness",
+    "key_events", "hid_reports", "mute_suppressed", "mute_reasserted",
+    "frames", "frame_overruns", "frame_max_late", "free_heap",
+)
+# fmt: on
+# Buckets in the frame histogram, after TELEMETRY_FIELDS
+HISTOGRAM_BUCKETS = 8
+# Sent on REQUEST_STATE: STATE_FORMAT, then one TASK_FORMAT record per task,
+# each followed by the task's name (name_length bytes of UTF-8)
+STATE_FORMAT = "<BBBbBHI"
+STATE_FIELDS = (
+    "muted",
+    "brightness",
+    "selected",
+    "hour_offset",
+    "nvm_version",
+    "telemetry_period",
+    "free_heap",
+)
+TASK_FORMAT = "<IIHBB"
+TASK_FIELDS = ("runs", "overruns", "max_late", "priority", "name_length")
+# Command payloads
+ACK_FORMAT = "<BB"
+SET_BRIGHTNESS_FORMAT = "<B"
+SET_PERIOD_FORMAT = "<H"
+
+
+def crc(data):
+    return binascii.crc32(data) & 0xFFFFFFFF
+
+
+def encode(kind, payload=b""):
+    """
+    Returns one frame, ready to write.
+    """
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError("payload too long")
+    frame = bytearray(HEADER_SIZE + len(payload) + CRC_SIZE)
+    struct.pack_into(HEADER_FORMAT, frame, 0, SYNC, kind, len(payload))
+    frame[HEADER_SIZE : HEADER_SIZE + len(payload)] = payload
+    checked = frame[1 : HEADER_SIZE + len(payload)]
+    struct.pack_into(CRC_FORMAT, frame, HEADER_SIZE + len(payload), crc(checked))
+    return bytes(frame)
+
+
+class FrameReader:
+    """
+    Collects bytes as they arrive and cuts them into frames.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        # bytes skipped looking for a frame that checks out
+        self.skipped = 0
+
+    def feed(self, data):
+        """
+        Returns [(kind, payload), ...] for every frame completed by `data`.
+        """
+        buffer = self._buffer
+        buffer.extend(data)
+        frames = []
+        while buffer:
+            if buffer[0] != SYNC:
+                # (MicroPython's bytearray has no find())
+                start = 1
+                while start < len(buffer) and buffer[start] != SYNC:
+                    start += 1
+                self.skipped += start
+                buffer[:start] = b""
+                continue
+            if len(buffer) < HEADER_SIZE:
+                break
+            _, kind, length = struct.unpack_from(HEADER_FORMAT, buffer, 0)
+            end = HEADER_SIZE + length
+            if len(buffer) < end + CRC_SIZE:
+                break
+            (expected,) = struct.unpack_from(CRC_FORMAT, buffer, end)
+            if crc(buffer[1:end]) != expected:
+                # not a frame after all, look for the next SYNC
+                self.skipped += 1
+                buffer[:1] = b""
+                continue
+            frames.append((kind, bytes(buffer[HEADER_SIZE:end])))
+            buffer[: end + CRC_SIZE] = b""
+        return frames
+
+
+class Channel:
+    """
+    The Macropad's end. Never blocks: with nobody listening, frames are
+    dropped, and a frame that doesn't fit in the USB buffer is cut short, for
+    the host to skip.
+    """
+
+    def __init__(self, serial):
+        self.serial = serial
+        serial.timeout = 0
+        serial.write_timeout = 0
+        self._reader = FrameReader()
+        # the telemetry frame is packed in place every period
+        size = struct.calcsize(TELEMETRY_FORMAT)
+        self._telemetry = bytearray(HEADER_SIZE + size + CRC_SIZE)
+        struct.pack_into(HEADER_FORMAT, self._telemetry, 0, SYNC, TELEMETRY, size)
+
+        # counters
+        self.sent = 0
+        self.dropped = 0
+        self.received = 0
+
+    def commands(self):
+        """
+        Returns [(kind, payload), ...] for the commands that came in since the
+        last call.
+        """
+        waiting = self.serial.in_waiting
+        if not waiting:
+            return ()
+        frames = self._reader.feed(self.serial.read(waiting))
+        self.received += len(frames)
+        return frames
+
+    def send(self, kind, payload=b""):
+        self._write(encode(kind, payload))
+
+    def send_telemetry(self, values):
+        """
+        values are the TELEMETRY_FIELDS, then the HISTOGRAM_BUCKETS.
+        """
+        frame = self._telemetry
+        end = len(frame) - CRC_SIZE
+        struct.pack_into(TELEMETRY_FORMAT, frame, HEADER_SIZE, *values)
+        struct.pack_into(CRC_FORMAT, frame, end, crc(memoryview(frame)[1:end]))
+        self._write(frame)
+
+    def ack(self, command, status=OK):
+        self.send(ACK, struct.pack(ACK_FORMAT, command, status))
+
+    def _write(self, frame):
+        if not self.serial.connected:
+            self.dropped += 1
+            return
+        written = self.serial.write(frame)
+        if written is not None and written < len(frame):
+            self.dropped += 1
+        else:
+            self.sent += 1
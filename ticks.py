@@ -0,0 +1,31 @@
+# autocopy
+
+"""
+TICKS
+
+supervisor.ticks_ms() counts milliseconds in a small int, so reading it never
+allocates, and unlike monotonic() it doesn't lose precision after the board has
+been up for a few hours. The price is that it wraps every 2**29 ms (about six
+days), so compare ticks with these helpers instead of < and -.
+
+Same names and behaviour as adafruit_ticks, without the extra library.
+"""
+
+from micropython import const
+from supervisor import ticks_ms
+
+_TICKS_PERIOD = const(1 << 29)
+_TICKS_MAX = const(_TICKS_PERIOD - 1)
+_TICKS_HALFPERIOD = const(_TICKS_PERIOD // 2)
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & _TICKS_MAX
+
+
+def ticks_diff(new, old):
+    return ((new - old + _TICKS_HALFPERIOD) & _TICKS_MAX) - _TICKS_HALFPERIOD
+
+
+def ticks_less(a, b):
+    return ticks_diff(b, a) > 0
@@ -0,0 +1,153 @@
+# autocopy
+
+"""
+WALL CLOCK
+
+The DS3231 keeps good time, but every read is an I2C transfer of about a ms,
+and the clock face used to make two of them a minute, plus one for every
+hour offset change. WallClock reads the chip now and then, and in between
+works the time out from ticks_ms(): telling the time is arithmetic on small
+ints, no I2C and no allocation. Seconds since 1970 are past 2**30, the most a
+small int holds on the RP2040, so they only come up at a resync. In between,
+the time is kept as seconds into the day.
+
+A read only says which second it is, not how far into it. So a resync
+watches for the chip's next second to begin, reading it every EDGE_POLL ms
+until it ticks over, and lines the extrapolated time up with that edge. The
+watching is spread over scheduled task runs, never a blocking loop, and after
+the first resync it starts just before the edge is due: a handful of reads.
+
+The RP2040's crystal and the DS3231's don't run at quite the same rate, so
+ticks drift against the chip by tens of ppm. Edges are ticks apart by exactly
+the seconds between them, give or take EDGE_POLL, so comparing the first edge
+with the latest one gives the drift, and the extrapolation corrects for it.
+"""
+
+from time import mktime
+
+from ticks import ticks_add, ticks_diff, ticks_ms
+
+DAY = 24 * 60 * 60
+
+
+class WallClock:
+    # Resync this often (ms). Keep it well under ticks' 3 day horizon.
+    RESYNC_PERIOD = 10 * 60_000
+    # Read the chip this often while watching for its second to tick over
+    # (ms). An edge is placed to within half of this.
+    EDGE_POLL = 10
+    # Start watching this long before the edge is expected (ms). Drift that
+    # isn't corrected for yet has to fit in it, 30 ppm is 18 ms a
+    # RESYNC_PERIOD; a miss only costs a second of watching.
+    EDGE_LEAD = 50
+    # Only estimate drift over at least this long (ms). The estimate is good to
+    # about EDGE_POLL / DRIFT_SPAN * 1_000_000 ppm.
+    DRIFT_SPAN = 30 * 60_000
+    # Crystals are off by tens of ppm. Drift estimates are kept within this
+    # (ppm).
+    MAX_DRIFT = 500
+    # An edge this far off the extrapolated time means the chip was set, and
+    # drift tracking starts over (s)
+    MAX_STEP = 2
+
+    def __init__(self, rtc):
+        self.rtc = rtc
+        # seconds since the epoch at the start of the day (a long int), then
+        # seconds into that day, and the ticks at which that second began
+        self._day = 0
+        self._seconds = 0
+        self._set_seconds(mktime(rtc.datetime))
+        # (at boot there's no time to wait for an edge, so this is up to a
+        # second early until the first resync)
+        self._ticks = ticks_ms()
+        # ticks per ms of drift correction (negative if the ticks run fast),
+        # 0 for none
+        self._ticks_per_correction = 0
+        # while watching for an edge: the second the chip was in, and when
+        # it was last read
+        self._watching = None
+        self._polled_at = 0
+        # first edge: drift is measured from it
+        self._anchor_seconds = None
+        self._anchor_ticks = 0
+        self._anchor_span = 0
+
+        # stats
+        self.drift_ppm = 0
+        self.resyncs = 0
+        # furthest the extrapolated time was off at a resync (ms)
+        self.max_error = 0
+
+    def _set_seconds(self, chip):
+        self._seconds = chip % DAY
+        self._day = chip - self._seconds
+
+    def _elapsed(self, now):
+        # ms since self._ticks, drift corrected
+        elapsed = ticks_diff(now, self._ticks)
+        if self._ticks_per_correction:
+            elapsed += elapsed // self._ticks_per_correction
+        return elapsed
+
+    # READING
+    def seconds_today(self):
+        """
+        Seconds since midnight, like time.mktime(rtc.datetime) % DAY.
+        """
+        return (self._seconds + self._elapsed(ticks_ms()) // 1000) % DAY
+
+    def ms_to_next_minute(self):
+        elapsed = self._elapsed(ticks_ms())
+        seconds = self._seconds + elapsed // 1000
+        return (60 - seconds % 60) * 1000 - elapsed % 1000
+
+    # SYNCING
+    def resync(self):
+        """
+        A scheduled task. Every RESYNC_PERIOD it starts watching the chip,
+        and returns EDGE_POLL as its period until the chip's second ticks over.
+        """
+        second = self.rtc.datetime.tm_sec
+        now = ticks_ms()
+        # (a late read, behind some long task, would place the edge badly:
+        # wait for the next one instead)
+        late = ticks_diff(now, self._polled_at) > 2 * self.EDGE_POLL
+        if self._watching is None or second == self._watching or late:
+            self._watching = second
+            self._polled_at = now
+            return self.EDGE_POLL
+        # the second began between the last two reads
+        edge = ticks_add(now, -(ticks_diff(now, self._polled_at) // 2))
+        self._watching = None
+        # only the edge's second needs the full date
+        self._align(mktime(self.rtc.datetime), edge)
+        # come back just before an edge, in ticks
+        period = self.RESYNC_PERIOD
+        if self._ticks_per_correction:
+            period -= period // self._ticks_per_correction
+        return period - self.EDGE_LEAD
+
+    def _align(self, chip, edge):
+        self.resyncs += 1
+        elapsed = self._elapsed(edge)
+        seconds = self._seconds + elapsed // 1000
+        # how far behind the chip we were (ms)
+        error = (chip - self._day - seconds) * 1000 - elapsed % 1000
+        self._set_seconds(chip)
+        self._ticks = edge
+        if self._anchor_seconds is None or abs(error) > self.MAX_STEP * 1000:
+            # the first edge, or the chip was set
+            self._anchor_seconds = chip
+            self._anchor_ticks = edge
+            self._anchor_span = 0
+            return
+        self.max_error = max(self.max_error, abs(error))
+        self._anchor_span += ticks_diff(edge, self._anchor_ticks)
+        self._anchor_ticks = edge
+        span = self._anchor_span
+        if span >= self.DRIFT_SPAN:
+            # floats are fine here, this runs once every RESYNC_PERIOD
+            ppm = ((chip - self._anchor_seconds) * 1000 - span) * 1_000_000 / span
+            ppm = max(-self.MAX_DRIFT, min(self.MAX_DRIFT, ppm))
+            self.drift_ppm = round(ppm)
+            self._ticks_per_correction = round(1_000_000 / ppm) if ppm else 0